@@ -0,0 +1,126 @@
+"""
+한정 판매(/buy 동시 요청) 부하 테스트 — 초과 판매가 없는지 확인 (디스코드 연결 없이 실행).
+
+    python bench/bench_flash_sale.py [--buyers 2000] [--requests 5000] [--stock 100] [--writers 2]
+
+임시 points DB 에 재고 --stock 개짜리 아이템을 만들고, --buyers 명(일부는 포인트 부족)이
+--requests 번의 구매를 한꺼번에 보냄. --writers 개의 구매 엔진이 각자 별도 커넥션/스레드로
+같은 DB 파일에 씀 (샤드 프로세스 여러 개와 같은 상황, 메모리 재고는 서로 모름).
+끝난 뒤 DB 로 확인:
+- 판매 수 == min(재고, 살 수 있는 요청) 이고 재고가 음수가 아님
+- purchases 행 수 == 성공 응답 수, 차감된 포인트 합 == 판매 수 × 가격
+- 잔액이 음수인 유저 없음, 장부(points_ledger)와 잔액 일치
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+_tmp = tempfile.mkdtemp(prefix="bench_flash_")
+os.environ["POINTS_DB_PATH"] = os.path.join(_tmp, "points.db")
+os.environ.setdefault("TTS_CACHE_DIR", os.path.join(_tmp, "tts"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mybot  # noqa: E402
+
+GUILD_ID = 1
+
+
+def setup(args, rng):
+    db = mybot.points_db
+    db.write_sync(mybot.init_points_db)
+    balances = {}
+    for uid in range(1, args.buyers + 1):
+        # 10% 는 가격보다 적게, 나머지는 1~3개 살 만큼
+        balances[uid] = rng.randrange(0, args.price) if rng.random() < 0.1 else args.price * rng.randint(1, 3)
+
+    def _setup(conn):
+        conn.executemany("INSERT INTO users(guild_id, user_id, points) VALUES(?, ?, ?)",
+                         [(GUILD_ID, uid, pts) for uid, pts in balances.items()])
+        mybot.seed_ledger_base(conn)
+        return conn.execute("INSERT INTO shop(guild_id, name, price, stock) VALUES(?, ?, ?, ?) RETURNING id",
+                            (GUILD_ID, "한정판", args.price, args.stock)).fetchone()["id"]
+
+    return db.write_sync(_setup), balances
+
+
+async def storm(engines, item_id, buyers, n_requests, rng):
+    latencies = []
+    statuses = []
+
+    async def one(i):
+        engine = engines[i % len(engines)]
+        t0 = time.perf_counter()
+        status, _, _ = await engine.buy(GUILD_ID, buyers[rng.randrange(len(buyers))], item_id)
+        latencies.append(time.perf_counter() - t0)
+        statuses.append(status)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n_requests)))
+    return time.perf_counter() - t0, statuses, latencies
+
+
+def verify(item_id, balances, price, stock, statuses):
+    def _check(conn):
+        left = conn.execute("SELECT stock FROM shop WHERE id=?", (item_id,)).fetchone()["stock"]
+        sold = conn.execute("SELECT COUNT(*) FROM purchases WHERE item_id=?", (item_id,)).fetchone()[0]
+        rows = conn.execute("SELECT user_id, points FROM users WHERE guild_id=?", (GUILD_ID,)).fetchall()
+        drift = sum(1 for r in rows if mybot.ledger_balance(conn, GUILD_ID, r["user_id"]) != r["points"])
+        return left, sold, {r["user_id"]: r["points"] for r in rows}, drift
+
+    left, sold, after, drift = mybot.points_db.write_sync(_check)
+    ok = statuses.count("ok")
+    spent = sum(balances.values()) - sum(after.values())
+    checks = {
+        "재고 음수 아님": left >= 0,
+        "판매 수 + 남은 재고 == 초기 재고": sold + left == stock,
+        "purchases 행 수 == 성공 응답": sold == ok,
+        "차감 포인트 == 판매 수 × 가격": spent == sold * price,
+        "잔액 음수 없음": min(after.values()) >= 0,
+        "장부 == 잔액": drift == 0,
+    }
+    return sold, left, checks
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    item_id, balances = setup(args, rng)
+    # 엔진 1개는 전역 points_db, 나머지는 같은 파일에 별도 커넥션 (다른 프로세스 흉내, BEGIN IMMEDIATE)
+    dbs = [mybot.points_db] + [mybot.PointsDB(mybot.POINTS_DB_PATH, immediate=True) for _ in range(args.writers - 1)]
+    engines = [mybot.PurchaseEngine(db) for db in dbs]
+    elapsed, statuses, latencies = await storm(engines, item_id, list(balances), args.requests, rng)
+    for db in dbs[1:]:
+        db.close()
+
+    sold, left, checks = verify(item_id, balances, args.price, args.stock, statuses)
+    latencies.sort()
+    print(f"요청 {args.requests}건 / {elapsed:.3f}s ({args.requests / elapsed:,.0f} req/s), 엔진 {len(engines)}개, "
+          f"DB 트랜잭션 {sum(e.batches for e in engines)}번")
+    print(f"지연 p50 {statistics.median(latencies) * 1000:.1f}ms / p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f}ms")
+    print("응답:", {s: statuses.count(s) for s in sorted(set(statuses))}, f"판매 {sold}, 남은 재고 {left}")
+    for name, passed in checks.items():
+        print(f"  [{'OK' if passed else 'FAIL'}] {name}")
+    return all(checks.values())
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--buyers", type=int, default=2000)
+    ap.add_argument("--requests", type=int, default=5000)
+    ap.add_argument("--stock", type=int, default=100)
+    ap.add_argument("--price", type=int, default=50)
+    ap.add_argument("--writers", type=int, default=2)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+    passed = asyncio.run(run(args))
+    mybot.points_db.close()
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+"""
+Lavalink 노드 장애 대응 확인 — 가짜 노드/풀로 실행 (Lavalink 서버, 디스코드 연결 없음).
+
+    python bench/bench_lavalink_failover.py
+
+mybot.wavelink 를 가짜 Pool/Node/Player 로 바꿔 LavalinkPool 을 그대로 돌림:
+- 연결이 끝나지 않는 노드가 있어도 connect() 가 바로 반환되고 나머지 노드는 연결됨
+- 노드가 끊기면(on_wavelink_node_disconnected) 붙어 있던 플레이어가 살아있는 노드로 옮겨짐
+- 재연결 중인 노드의 플레이어도 lavalink_stats_loop 의 상태 확인에서 옮겨짐
+- 재시도를 다 쓴 노드는 상태 확인에서 새로 연결됨
+실패하면 종료 코드 1.
+"""
+import asyncio
+import enum
+import os
+import sys
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+_tmp = tempfile.mkdtemp(prefix="bench_lavalink_")
+os.environ["POINTS_DB_PATH"] = os.path.join(_tmp, "points.db")
+os.environ.setdefault("TTS_CACHE_DIR", os.path.join(_tmp, "tts"))
+os.environ["LAVALINK_NODES"] = "a=http://a:2333|pw,b=http://b:2333|pw,slow=http://slow:2333|pw"
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mybot  # noqa: E402
+
+
+class NodeStatus(enum.Enum):
+    DISCONNECTED = 0
+    CONNECTING = 1
+    CONNECTED = 2
+
+
+class FakeNode:
+    def __init__(self, *, identifier, uri, password, retries):
+        self.identifier = identifier
+        self.status = NodeStatus.CONNECTING
+        self.players: dict[int, "FakePlayer"] = {}
+        self.closed = False
+
+    async def fetch_stats(self):
+        return SimpleNamespace(playing=len(self.players), cpu=SimpleNamespace(system_load=0.1), frames=None)
+
+    async def close(self, eject=False):
+        # 실제 wavelink 처럼 닫을 때 남은 플레이어를 끊음
+        for player in list(self.players.values()):
+            player.node = None
+        self.players.clear()
+        self.closed = True
+        if eject:
+            FakePool.nodes.pop(self.identifier, None)
+
+
+class FakePool:
+    nodes: dict[str, FakeNode] = {}
+    connects = 0
+
+    @classmethod
+    async def connect(cls, *, nodes, client, cache_capacity):
+        for node in nodes:
+            cls.connects += 1
+            if node.identifier == "slow":
+                await asyncio.Event().wait()  # 응답 없는 노드: 영원히 연결 중
+            node.status = NodeStatus.CONNECTED
+            cls.nodes[node.identifier] = node
+
+
+class FakePlayer:
+    def __init__(self, guild_id, node):
+        self.guild_id, self.node = guild_id, node
+        node.players[guild_id] = self
+
+    async def switch_node(self, new_node):
+        if self.node is None:
+            raise RuntimeError("Player is not connected")
+        del self.node.players[self.guild_id]
+        self.node = new_node
+        new_node.players[self.guild_id] = self
+
+
+mybot.wavelink = SimpleNamespace(Pool=FakePool, Node=FakeNode, NodeStatus=NodeStatus, Player=FakePlayer)
+
+
+def check(ok: bool, what: str, failures: list):
+    print(("OK   " if ok else "FAIL ") + what)
+    if not ok:
+        failures.append(what)
+
+
+async def main() -> int:
+    failures: list[str] = []
+    pool = mybot.LavalinkPool(os.environ["LAVALINK_NODES"])
+    mybot.lavalink_pool = pool
+    mybot.lavalink_stats_loop.change_interval(seconds=3600)  # 상태 확인은 아래에서 직접 호출
+
+    pool.connect()
+    await asyncio.sleep(0.05)
+    nodes = FakePool.nodes
+    check(set(pool.healthy()) == {"a", "b"}, "응답 없는 노드가 있어도 나머지 노드 연결", failures)
+    check(not pool._connecting["slow"].done(), "응답 없는 노드는 백그라운드에서 계속 연결 중", failures)
+
+    # 1) 연결 끊김 이벤트: 플레이어가 아직 붙어 있을 때 옮김
+    a, b = nodes["a"], nodes["b"]
+    players = [FakePlayer(gid, a) for gid in range(1, 6)]
+    a.status = NodeStatus.CONNECTING  # wavelink 는 끊기면 재연결 시도 중 상태
+    await mybot.on_wavelink_node_disconnected(SimpleNamespace(node=a))
+    check(all(p.node is b for p in players) and not a.players, "끊김 이벤트 → 플레이어 5개 b 로 이동", failures)
+
+    # 2) 이벤트를 놓쳐도 상태 확인에서 옮김
+    a.status = NodeStatus.CONNECTED
+    for p in players[:2]:
+        await p.switch_node(a)
+    a.status = NodeStatus.CONNECTING
+    await pool.check_health()
+    check(all(p.node is b for p in players), "상태 확인 → 재연결 중인 노드의 플레이어 이동", failures)
+
+    # 3) 재시도를 다 쓴 노드는 새로 연결
+    a.status = NodeStatus.DISCONNECTED
+    before = FakePool.connects
+    await pool.check_health()
+    await asyncio.sleep(0.05)
+    fresh = nodes.get("a")
+    check(a.closed and fresh is not None and fresh is not a and fresh.status == NodeStatus.CONNECTED
+          and FakePool.connects == before + 1, "재시도 소진 노드 → 새 노드로 재연결", failures)
+    check(all(p.node is b for p in players), "재연결 중에도 플레이어는 b 에서 계속 재생", failures)
+
+    # 4) 살아있는 노드가 없으면 옮기지 않고 그대로 둠
+    b.status = NodeStatus.CONNECTING
+    fresh.status = NodeStatus.CONNECTING
+    moved = await pool.failover(b)
+    check(moved == 0 and all(p.node is b for p in players), "옮길 노드가 없으면 플레이어 유지", failures)
+
+    mybot.lavalink_stats_loop.cancel()
+    for task in pool._connecting.values():
+        task.cancel()
+    print("통과" if not failures else f"실패 {len(failures)}건")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main()))
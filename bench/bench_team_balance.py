@@ -0,0 +1,73 @@
+"""
+팀 밸런서 벤치마크: balance_teams vs 예전 $팀짜기 그리디(섞고 합이 작은 팀에 배치).
+
+    python bench/bench_team_balance.py [--trials 200] [--seed 1]
+
+인원/팀 수별로 점수 차(최대 팀합 - 최소 팀합)의 평균/p95 와 1회 실행 시간을 출력.
+점수는 등록 기본값(1000) 근처 분포, 포지션은 POSITION_ROLES 에서 무작위.
+"""
+import argparse
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mybot import POSITION_ROLES, balance_teams, team_cost  # noqa: E402
+
+CASES = [(6, 2), (10, 2), (16, 2), (24, 2), (40, 2), (12, 3), (15, 3), (12, 4), (20, 4), (40, 4), (100, 4)]
+
+
+def greedy_teams(scores, k, rng):
+    """예전 방식을 k팀으로 그대로 확장"""
+    order = list(range(len(scores)))
+    rng.shuffle(order)
+    teams, sums = [[] for _ in range(k)], [0] * k
+    for i in order:
+        t = min(range(k), key=lambda t: sums[t])
+        teams[t].append(i)
+        sums[t] += scores[i]
+    return teams
+
+
+def p95(values):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * 0.95))]
+
+
+def run_case(n, k, trials, rng, with_positions):
+    rows = {"greedy": ([], []), "balance": ([], [])}
+    for _ in range(trials):
+        scores = [max(0, int(rng.gauss(1000, 150))) for _ in range(n)]
+        positions = [rng.choice(POSITION_ROLES) for _ in range(n)] if with_positions else None
+        for name, fn in (("greedy", lambda: greedy_teams(scores, k, rng)),
+                         ("balance", lambda: balance_teams(scores, k, True, positions))):
+            t0 = time.perf_counter()
+            teams = fn()
+            elapsed = (time.perf_counter() - t0) * 1000
+            dups, spread = team_cost(teams, scores, positions)
+            rows[name][0].append(spread)
+            rows[name][1].append(elapsed)
+    return rows
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--trials", type=int, default=200)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--positions", action="store_true", help="포지션 중복 회피 조건 포함")
+    args = ap.parse_args()
+    rng = random.Random(args.seed)
+
+    print(f"{'N':>4} {'k':>2}  {'method':<8} {'spread avg':>10} {'p95':>6} {'ms avg':>8} {'ms max':>8}")
+    for n, k in CASES:
+        rows = run_case(n, k, args.trials, rng, args.positions)
+        for name, (spreads, times) in rows.items():
+            print(f"{n:>4} {k:>2}  {name:<8} {statistics.mean(spreads):>10.1f} {p95(spreads):>6} "
+                  f"{statistics.mean(times):>8.2f} {max(times):>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
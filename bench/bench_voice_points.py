@@ -0,0 +1,266 @@
+"""
+보이스/포인트 핫패스 부하 테스트 (디스코드 연결 없이 가짜 길드/채널/멤버로 실행).
+
+    python bench/bench_voice_points.py [--guilds 2000] [--members 20000] [--events 50000]
+                                      [--json out.json] [--compare base.json]
+
+임시 디렉터리의 새 points DB 에 대해 아래를 측정:
+- events : on_voice_state_update 합성 이벤트 재생 처리량 + 길드별 파이프라인이 DB 반영을 끝낼 때까지 시간
+- accrual: accrual_loop 1회(accrual_tick) 시간
+- afk    : afk_guard 1회(afk_reconcile) 시간
+- grant  : grant_points_for_session 단건 처리량
+각 단계의 SQL 문장 수/DB 작업 수도 같이 기록. --json 으로 저장해 두고 --compare 로 커밋 간 비교.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+_tmp = tempfile.mkdtemp(prefix="bench_voice_")
+os.environ["POINTS_DB_PATH"] = os.path.join(_tmp, "points.db")
+os.environ.setdefault("TTS_CACHE_DIR", os.path.join(_tmp, "tts"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import mybot  # noqa: E402
+
+NOW = 1_700_000_000
+VOICE_CHANNELS_PER_GUILD = 4
+AFK_CHANNEL_OFFSET = 99  # 길드마다 채널 하나는 잠수방
+
+
+# ---------------- 가짜 디스코드 객체 ----------------
+class FakeVoiceState:
+    def __init__(self, channel=None, self_mute=False, self_deaf=False):
+        self.channel = channel
+        self.self_mute = self_mute
+        self.self_deaf = self_deaf
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild, channel_id, name):
+        self.guild = guild
+        self.id = channel_id
+        self.name = name
+        self.category = None
+        self.members = []
+
+
+class FakeMember:
+    def __init__(self, guild, user_id):
+        self.guild = guild
+        self.id = user_id
+        self.name = self.display_name = f"user{user_id}"
+        self.bot = False
+        self.voice = None
+
+    def __str__(self):
+        return self.name
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.voice_channels = [FakeVoiceChannel(self, guild_id * 1000 + i, f"vc{i}")
+                               for i in range(VOICE_CHANNELS_PER_GUILD)]
+        self.afk_channel = FakeVoiceChannel(self, guild_id * 1000 + AFK_CHANNEL_OFFSET, "afk")
+        self.voice_channels.append(self.afk_channel)
+        self._channels = {c.id: c for c in self.voice_channels}
+        self.members = {}
+        self.voice_client = None
+        self.categories = []
+
+    def get_member(self, user_id):
+        return self.members.get(user_id)
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+
+def build_world(n_guilds, n_members, rng):
+    guilds = [FakeGuild(g + 1) for g in range(n_guilds)]
+    for g in guilds:
+        mybot.guild_settings.afk[g.id] = g.afk_channel.id
+    members = []
+    for uid in range(1, n_members + 1):
+        guild = guilds[rng.randrange(n_guilds)]
+        member = FakeMember(guild, uid)
+        guild.members[uid] = member
+        members.append(member)
+    return guilds, members
+
+
+def move(member, channel, mute=False, deaf=False):
+    """멤버 상태를 바꾸고 (before, after) 반환 — discord.py 가 이벤트 전에 캐시를 갱신하는 것과 같은 순서."""
+    before = member.voice or FakeVoiceState()
+    if before.channel is not None:
+        before.channel.members.remove(member)
+    after = FakeVoiceState(channel, mute, deaf)
+    if channel is not None:
+        channel.members.append(member)
+    member.voice = after if channel is not None else None
+    return before, after
+
+
+def next_event(member, rng):
+    """입장/퇴장/이동/뮤트 토글/잠수방 중 하나 (실제 서버처럼 뮤트 토글과 이동이 대부분)."""
+    cur = member.voice.channel if member.voice else None
+    channels = member.guild.voice_channels
+    r = rng.random()
+    if cur is None:
+        return rng.choice(channels[:-1]), False, False
+    if r < 0.45:  # 뮤트/이어폰 토글
+        return cur, not member.voice.self_mute, rng.random() < 0.2
+    if r < 0.75:  # 일반 채널 간 이동
+        return rng.choice(channels[:-1]), False, False
+    if r < 0.85:  # 잠수방
+        return member.guild.afk_channel, True, True
+    return None, False, False  # 퇴장
+
+
+# ---------------- 측정 ----------------
+def fresh_db():
+    mybot.points_db.close()
+    path = os.path.join(_tmp, f"points_{time.monotonic_ns()}.db")
+    mybot.points_db = mybot.PointsDB(path, count_statements=True)
+    mybot.points_db.write_sync(mybot.init_points_db)
+    mybot.points_db.statements = 0
+    return mybot.points_db
+
+
+async def wait_pipeline():
+    while True:
+        tasks = [t for t in mybot.voice_pipeline._workers.values() if not t.done()]
+        if not tasks:
+            return
+        await asyncio.gather(*tasks)
+
+
+async def bench_events(guilds, members, n_events, rng):
+    db = fresh_db()
+    mybot.voice_pipeline = mybot.VoicePipeline(mybot.VOICE_COALESCE_SECONDS)
+    handler = mybot.on_voice_state_update
+    t0 = time.perf_counter()
+    for _ in range(n_events):
+        member = members[rng.randrange(len(members))]
+        before, after = move(member, *next_event(member, rng))
+        await handler(member, before, after)
+    dispatched = time.perf_counter() - t0
+    await wait_pipeline()
+    total = time.perf_counter() - t0
+    return {
+        "events": n_events,
+        "dispatch_s": round(dispatched, 3),
+        "events_per_s": round(n_events / dispatched),
+        "drain_s": round(total, 3),
+        "db_ops": mybot.voice_pipeline.db_ops,
+        "sql_statements": db.statements,
+    }
+
+
+async def bench_accrual(guilds, members, ticks):
+    db = fresh_db()
+    for m in members:  # 모두 보이스에 넣고 세션 시작
+        if not m.voice:
+            move(m, m.guild.voice_channels[0])
+    db.write_sync(lambda conn: conn.executemany(
+        "INSERT INTO users(guild_id, user_id, last_join) VALUES(?, ?, ?)",
+        [(m.guild.id, m.id, NOW) for m in members]))
+    db.statements = 0
+    times = []
+    for i in range(ticks):
+        t0 = time.perf_counter()
+        await mybot.accrual_tick(guilds, NOW + (i + 1) * 300)
+        times.append(time.perf_counter() - t0)
+    return {
+        "ticks": ticks,
+        "tick_ms_p50": round(statistics.median(times) * 1000, 1),
+        "tick_ms_max": round(max(times) * 1000, 1),
+        "sql_statements_per_tick": db.statements // ticks,
+    }
+
+
+def bench_afk(guilds, rounds):
+    times = []
+    for i in range(rounds):
+        t0 = time.perf_counter()
+        mybot.afk_reconcile(guilds, NOW + i)
+        times.append(time.perf_counter() - t0)
+    return {
+        "rounds": rounds,
+        "tick_ms_p50": round(statistics.median(times) * 1000, 1),
+        "tick_ms_max": round(max(times) * 1000, 1),
+        "tracked": len(mybot.afk_sched.tracked()),
+    }
+
+
+def bench_grant(n_calls, rng):
+    db = fresh_db()
+
+    def run(conn):
+        for i in range(n_calls):
+            mybot.grant_points_for_session(conn, rng.randrange(1, 100), rng.randrange(1, 5000), rng.randrange(0, 4000))
+
+    t0 = time.perf_counter()
+    db.write_sync(run)
+    elapsed = time.perf_counter() - t0
+    return {
+        "calls": n_calls,
+        "calls_per_s": round(n_calls / elapsed),
+        "sql_statements_per_call": round(db.statements / n_calls, 2),
+    }
+
+
+async def run_all(args):
+    rng = random.Random(args.seed)
+    guilds, members = build_world(args.guilds, args.members, rng)
+    results = {"params": vars(args).copy()}
+    results["params"].pop("json", None)
+    results["params"].pop("compare", None)
+    results["events"] = await bench_events(guilds, members, args.events, rng)
+    results["accrual"] = await bench_accrual(guilds, members, args.ticks)
+    results["afk"] = bench_afk(guilds, args.ticks)
+    results["grant"] = bench_grant(args.grant_calls, rng)
+    return results
+
+
+def print_results(results, base=None):
+    for section, values in results.items():
+        if section == "params":
+            continue
+        print(f"[{section}]")
+        for key, value in values.items():
+            line = f"  {key:<26} {value}"
+            old = (base or {}).get(section, {}).get(key)
+            if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+                line += f"   (기준 {old}, {(value - old) / old:+.1%})"
+            print(line)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--guilds", type=int, default=2000)
+    ap.add_argument("--members", type=int, default=20000)
+    ap.add_argument("--events", type=int, default=50000)
+    ap.add_argument("--ticks", type=int, default=5)
+    ap.add_argument("--grant-calls", type=int, default=20000)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--json", help="결과를 JSON 파일로 저장")
+    ap.add_argument("--compare", help="이전 결과 JSON 과 비교 출력")
+    args = ap.parse_args()
+
+    results = asyncio.run(run_all(args))
+    base = json.loads(Path(args.compare).read_text(encoding="utf-8")) if args.compare else None
+    print_results(results, base)
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+    mybot.points_db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+"""
+샤드 런처: 샤드를 여러 프로세스(코어)에 나눠 mybot.py 를 실행하고, 죽은 프로세스는 다시 띄움.
+
+    python launcher.py [--shards N] [--procs P]
+
+- 샤드 수: --shards > SHARD_COUNT 환경변수 > 디스코드 권장값(/gateway/bot)
+- 프로세스 수: --procs > SHARD_PROCESSES 환경변수 > CPU 코어 수 (샤드 수보다 많지 않게)
+- 프로세스마다 SHARD_COUNT/SHARD_IDS 를 넘기고, METRICS_PORT 는 프로세스 번호만큼 더하고,
+  TTS 캐시는 프로세스별 하위 폴더를 씀 (index.json 을 서로 덮어쓰지 않게)
+- points DB 는 같은 파일을 공유 (WAL + BEGIN IMMEDIATE, 길드는 한 샤드에만 속하므로 유저 행 쓰기가 겹치지 않음)
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+from pathlib import Path
+
+BOT_SCRIPT = Path(__file__).resolve().parent / "mybot.py"
+IDENTIFY_INTERVAL = 5.5  # 디스코드 IDENTIFY 제한(5초에 1번) — 프로세스끼리 겹치지 않게 샤드 수만큼 띄엄띄엄 기동
+RESTART_DELAY = 10
+
+
+def recommended_shards(token: str) -> int:
+    req = urllib.request.Request("https://discord.com/api/v10/gateway/bot",
+                                 headers={"Authorization": f"Bot {token}", "User-Agent": "DiscordBot launcher"})
+    with urllib.request.urlopen(req, timeout=10) as resp:
+        return int(json.load(resp)["shards"])
+
+
+def split_shards(shard_count: int, procs: int) -> list[list[int]]:
+    """샤드 0..N-1 을 프로세스 P 개에 연속 구간으로 고르게 나눔."""
+    procs = max(1, min(procs, shard_count))
+    base, extra = divmod(shard_count, procs)
+    out, start = [], 0
+    for i in range(procs):
+        size = base + (1 if i < extra else 0)
+        out.append(list(range(start, start + size)))
+        start += size
+    return out
+
+
+def spawn(index: int, shard_count: int, shard_ids: list[int]) -> subprocess.Popen:
+    env = dict(os.environ, SHARD_COUNT=str(shard_count), SHARD_IDS=",".join(map(str, shard_ids)))
+    if os.getenv("METRICS_PORT"):
+        env["METRICS_PORT"] = str(int(os.environ["METRICS_PORT"]) + index)
+    env["TTS_CACHE_DIR"] = os.path.join(os.getenv("TTS_CACHE_DIR", "/tmp/tts_cache"), f"proc{index}")
+    print(f"[launcher] 프로세스 {index}: 샤드 {shard_ids[0]}~{shard_ids[-1]} / {shard_count}")
+    # 별도 세션: 터미널 Ctrl+C 가 자식에게 직접 가지 않고 런처가 한 번만 전달 (종료 처리 중 두 번째 인터럽트 방지)
+    return subprocess.Popen([sys.executable, str(BOT_SCRIPT)], env=env, start_new_session=True)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--shards", type=int, default=int(os.getenv("SHARD_COUNT", "0")))
+    ap.add_argument("--procs", type=int, default=int(os.getenv("SHARD_PROCESSES", "0")) or os.cpu_count() or 1)
+    args = ap.parse_args()
+
+    shard_count = args.shards
+    if not shard_count:
+        token = os.getenv("DISCORD_TOKEN")
+        if not token:
+            print("환경변수 DISCORD_TOKEN이 비어있습니다. 토큰을 설정하거나 --shards 를 지정하세요.")
+            return
+        shard_count = recommended_shards(token)
+    groups = split_shards(shard_count, args.procs)
+
+    procs: dict[int, subprocess.Popen] = {}
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+        for p in procs.values():
+            # SIGINT = Ctrl+C 와 같은 경로로 종료해야 mybot.main() 의 종료 처리(정산/기록 flush)가 실행됨
+            p.send_signal(signal.SIGINT)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for i, ids in enumerate(groups):
+        if stopping:
+            break
+        procs[i] = spawn(i, shard_count, ids)
+        time.sleep(IDENTIFY_INTERVAL * len(ids))
+
+    while procs and not stopping:
+        time.sleep(1)
+        for i, p in list(procs.items()):
+            code = p.poll()
+            if code is None or stopping:
+                continue
+            print(f"[launcher] 프로세스 {i} 종료 (코드 {code}), {RESTART_DELAY}초 후 재시작")
+            time.sleep(RESTART_DELAY)
+            procs[i] = spawn(i, shard_count, groups[i])
+
+    for p in procs.values():
+        try:
+            p.wait(timeout=30)  # 봇 쪽 종료 처리(보이스 정산/활동 기록 flush) 기다림
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+if __name__ == "__main__":
+    main()
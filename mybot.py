@@ -10,17 +10,27 @@ import datetime as dt
 import hashlib
 import edge_tts
 import re
-
-
-from contextlib import closing
-from typing import Optional
+import json
+import time
+import threading
+import signal
+import queue
+import heapq
+import unicodedata
+import bisect
+import functools
+
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Literal
 from pathlib import Path
 from discord import app_commands
 from discord.ext import commands, tasks
 from discord.ui import Button, View
-from openai import OpenAI
-from fastapi import FastAPI, Request
-from collections import defaultdict
+from discord.oggparse import OggStream
+from openai import AsyncOpenAI
+from fastapi import FastAPI, Request, Response
+from collections import defaultdict, OrderedDict, deque
 
 
 # ======================== 기본 설정 ========================
@@ -30,16 +40,43 @@ intents.guilds = True
 intents.message_content = True
 intents.voice_states = True
 
-bot = commands.Bot(command_prefix="$", intents=intents, help_command=None)
+# 샤딩: SHARD_COUNT 가 있으면 AutoShardedBot, SHARD_IDS 는 이 프로세스가 맡을 샤드 (launcher.py 가 나눠서 설정)
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+SHARD_IDS = [int(x) for x in os.getenv("SHARD_IDS", "").split(",") if x.strip()] or None
+if SHARD_IDS and not SHARD_COUNT:
+    raise SystemExit("SHARD_IDS 는 SHARD_COUNT 와 같이 설정해야 합니다.")
+# 길드 전체에 걸친 작업(슬래시 동기화, scores 이전, 장부 압축)은 0번 샤드를 가진 프로세스만 실행
+PRIMARY_SHARD = SHARD_IDS is None or 0 in SHARD_IDS
+
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(command_prefix="$", intents=intents, help_command=None,
+                                  shard_count=SHARD_COUNT, shard_ids=SHARD_IDS)
+else:
+    bot = commands.Bot(command_prefix="$", intents=intents, help_command=None)
+
+def local_guilds() -> list:
+    """
+    이 프로세스가 맡은 길드 중 샤드 연결이 살아 있는 것만.
+    끊긴 샤드의 보이스 상태는 낡았으므로 정산/AFK 판정을 미룸 (last_join 이 남아 있어 재연결 후 이어서 정산).
+    """
+    if not SHARD_COUNT:
+        return list(bot.guilds)
+    live = {sid for sid, shard in bot.shards.items() if not shard.is_closed()}
+    return [g for g in bot.guilds if g.shard_id in live]
 
-# 기존 랭킹(점수) 시스템 DB (그대로 유지)
+# 기존 랭킹(점수) 시스템 DB — points DB 로 이전됨, 이전이 끝날 때까지 읽기 호환용
 DB_PATH = "scores.db"
 
-TTS_CACHE_DIR = Path("/tmp/tts_cache")
-TTS_CACHE_DIR.mkdir(exist_ok=True)
+TTS_CACHE_DIR = Path(os.getenv("TTS_CACHE_DIR", "/tmp/tts_cache"))
+TTS_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+TTS_CACHE_MAX_MB = int(os.getenv("TTS_CACHE_MAX_MB", "200"))
+TTS_CACHE_MAX_ENTRIES = int(os.getenv("TTS_CACHE_MAX_ENTRIES", "2000"))
+TTS_VOICE = "ko-KR-SunHiNeural"
+TTS_OPUS_MEMORY_ENTRIES = 64  # 메모리에 패킷째 올려둘 자주 쓰는 문장 수
 
-# 길드별 보이스 작업 락(동시 요청 충돌 방지)
-voice_locks = defaultdict(asyncio.Lock)
+# TTS 재생 정책: enqueue(앞 사람 말 끝나고 순서대로) / interrupt(새 요청이 끊고 바로 재생)
+TTS_QUEUE_POLICY = os.getenv("TTS_QUEUE_POLICY", "enqueue")
+TTS_QUEUE_MAX = int(os.getenv("TTS_QUEUE_MAX", "20"))
 
 
 # *** 중요: 토큰/키는 환경변수 사용 (반드시 재발급 후 세팅!) ***
@@ -47,7 +84,16 @@ MY_DISCORD_TOKEN_KEY = os.getenv("DISCORD_TOKEN")
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY", "sk-REPLACE_ME"))
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY", "sk-REPLACE_ME"))
+
+QA_MODEL = "gpt-3.5-turbo"
+QA_MAX_CONCURRENCY = int(os.getenv("QA_MAX_CONCURRENCY", "4"))  # 전체 동시 질문 수
+QA_PER_GUILD = int(os.getenv("QA_PER_GUILD", "2"))              # 길드별 동시 질문 수
+QA_QUEUE_TIMEOUT = int(os.getenv("QA_QUEUE_TIMEOUT", "60"))     # 대기열에서 기다리는 최대 시간(초)
+QA_TIMEOUT = int(os.getenv("QA_TIMEOUT", "60"))                 # 답변 생성 최대 시간(초)
+QA_EDIT_INTERVAL = 1.0                                          # 스트리밍 중 메시지 수정 간격(초)
+QA_CACHE_TTL = int(os.getenv("QA_CACHE_TTL", str(7 * 24 * 3600)))  # 답변 캐시 유효기간(초)
+QA_CACHE_MAX = int(os.getenv("QA_CACHE_MAX", "5000"))              # 답변 캐시 최대 개수
 
 TRIGGER_CHANNEL_NAMES = ["칼바람 방 생성", "솔랭 방 생성", "방 생성"]
 
@@ -55,7 +101,7 @@ TEAM_TRIGGER_NAME = "팀 생성"
 
 TEAM_PARENT_CATEGORIES = {"칼바내전", "협곡내전"}
 
-temp_channels = {}
+temp_channels: set[int] = set()   # 봇이 만든 임시 보이스 채널ID
 games = {}
 
 POSITION_ROLES = ["탑", "정글", "미드", "원딜", "서폿"]
@@ -70,6 +116,120 @@ category_group: dict[int, int] = {}       # 카테고리ID -> group_key (중복
 
 print(wavelink.__version__)
 
+# ================ 메트릭 (Prometheus 텍스트 형식) ================
+# METRICS_PORT 를 설정하면 봇과 같은 프로세스에서 /metrics HTTP 서버를 띄움 (미설정 시 수집만 하고 노출 안 함)
+METRICS_PORT = os.getenv("METRICS_PORT")
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+LOOP_LAG_INTERVAL = 0.5  # 이벤트 루프 지연 측정 주기(초)
+
+class Metrics:
+    """
+    카운터/히스토그램/콜백 게이지만 있는 작은 레지스트리 (외부 의존성 없음).
+    DB 스레드와 HTTP 서버 스레드에서도 쓰므로 갱신은 락 안에서.
+    """
+
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta: dict[str, tuple[str, str]] = {}                 # 이름 -> (type, help)
+        self._counters: dict[tuple[str, tuple], float] = defaultdict(float)
+        self._hists: dict[tuple[str, tuple], list] = {}             # -> [버킷별 개수..., 합, 개수]
+        self._callbacks: dict[str, object] = {}                     # 이름 -> fn() -> 값 또는 {라벨튜플: 값}
+
+    def describe(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._hists.get(key)
+            if h is None:
+                h = self._hists[key] = [0] * len(self.BUCKETS) + [0.0, 0]
+            i = bisect.bisect_left(self.BUCKETS, seconds)
+            if i < len(self.BUCKETS):
+                h[i] += 1
+            h[-2] += seconds
+            h[-1] += 1
+
+    def callback(self, name: str, kind: str, help_text: str, fn):
+        """스크레이프할 때 fn() 으로 값을 읽는 메트릭 (큐 길이, 캐시 통계 등)."""
+        self.describe(name, kind, help_text)
+        self._callbacks[name] = fn
+
+    def timed(self, name: str, **labels):
+        """async 함수 실행 시간을 히스토그램으로 (예외도 기록, status 라벨)."""
+        def deco(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                t0 = time.perf_counter()
+                status = "ok"
+                try:
+                    return await fn(*args, **kwargs)
+                except BaseException:
+                    status = "error"
+                    raise
+                finally:
+                    self.observe(name, time.perf_counter() - t0, status=status, **labels)
+            return wrapper
+        return deco
+
+    @staticmethod
+    def _labels(pairs) -> str:
+        if not pairs:
+            return ""
+        body = ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+                        for k, v in pairs)
+        return "{" + body + "}"
+
+    def render(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            hists = {k: list(v) for k, v in self._hists.items()}
+        out: dict[str, list[str]] = defaultdict(list)
+        for (name, labels), value in counters.items():
+            out[name].append(f"{name}{self._labels(labels)} {value:g}")
+        for (name, labels), h in hists.items():
+            acc = 0
+            for bound, n in zip(self.BUCKETS, h):
+                acc += n
+                out[name].append(f"{name}_bucket{self._labels(labels + (('le', f'{bound:g}'),))} {acc}")
+            out[name].append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {h[-1]}")
+            out[name].append(f"{name}_sum{self._labels(labels)} {h[-2]:.6f}")
+            out[name].append(f"{name}_count{self._labels(labels)} {h[-1]}")
+        for name, fn in self._callbacks.items():
+            try:
+                value = fn()
+            except Exception as e:  # 다른 스레드에서 읽으므로 드물게 실패할 수 있음, 이번 스크레이프만 건너뜀
+                print("메트릭 수집 실패:", name, e)
+                continue
+            items = value.items() if isinstance(value, dict) else [((), value)]
+            for labels, v in items:
+                out[name].append(f"{name}{self._labels(labels)} {v:g}")
+        lines = []
+        for name in sorted(out):
+            kind, help_text = self._meta.get(name, ("untyped", ""))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(out[name])
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("bot_event_loop_lag_seconds", "histogram", "asyncio 이벤트 루프 지연")
+metrics.describe("bot_command_seconds", "histogram", "프리픽스/슬래시 명령 처리 시간")
+metrics.describe("bot_event_seconds", "histogram", "디스코드 이벤트 핸들러 처리 시간")
+metrics.describe("bot_sqlite_seconds", "histogram", "points DB 작업(트랜잭션) 실행 시간")
+metrics.describe("bot_sqlite_wait_seconds", "histogram", "points DB 작업이 스레드 큐에서 기다린 시간")
+metrics.describe("bot_sqlite_ops_total", "counter", "points DB 작업 수")
+metrics.describe("bot_loop_tick_seconds", "histogram", "주기 루프 1회 실행 시간")
+metrics.describe("bot_openai_seconds", "histogram", "OpenAI 요청 시간 (phase=first_token|total)")
+metrics.describe("bot_lavalink_seconds", "histogram", "Lavalink 요청 시간")
+
 # ================= 포인트/상점/AFK (신규) =================
 # 새 파일명으로 사용하여 기존 points.db와 충돌 방지
 POINTS_DB_PATH  = os.getenv("POINTS_DB_PATH", "points_v2.db")
@@ -77,19 +237,108 @@ POINTS_PER_BLOCK = 5
 BLOCK_SECONDS    = 30 * 60  # 30분
 AFK_SECONDS      = 60 * 60  # 60분
 MUTE_GRACE_SECONDS = 60 * 60  # 뮤트/이어폰 2분 지속 시에만 AFK 이동
-
-# 뮤트/이어폰 시작 시각 캐시(메모리)
-mute_since = {}  # key: (guild_id, user_id) -> unix ts
+ACTIVITY_FLUSH_SECONDS = int(os.getenv("ACTIVITY_FLUSH_SECONDS", "5"))  # last_active 모아쓰기 주기
+AFK_RECONCILE_MINUTES = 10  # AFK 스케줄러 안전망(전체 재점검) 주기
+AFK_RETRY_SECONDS = 60  # AFK 이동 실패(채널 미설정/권한 없음) 시 재시도 간격, 실패할 때마다 2배
+AFK_RETRY_MAX_SECONDS = 30 * 60
 
 
-def get_db():
-    conn = sqlite3.connect(POINTS_DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+class PointsDB:
+    """
+    포인트 DB 전용 커넥션 레이어 (장수 커넥션 + 전용 스레드).
+    - 쓰기: writer 스레드 1개에서 직렬 실행, fn 하나가 트랜잭션 하나
+    - 읽기: reader 스레드 커넥션 (WAL 모드라 쓰기와 동시에 읽기 가능)
+    - immediate=True: 여러 프로세스(샤드)가 같은 파일에 쓸 때 트랜잭션을 BEGIN IMMEDIATE 로 시작
+      (읽기 후 쓰기 승격 중 SQLITE_BUSY 교착 대신 busy_timeout 안에서 순서대로 대기)
+    핸들러는 `await points_db.write(fn, ...)` / `await points_db.read(fn, ...)` 로 사용.
+    fn(db, *args) 는 DB 스레드에서 실행되므로 안에서 디스코드 API를 부르면 안 됨.
+    """
 
-def init_points_db():
-    with closing(get_db()) as db, db:
-        db.executescript("""
+    def __init__(self, path: str, count_statements: bool = False, immediate: bool = False):
+        self.path = path
+        self.immediate = immediate
+        self.count_statements = count_statements  # 벤치마크용: 실행된 SQL 문장 수 집계
+        self.statements = 0
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="points-db-writer")
+        self._reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="points-db-reader")
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        # cached_statements: 파라미터 쿼리는 sqlite3 모듈이 prepared statement로 재사용
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=10000")
+        if self.count_statements:
+            conn.set_trace_callback(self._count_statement)
+        return conn
+
+    def _count_statement(self, _sql):
+        self.statements += 1  # 스레드 2개에서 증가하지만 벤치 집계용이라 근사치로 충분
+
+    def _conn(self) -> sqlite3.Connection:
+        # 각 executor는 스레드가 1개라 스레드 로컬 = 실행기별 커넥션
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    @staticmethod
+    def _timed(kind: str, fn, queued: float, run):
+        start = time.perf_counter()
+        status = "ok"
+        try:
+            return run()
+        except BaseException:
+            status = "error"
+            raise
+        finally:
+            name = getattr(fn, "__name__", "fn")
+            metrics.observe("bot_sqlite_wait_seconds", start - queued, kind=kind)
+            metrics.observe("bot_sqlite_seconds", time.perf_counter() - start, kind=kind, fn=name)
+            metrics.inc("bot_sqlite_ops_total", kind=kind, fn=name, status=status)
+
+    def _run_write(self, fn, args, queued):
+        def run():
+            db = self._conn()
+            with db:
+                if self.immediate:
+                    db.execute("BEGIN IMMEDIATE")
+                return fn(db, *args)
+        return self._timed("write", fn, queued, run)
+
+    def _run_read(self, fn, args, queued):
+        return self._timed("read", fn, queued, lambda: fn(self._conn(), *args))
+
+    async def write(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._run_write, fn, args, time.perf_counter())
+
+    async def read(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._reader, self._run_read, fn, args, time.perf_counter())
+
+    def write_sync(self, fn, *args):
+        """이벤트 루프 밖(시작/종료 시점)에서 쓰기용."""
+        return self._writer.submit(self._run_write, fn, args, time.perf_counter()).result()
+
+    def close(self):
+        for ex in (self._writer, self._reader):
+            ex.submit(self._close_local).result()
+            ex.shutdown(wait=True)
+
+    def _close_local(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+points_db = PointsDB(POINTS_DB_PATH, immediate=SHARD_IDS is not None)
+
+def init_points_db(db):
+    db.executescript("""
         CREATE TABLE IF NOT EXISTS users (
             guild_id   INTEGER NOT NULL,
             user_id    INTEGER NOT NULL,
@@ -123,17 +372,80 @@ def init_points_db():
             last_active INTEGER NOT NULL,
             PRIMARY KEY (guild_id, user_id)
         );
+        CREATE TABLE IF NOT EXISTS qa_cache (
+            key        TEXT PRIMARY KEY,
+            model      TEXT NOT NULL,
+            question   TEXT NOT NULL,
+            answer     TEXT NOT NULL,
+            created_at INTEGER NOT NULL,
+            last_hit   INTEGER NOT NULL,
+            hits       INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS idx_qa_cache_last_hit ON qa_cache(last_hit);
+        CREATE INDEX IF NOT EXISTS idx_users_guild_points ON users(guild_id, points DESC);
+        CREATE TABLE IF NOT EXISTS scores (
+            id       INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            user_id  INTEGER NOT NULL,
+            username TEXT NOT NULL,
+            score    INTEGER NOT NULL DEFAULT 1000
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_scores_guild_user ON scores(guild_id, user_id);
+        CREATE INDEX IF NOT EXISTS idx_scores_guild_score ON scores(guild_id, score DESC);
+        CREATE TABLE IF NOT EXISTS match_logs (
+            id         INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id   INTEGER NOT NULL,
+            timestamp  TEXT NOT NULL,
+            winner_ids TEXT,
+            loser_ids  TEXT,
+            note       TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_match_logs_guild ON match_logs(guild_id, id DESC);
+        CREATE TABLE IF NOT EXISTS managed_channels (
+            channel_id  INTEGER PRIMARY KEY,
+            guild_id    INTEGER NOT NULL,
+            kind        TEXT NOT NULL,
+            group_key   INTEGER,
+            category_id INTEGER,
+            created_at  INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS points_ledger (
+            id       INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id INTEGER NOT NULL,
+            user_id  INTEGER NOT NULL,
+            delta    INTEGER NOT NULL,
+            balance  INTEGER NOT NULL,
+            reason   TEXT NOT NULL,
+            actor_id INTEGER,
+            ts       INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_points_ledger_user ON points_ledger(guild_id, user_id, id);
+        CREATE INDEX IF NOT EXISTS idx_points_ledger_ts ON points_ledger(ts);
+        CREATE TABLE IF NOT EXISTS ledger_base (
+            guild_id INTEGER NOT NULL,
+            user_id  INTEGER NOT NULL,
+            points   INTEGER NOT NULL,
+            upto_id  INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key   TEXT PRIMARY KEY,
+            value TEXT
+        );
         """)
 
+def get_meta(db, key: str) -> Optional[str]:
+    row = db.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+    return row["value"] if row else None
+
+def set_meta(db, key: str, value: str):
+    db.execute("INSERT OR REPLACE INTO meta(key, value) VALUES(?, ?)", (key, value))
+
 def ensure_user(db, guild_id: int, user_id: int):
     db.execute("INSERT OR IGNORE INTO users(guild_id, user_id) VALUES (?,?)", (guild_id, user_id))
     db.execute("INSERT OR IGNORE INTO afk_watch(guild_id, user_id, last_active) VALUES(?,?,?)",
                (guild_id, user_id, int(dt.datetime.utcnow().timestamp())))
 
-def get_afk_channel_id(db, guild_id: int) -> Optional[int]:
-    row = db.execute("SELECT afk_channel_id FROM guild_settings WHERE guild_id=?", (guild_id,)).fetchone()
-    return row["afk_channel_id"] if row and row["afk_channel_id"] else None
-
 def set_afk_channel_id(db, guild_id: int, channel_id: Optional[int]):
     db.execute(
         "INSERT INTO guild_settings(guild_id, afk_channel_id) VALUES(?, ?) "
@@ -141,10 +453,153 @@ def set_afk_channel_id(db, guild_id: int, channel_id: Optional[int]):
         (guild_id, channel_id)
     )
 
-def mark_active(db, guild_id: int, user_id: int, now: Optional[int] = None):
+class ActivityBuffer:
+    """
+    last_active 쓰기 지연(write-behind) 버퍼.
+    활동은 메모리 맵만 갱신하고, activity_flush_loop 가 몇 초마다 바뀐 것만 한 트랜잭션으로 기록.
+    이벤트 루프 스레드에서만 만질 것 (DB 스레드에는 drain() 결과만 넘김).
+    """
+
+    def __init__(self):
+        self.last_active: dict[tuple[int, int], int] = {}
+        self._dirty: set[tuple[int, int]] = set()
+
+    def touch(self, guild_id: int, user_id: int, now: int):
+        key = (guild_id, user_id)
+        if self.last_active.get(key) != now:
+            self.last_active[key] = now
+            self._dirty.add(key)
+
+    def get(self, guild_id: int, user_id: int, now: int) -> int:
+        """처음 보는 유저는 지금을 기준으로 기록 (기존 ensure_user 동작과 동일)."""
+        key = (guild_id, user_id)
+        if key not in self.last_active:
+            self.touch(guild_id, user_id, now)
+        return self.last_active[key]
+
+    def load(self, rows):
+        # 시작 시 afk_watch 전체 적재. 이미 메모리에 더 최신 값이 있으면 유지
+        for r in rows:
+            key = (r["guild_id"], r["user_id"])
+            if r["last_active"] > self.last_active.get(key, 0):
+                self.last_active[key] = r["last_active"]
+
+    def drain(self) -> list[tuple[int, int, int]]:
+        rows = [(g, u, self.last_active[(g, u)]) for g, u in self._dirty]
+        self._dirty.clear()
+        return rows
+
+
+activity = ActivityBuffer()
+
+def mark_active(guild_id: int, user_id: int, now: Optional[int] = None):
     now = now or int(dt.datetime.utcnow().timestamp())
-    db.execute("INSERT OR REPLACE INTO afk_watch(guild_id, user_id, last_active) VALUES(?,?,?)",
-               (guild_id, user_id, now))
+    activity.touch(guild_id, user_id, now)
+
+def flush_activity_rows(db, rows: list[tuple[int, int, int]]):
+    db.executemany("INSERT OR IGNORE INTO users(guild_id, user_id) VALUES (?,?)",
+                   [(g, u) for g, u, _ in rows])
+    db.executemany("INSERT OR REPLACE INTO afk_watch(guild_id, user_id, last_active) VALUES(?,?,?)", rows)
+
+def load_all_last_active(db):
+    return db.execute("SELECT guild_id, user_id, last_active FROM afk_watch").fetchall()
+
+@tasks.loop(seconds=ACTIVITY_FLUSH_SECONDS)
+@metrics.timed("bot_loop_tick_seconds", loop="activity_flush")
+async def activity_flush_loop():
+    rows = activity.drain()
+    if rows:
+        await points_db.write(flush_activity_rows, rows)
+
+# ---- 포인트 장부 (ledger) ----
+# 모든 포인트 변동은 points_ledger 에 (변동량, 변동 후 잔액, 사유, 실행자) 로 추가만 함.
+# users.points 는 장부를 누적한 결과(물리화된 뷰)로, 같은 트랜잭션에서 증분 갱신되므로 잔액 조회는 PK 1건.
+# 오래된 장부는 ledger_base(유저별 스냅샷)에 합쳐서 지움: users.points == base.points + SUM(base 이후 delta)
+LEDGER_RETENTION_DAYS = int(os.getenv("LEDGER_RETENTION_DAYS", "30"))  # 이보다 오래된 장부는 스냅샷으로 압축
+LEDGER_COMPACT_HOURS = 6
+
+def ledger_append(db, rows):
+    """rows: [(guild_id, user_id, delta, balance, reason, actor_id, ts)] — 한 번에 executemany"""
+    db.executemany("INSERT INTO points_ledger(guild_id, user_id, delta, balance, reason, actor_id, ts) "
+                   "VALUES(?, ?, ?, ?, ?, ?, ?)", rows)
+
+def change_points(db, guild_id: int, user_id: int, reason: str, actor_id: Optional[int] = None,
+                  delta: int = 0, set_to: Optional[int] = None, floor: Optional[int] = None) -> int:
+    """잔액 변경 + 장부 기록 (관리자/구매 등 단건 경로). set_to 가 있으면 그 값으로, floor 는 하한. return: 새 잔액"""
+    ensure_user(db, guild_id, user_id)
+    old = get_user_points(db, guild_id, user_id)
+    new = set_to if set_to is not None else old + delta
+    if floor is not None:
+        new = max(new, floor)
+    if new != old:
+        db.execute("UPDATE users SET points=? WHERE guild_id=? AND user_id=?", (new, guild_id, user_id))
+        ledger_append(db, [(guild_id, user_id, new - old, new, reason, actor_id, int(time.time()))])
+    return new
+
+def seed_ledger_base(db):
+    """장부 도입 전 잔액을 스냅샷으로 한 번 옮김 (이후 불변식 유지)."""
+    if get_meta(db, "ledger_seeded"):
+        return
+    db.execute("INSERT OR IGNORE INTO ledger_base(guild_id, user_id, points, upto_id) "
+               "SELECT guild_id, user_id, points, 0 FROM users WHERE points != 0")
+    set_meta(db, "ledger_seeded", str(int(time.time())))
+
+def compact_ledger(db, before_ts: int) -> int:
+    """before_ts 이전 장부를 ledger_base 에 합치고 삭제. return: 지운 행 수"""
+    row = db.execute("SELECT MAX(id) AS cut FROM points_ledger WHERE ts < ?", (before_ts,)).fetchone()
+    cut = row["cut"]
+    if cut is None:
+        return 0
+    db.execute("""
+        INSERT INTO ledger_base(guild_id, user_id, points, upto_id)
+        SELECT guild_id, user_id, SUM(delta), MAX(id) FROM points_ledger WHERE id <= ? GROUP BY guild_id, user_id
+        ON CONFLICT(guild_id, user_id) DO UPDATE SET
+            points  = points + excluded.points,
+            upto_id = excluded.upto_id
+    """, (cut,))
+    return db.execute("DELETE FROM points_ledger WHERE id <= ?", (cut,)).rowcount
+
+def ledger_balance(db, guild_id: int, user_id: int) -> int:
+    """장부만으로 다시 계산한 잔액 (감사용, users.points 와 같아야 함)."""
+    base = db.execute("SELECT points, upto_id FROM ledger_base WHERE guild_id=? AND user_id=?",
+                      (guild_id, user_id)).fetchone()
+    points, upto = (base["points"], base["upto_id"]) if base else (0, 0)
+    row = db.execute("SELECT COALESCE(SUM(delta), 0) AS s FROM points_ledger WHERE guild_id=? AND user_id=? AND id > ?",
+                     (guild_id, user_id, upto)).fetchone()
+    return points + row["s"]
+
+def ledger_history(db, guild_id: int, user_id: int, limit: int):
+    return db.execute("SELECT id, delta, balance, reason, actor_id, ts FROM points_ledger "
+                      "WHERE guild_id=? AND user_id=? ORDER BY id DESC LIMIT ?",
+                      (guild_id, user_id, limit)).fetchall()
+
+class BalanceCache:
+    """잔액 메모리 캐시: 조회는 dict 한 번, 변경은 on_points_changed 로 들어온 새 잔액으로 덮어씀."""
+
+    def __init__(self):
+        self._points: dict[tuple[int, int], int] = {}
+
+    async def get(self, guild_id: int, user_id: int) -> int:
+        key = (guild_id, user_id)
+        if key not in self._points:
+            points = await points_db.read(get_user_points, guild_id, user_id)
+            # 읽는 동안 update() 로 들어온 값이 더 새 것이므로 덮어쓰지 않음
+            self._points.setdefault(key, points)
+        return self._points[key]
+
+    def update(self, guild_id: int, changes):
+        for uid, total in changes:
+            self._points[(guild_id, uid)] = total
+
+
+balances = BalanceCache()
+
+@tasks.loop(hours=LEDGER_COMPACT_HOURS)
+async def ledger_compact_loop():
+    cutoff = int(time.time()) - LEDGER_RETENTION_DAYS * 86400
+    removed = await points_db.write(compact_ledger, cutoff)
+    if removed:
+        print(f"포인트 장부 압축: {removed}건 → 스냅샷")
 
 def grant_points_for_session(db, guild_id: int, user_id: int, extra_sec: int) -> tuple[int, int]:
     """
@@ -174,28 +629,279 @@ def grant_points_for_session(db, guild_id: int, user_id: int, extra_sec: int) ->
     # 총 포인트 조회
     row = db.execute("SELECT points FROM users WHERE guild_id=? AND user_id=?", (guild_id, user_id)).fetchone()
     new_total = row["points"] if row else 0
+    if awarded:
+        ledger_append(db, [(guild_id, user_id, awarded, new_total, "voice", None, int(time.time()))])
     return awarded, new_total
 
+def set_log_channel_id(db, guild_id: int, channel_id: Optional[int]):
+    db.execute(
+        "INSERT INTO guild_settings(guild_id, log_channel_id) VALUES(?, ?) "
+        "ON CONFLICT(guild_id) DO UPDATE SET log_channel_id=excluded.log_channel_id",
+        (guild_id, channel_id)
+    )
+
+def load_guild_settings(db):
+    return db.execute("SELECT guild_id, afk_channel_id, log_channel_id FROM guild_settings").fetchall()
+
+class GuildSettingsCache:
+    """
+    guild_settings 메모리 캐시. 시작 시 전체 적재하고, 설정 변경은 메모리와 DB에 같이 반영(write-through).
+    보이스 이벤트/루프/로그 같은 핫 경로는 설정 때문에 SQLite를 읽지 않음.
+    """
+
+    def __init__(self):
+        self.afk: dict[int, int] = {}  # guild_id -> afk_channel_id
+        self.log: dict[int, int] = {}  # guild_id -> log_channel_id
+
+    def load(self, rows):
+        for r in rows:
+            self._put(self.afk, r["guild_id"], r["afk_channel_id"])
+            self._put(self.log, r["guild_id"], r["log_channel_id"])
+
+    async def set_afk(self, guild_id: int, channel_id: Optional[int]):
+        self._put(self.afk, guild_id, channel_id)
+        await points_db.write(set_afk_channel_id, guild_id, channel_id)
+
+    async def set_log(self, guild_id: int, channel_id: Optional[int]):
+        self._put(self.log, guild_id, channel_id)
+        await points_db.write(set_log_channel_id, guild_id, channel_id)
+
+    @staticmethod
+    def _put(d: dict[int, int], guild_id: int, channel_id: Optional[int]):
+        if channel_id:
+            d[guild_id] = channel_id
+        else:
+            d.pop(guild_id, None)
+
+
+guild_settings = GuildSettingsCache()
+
+def get_afk_channel_id(guild_id: int) -> Optional[int]:
+    return guild_settings.afk.get(guild_id)
+
+def get_user_points(db, guild_id: int, user_id: int) -> int:
+    row = db.execute("SELECT points FROM users WHERE guild_id=? AND user_id=?", (guild_id, user_id)).fetchone()
+    return row["points"] if row else 0
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+def award_line(name: str, awarded: int, new_total: int) -> str:
+    minutes = (awarded // POINTS_PER_BLOCK) * (BLOCK_SECONDS // 60)
+    return f"{name} 님이 **{minutes}분 활동**으로 **{awarded}p** 획득! (총 {new_total}p)"
+
+def split_message(lines: list[str], limit: int = DISCORD_MESSAGE_LIMIT) -> list[str]:
+    """줄 단위로 묶어서 디스코드 메시지 길이 제한 안쪽으로 나누기."""
+    chunks, cur, size = [], [], 0
+    for line in lines:
+        line = line[:limit]
+        if cur and size + 1 + len(line) > limit:
+            chunks.append("\n".join(cur))
+            cur, size = [], 0
+        size += len(line) + (1 if cur else 0)
+        cur.append(line)
+    if cur:
+        chunks.append("\n".join(cur))
+    return chunks
+
+class AwardLog:
+    """
+    포인트 적립 로그 전송 파이프라인.
+    줄은 채널별 대기열에 쌓이고, 채널마다 백그라운드 태스크 하나가 메시지 길이 단위로 묶어 전송.
+    레이트리밋(429)으로 전송이 밀려도 호출 쪽(루프/이벤트)은 기다리지 않으며,
+    밀리는 동안 쌓인 줄은 다음 메시지에 합쳐져 전송 횟수가 줄어듦.
+    """
+
+    def __init__(self):
+        self._pending: dict[int, list[str]] = defaultdict(list)
+        self._tasks: dict[int, asyncio.Task] = {}
+
+    def depth(self) -> int:
+        return sum(len(v) for v in self._pending.values())
+
+    def post(self, channel: discord.TextChannel, lines: list[str]):
+        if not lines:
+            return
+        self._pending[channel.id].extend(lines)
+        task = self._tasks.get(channel.id)
+        if task is None or task.done():
+            self._tasks[channel.id] = asyncio.create_task(self._drain(channel))
+
+    async def _drain(self, channel: discord.TextChannel):
+        # while 검사와 pop 사이에 await 가 없으므로 post()와 경합 없음
+        while self._pending.get(channel.id):
+            lines = self._pending.pop(channel.id)
+            for chunk in split_message(lines):
+                try:
+                    await channel.send(chunk)
+                except Exception as e:
+                    print("포인트 로그 전송 실패:", e)
+        self._tasks.pop(channel.id, None)
+
+
+award_log = AwardLog()
+
 def get_log_channel_obj(guild) -> discord.TextChannel | None:
-    with closing(get_db()) as db:
-        row = db.execute("SELECT log_channel_id FROM guild_settings WHERE guild_id=?", (guild.id,)).fetchone()
-    if not row or not row[0]:
+    log_id = guild_settings.log.get(guild.id)
+    if not log_id:
         return None
-    return guild.get_channel(row[0])
+    return guild.get_channel(log_id)
 
 @bot.tree.command(name="set_log_channel", description="포인트 로그 채널 설정/해제")
 @app_commands.default_permissions(administrator=True)
 async def set_log_channel_cmd(interaction: discord.Interaction, channel: discord.TextChannel | None):
-    with closing(get_db()) as db, db:
-        db.execute(
-            "INSERT INTO guild_settings(guild_id, log_channel_id) VALUES(?, ?) "
-            "ON CONFLICT(guild_id) DO UPDATE SET log_channel_id=excluded.log_channel_id",
-            (interaction.guild.id, channel.id if channel else None),
-        )
+    await guild_settings.set_log(interaction.guild.id, channel.id if channel else None)
     await interaction.response.send_message(
         f"📜 로그 채널: {channel.mention}" if channel else "📜 로그 채널 해제됨."
     )
 
+
+# ================ 리더보드 (메모리 정렬 + 페이지 캐시) ================
+LEADERBOARD_PAGE_SIZE = 10
+LEADERBOARD_PAGE_TTL = 60  # 닉네임 변경 반영용, 값 변경은 즉시 무효화
+
+class Leaderboard:
+    """
+    길드별 정렬 리스트 [(-값, user_id)] 를 메모리에 유지.
+    - 첫 조회 때 DB 에서 길드 전체를 한 번 읽고, 이후엔 값 변경 훅(update)으로만 갱신
+    - 순위/주변 조회는 bisect 로 O(log n), top-N 페이지는 렌더링한 문자열을 캐시
+    - 값이 바뀐 순위 이후 페이지만 무효화
+    loader(guild_id) 는 [(user_id, 값)] 을 돌려주는 코루틴.
+    """
+
+    def __init__(self, loader):
+        self._loader = loader
+        self._keys: dict[int, list[tuple[int, int]]] = {}
+        self._value: dict[int, dict[int, int]] = {}
+        self._loading: dict[int, asyncio.Future] = {}
+        self._pending: dict[int, dict[int, Optional[int]]] = {}  # 로딩 중 들어온 변경
+        self._pages: dict[tuple[int, int], tuple[float, str]] = {}
+
+    async def ensure(self, guild_id: int):
+        if guild_id in self._keys:
+            return
+        fut = self._loading.get(guild_id)
+        if fut is not None:
+            await asyncio.shield(fut)
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._loading[guild_id] = fut
+        self._pending[guild_id] = {}
+        try:
+            rows = await self._loader(guild_id)
+            values = {uid: v for uid, v in rows}
+            self._value[guild_id] = values
+            self._keys[guild_id] = sorted((-v, uid) for uid, v in values.items())
+            # 읽는 동안 커밋된 변경은 절댓값이라 다시 적용해도 안전
+            self.update(guild_id, self._pending.pop(guild_id).items())
+            fut.set_result(None)
+        except BaseException as e:
+            self._pending.pop(guild_id, None)
+            fut.set_exception(e)
+            fut.exception()  # 기다리는 쪽이 없어도 경고 안 나게
+            raise
+        finally:
+            self._loading.pop(guild_id, None)
+
+    def update(self, guild_id: int, changes):
+        """changes: [(user_id, 새 값 또는 None=제거)]"""
+        pending = self._pending.get(guild_id)
+        if pending is not None:
+            pending.update(changes)
+            return
+        keys = self._keys.get(guild_id)
+        if keys is None:
+            return  # 아직 아무도 조회 안 한 길드: 첫 조회 때 DB 에서 읽음
+        values = self._value[guild_id]
+        first = None
+        for uid, value in changes:
+            old = values.get(uid)
+            if old == value:
+                continue
+            if old is not None:
+                i = bisect.bisect_left(keys, (-old, uid))
+                del keys[i]
+                first = i if first is None else min(first, i)
+            if value is None:
+                values.pop(uid, None)
+                continue
+            values[uid] = value
+            i = bisect.bisect_left(keys, (-value, uid))
+            keys.insert(i, (-value, uid))
+            first = i if first is None else min(first, i)
+        if first is not None:
+            self._invalidate(guild_id, first // LEADERBOARD_PAGE_SIZE)
+
+    def forget_all(self):
+        for guild_id in list(self._keys):
+            self.forget(guild_id)
+
+    def forget(self, guild_id: int):
+        self._keys.pop(guild_id, None)
+        self._value.pop(guild_id, None)
+        self._invalidate(guild_id, 0)
+
+    def _invalidate(self, guild_id: int, from_page: int):
+        for key in [k for k in self._pages if k[0] == guild_id and k[1] >= from_page]:
+            del self._pages[key]
+
+    def size(self, guild_id: int) -> int:
+        return len(self._keys.get(guild_id, ()))
+
+    def rank(self, guild_id: int, user_id: int) -> Optional[int]:
+        """동점은 같은 순위 (1, 2, 2, 4 ...)"""
+        value = self._value.get(guild_id, {}).get(user_id)
+        if value is None:
+            return None
+        return bisect.bisect_left(self._keys[guild_id], (-value,)) + 1
+
+    def around(self, guild_id: int, user_id: int, radius: int = 2) -> list[tuple[int, int, int]]:
+        """[(순위, user_id, 값)] — 본인 앞뒤 radius 명"""
+        value = self._value.get(guild_id, {}).get(user_id)
+        if value is None:
+            return []
+        keys = self._keys[guild_id]
+        i = bisect.bisect_left(keys, (-value, user_id))
+        out = []
+        for neg, uid in keys[max(0, i - radius): i + radius + 1]:
+            out.append((bisect.bisect_left(keys, (neg,)) + 1, uid, -neg))
+        return out
+
+    def top(self, guild_id: int, page: int = 0) -> list[tuple[int, int, int]]:
+        keys = self._keys.get(guild_id, [])
+        start = page * LEADERBOARD_PAGE_SIZE
+        return [(bisect.bisect_left(keys, (neg,)) + 1, uid, -neg)
+                for neg, uid in keys[start: start + LEADERBOARD_PAGE_SIZE]]
+
+    def page_text(self, guild_id: int, page: int, render) -> str:
+        """render(rows) -> str 결과를 캐시. rows 가 비면 빈 문자열."""
+        hit = self._pages.get((guild_id, page))
+        now = time.monotonic()
+        if hit and now - hit[0] < LEADERBOARD_PAGE_TTL:
+            return hit[1]
+        rows = self.top(guild_id, page)
+        text = render(rows) if rows else ""
+        self._pages[(guild_id, page)] = (now, text)
+        return text
+
+
+def _load_points_rows(db, guild_id: int) -> list[tuple[int, int]]:
+    return [(r["user_id"], r["points"]) for r in
+            db.execute("SELECT user_id, points FROM users WHERE guild_id=? AND points > 0", (guild_id,))]
+
+async def _load_points_board(guild_id: int):
+    return await points_db.read(_load_points_rows, guild_id)
+
+points_board = Leaderboard(_load_points_board)
+
+def on_points_changed(guild_id: int, changes):
+    """포인트가 바뀐 곳에서 호출 (이벤트 루프). changes: [(user_id, 새 총 포인트)]"""
+    points_board.update(guild_id, [(uid, total if total > 0 else None) for uid, total in changes])
+    balances.update(guild_id, changes)
+
+def member_name(guild: discord.Guild, user_id: int) -> str:
+    mem = guild.get_member(user_id)
+    return mem.display_name if mem else str(user_id)
+
     
 # ===관리자포인트====
 
@@ -205,13 +911,11 @@ async def points_add_cmd(interaction: discord.Interaction, member: discord.Membe
     if amount <= 0:
         await interaction.response.send_message("추가할 포인트는 1 이상이어야 합니다.", ephemeral=True)
         return
-    with closing(get_db()) as db, db:
-        ensure_user(db, interaction.guild.id, member.id)
-        db.execute("UPDATE users SET points = points + ? WHERE guild_id=? AND user_id=?",
-                   (amount, interaction.guild.id, member.id))
-        row = db.execute("SELECT points FROM users WHERE guild_id=? AND user_id=?",
-                         (interaction.guild.id, member.id)).fetchone()
-    await interaction.response.send_message(f"✅ {member.display_name} 님에게 **+{amount}p** 추가 (현재 {row['points']}p)")
+    gid = interaction.guild.id
+
+    total = await points_db.write(change_points, gid, member.id, "admin_add", interaction.user.id, amount)
+    on_points_changed(gid, [(member.id, total)])
+    await interaction.response.send_message(f"✅ {member.display_name} 님에게 **+{amount}p** 추가 (현재 {total}p)")
 
 @bot.tree.command(name="points_remove", description="(관리자) 해당 유저의 포인트를 차감합니다.")
 @app_commands.default_permissions(administrator=True)
@@ -219,13 +923,12 @@ async def points_remove_cmd(interaction: discord.Interaction, member: discord.Me
     if amount <= 0:
         await interaction.response.send_message("차감할 포인트는 1 이상이어야 합니다.", ephemeral=True)
         return
-    with closing(get_db()) as db, db:
-        ensure_user(db, interaction.guild.id, member.id)
-        db.execute("UPDATE users SET points = MAX(points - ?, 0) WHERE guild_id=? AND user_id=?",
-                   (amount, interaction.guild.id, member.id))
-        row = db.execute("SELECT points FROM users WHERE guild_id=? AND user_id=?",
-                         (interaction.guild.id, member.id)).fetchone()
-    await interaction.response.send_message(f"✅ {member.display_name} 님에게 **-{amount}p** 차감 (현재 {row['points']}p)")
+    gid = interaction.guild.id
+
+    total = await points_db.write(change_points, gid, member.id, "admin_remove", interaction.user.id, -amount,
+                                  None, 0)
+    on_points_changed(gid, [(member.id, total)])
+    await interaction.response.send_message(f"✅ {member.display_name} 님에게 **-{amount}p** 차감 (현재 {total}p)")
 
 @bot.tree.command(name="points_set", description="(관리자) 해당 유저의 포인트를 특정 값으로 설정합니다.")
 @app_commands.default_permissions(administrator=True)
@@ -233,28 +936,475 @@ async def points_set_cmd(interaction: discord.Interaction, member: discord.Membe
     if value < 0:
         await interaction.response.send_message("설정 값은 0 이상이어야 합니다.", ephemeral=True)
         return
-    with closing(get_db()) as db, db:
-        ensure_user(db, interaction.guild.id, member.id)
-        db.execute("UPDATE users SET points = ? WHERE guild_id=? AND user_id=?",
-                   (value, interaction.guild.id, member.id))
+    gid = interaction.guild.id
+
+    await points_db.write(change_points, gid, member.id, "admin_set", interaction.user.id, 0, value)
+    on_points_changed(gid, [(member.id, value)])
     await interaction.response.send_message(f"✅ {member.display_name} 님의 포인트를 **{value}p** 로 설정했습니다.")
 
+@bot.tree.command(name="points_history", description="(관리자) 해당 유저의 최근 포인트 변동 내역을 봅니다.")
+@app_commands.default_permissions(administrator=True)
+async def points_history_cmd(interaction: discord.Interaction, member: discord.Member, limit: int = 10):
+    gid = interaction.guild.id
+    limit = max(1, min(limit, 25))
+
+    def _history(db):
+        return ledger_history(db, gid, member.id, limit), ledger_balance(db, gid, member.id), \
+            get_user_points(db, gid, member.id)
+
+    rows, replayed, current = await points_db.read(_history)
+    if not rows:
+        await interaction.response.send_message(f"{member.display_name} 님의 최근 변동 내역이 없습니다. (현재 {current}p)",
+                                                ephemeral=True)
+        return
+    lines = [f"`#{r['id']}` <t:{r['ts']}:f> **{r['delta']:+}p** → {r['balance']}p ({r['reason']})" for r in rows]
+    check = "✅ 장부 일치" if replayed == current else f"⚠️ 장부 불일치 (장부 {replayed}p / 잔액 {current}p)"
+    await interaction.response.send_message(
+        f"📒 **{member.display_name}** 포인트 내역 (현재 {current}p, {check})\n" + "\n".join(lines), ephemeral=True)
+
+@bot.tree.command(name="points_undo", description="(관리자) 장부 번호의 포인트 변동을 되돌립니다.")
+@app_commands.default_permissions(administrator=True)
+async def points_undo_cmd(interaction: discord.Interaction, ledger_id: int):
+    gid = interaction.guild.id
+
+    def _undo(db):
+        row = db.execute("SELECT user_id, delta, reason FROM points_ledger WHERE guild_id=? AND id=?",
+                         (gid, ledger_id)).fetchone()
+        if not row:
+            return None
+        if db.execute("SELECT 1 FROM points_ledger WHERE guild_id=? AND reason=?",
+                      (gid, f"undo:{ledger_id}")).fetchone():
+            return row["user_id"], None
+        return row["user_id"], change_points(db, gid, row["user_id"], f"undo:{ledger_id}", interaction.user.id,
+                                             -row["delta"])
+
+    result = await points_db.write(_undo)
+    if result is None:
+        await interaction.response.send_message("해당 번호의 장부 기록이 없습니다. (압축된 기록은 되돌릴 수 없음)",
+                                                ephemeral=True)
+        return
+    uid, total = result
+    if total is None:
+        await interaction.response.send_message("이미 되돌린 기록입니다.", ephemeral=True)
+        return
+    on_points_changed(gid, [(uid, total)])
+    await interaction.response.send_message(f"↩️ 장부 `#{ledger_id}` 를 되돌렸습니다. ({member_name(interaction.guild, uid)} 님 현재 {total}p)")
+
 
     
 # ==============================================
 
+class TTSCache:
+    """
+    TTS 결과 디스크 캐시.
+    - 키: 텍스트 + 보이스 + 속도 + 볼륨
+    - 용량/개수 상한 LRU 제거, index.json 으로 재시작 후에도 순서/목록 유지
+    - 같은 키 동시 요청은 합성 1번만 하고 결과 공유 (single-flight)
+    """
+
+    INDEX_NAME = "index.json"
+    # 캐시가 만드는 파일 이름: sha1 키 + .mp3/.ogg (+ 작성 중 .part) — 정리는 이 패턴만 (다른 파일은 건드리지 않음)
+    FILE_PATTERN = re.compile(r"[0-9a-f]{40}\.(mp3|ogg)(\.part)?")
+
+    def __init__(self, root: Path, max_bytes: int, max_entries: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        # key -> {"files": {종류: 파일명}, "size": 바이트, "atime": 마지막 사용}
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    @staticmethod
+    def make_key(text: str, voice: str, rate: str, volume: str) -> str:
+        raw = json.dumps([text, voice, rate, volume], ensure_ascii=False)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(e["size"] for e in self._entries.values())
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+        }
+
+    def _load(self):
+        try:
+            data = json.loads((self.root / self.INDEX_NAME).read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            data = {}
+        for key, entry in sorted(data.items(), key=lambda kv: kv[1].get("atime", 0)):
+            if all((self.root / f).exists() for f in entry.get("files", {}).values()):
+                self._entries[key] = entry
+        # 인덱스에 없는 캐시 파일(구버전 캐시, 합성 중 종료된 .part 등)은 정리
+        # TTS_CACHE_DIR 을 잘못 지정해도 남의 파일을 지우지 않도록 캐시 이름 패턴인 파일만
+        known = {f for e in self._entries.values() for f in e["files"].values()}
+        for path in self.root.iterdir():
+            if path.name not in known and self.FILE_PATTERN.fullmatch(path.name) and path.is_file():
+                path.unlink(missing_ok=True)
+        (self.root / (self.INDEX_NAME + ".tmp")).unlink(missing_ok=True)
+        self._evict()
+        self.save()
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp = self.root / (self.INDEX_NAME + ".tmp")
+        tmp.write_text(json.dumps(self._entries, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.root / self.INDEX_NAME)
+        self._dirty = False
+
+    def pending(self, key: str) -> bool:
+        return key in self._inflight
+
+    def lookup(self, key: str, kind: str = "mp3") -> Optional[Path]:
+        entry = self._entries.get(key)
+        if not entry or kind not in entry["files"]:
+            return None
+        path = self.root / entry["files"][kind]
+        if not path.exists():
+            self._drop(key)
+            return None
+        entry["atime"] = int(time.time())
+        self._entries.move_to_end(key)
+        self._dirty = True
+        return path
+
+    def add_file(self, key: str, kind: str, path: Path):
+        entry = self._entries.setdefault(key, {"files": {}, "size": 0, "atime": 0})
+        entry["files"][kind] = path.name
+        entry["size"] = sum((self.root / f).stat().st_size for f in entry["files"].values())
+        entry["atime"] = int(time.time())
+        self._entries.move_to_end(key)
+        self._dirty = True
+        self._evict()
+        self.save()
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry:
+            for f in entry["files"].values():
+                (self.root / f).unlink(missing_ok=True)
+            self._dirty = True
+
+    def _evict(self):
+        total = self.total_bytes
+        while self._entries and (len(self._entries) > self.max_entries or total > self.max_bytes):
+            key = next(iter(self._entries))
+            if key in self._inflight:
+                break
+            total -= self._entries[key]["size"]
+            self._drop(key)
+
+    async def get_or_create(self, key: str, create) -> Path:
+        """
+        캐시에 있으면 바로 경로 반환, 없으면 create(임시경로) 로 만들고 등록.
+        같은 키를 이미 만드는 중이면 그 결과를 기다려서 공유.
+        """
+        path = self.lookup(key)
+        if path:
+            self.hits += 1
+            return path
+        fut = self._inflight.get(key)
+        if fut:
+            self.hits += 1
+            return await asyncio.shield(fut)
+        return await self.fill(key, self.reserve(key), create)
+
+    def reserve(self, key: str) -> asyncio.Future:
+        """
+        합성 시작 전에 동기적으로 "만드는 중" 표시 (await 없이 등록해야 동시 요청이 중복 합성하지 않음).
+        반드시 fill() 로 이어서 완료/실패 처리할 것.
+        """
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        return fut
+
+    def release(self, key: str, fut: asyncio.Future):
+        """reserve() 후 fill() 을 못 돌린 경우 등록 해제 (기다리던 쪽은 취소로 받음)."""
+        if not fut.done():
+            fut.cancel()
+        if self._inflight.get(key) is fut:
+            del self._inflight[key]
+
+    async def fill(self, key: str, fut: asyncio.Future, create) -> Path:
+        try:
+            out = self.root / f"{key}.mp3"
+            part = self.root / f"{key}.mp3.part"
+            await create(part)
+            os.replace(part, out)
+            self.add_file(key, "mp3", out)
+            fut.set_result(out)
+            return out
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                fut.cancel()
+            else:
+                fut.set_exception(e)
+                fut.exception()  # 기다리는 쪽이 없어도 경고 안 나도록
+            (self.root / f"{key}.mp3.part").unlink(missing_ok=True)
+            raise
+        finally:
+            self._inflight.pop(key, None)
+
+
+tts_cache = TTSCache(TTS_CACHE_DIR, TTS_CACHE_MAX_MB * 1024 * 1024, TTS_CACHE_MAX_ENTRIES)
+
 async def tts_synthesize_to_file(text: str,
-                                 voice: str = "ko-KR-SunHiNeural") -> str:
+                                 voice: str = TTS_VOICE,
+                                 rate: str = "+0%",
+                                 volume: str = "+0%") -> str:
     """
     edge-tts로 텍스트를 mp3로 합성하고, 캐시 파일 경로를 반환.
-    같은 텍스트는 캐시 히트로 즉시 재생.
+    같은 (텍스트, 보이스, 속도, 볼륨)은 캐시 히트로 즉시 재생.
+    """
+    key = TTSCache.make_key(text, voice, rate, volume)
+
+    async def _create(path: Path):
+        await edge_tts.Communicate(text, voice=voice, rate=rate, volume=volume).save(str(path))
+
+    return str(await tts_cache.get_or_create(key, _create))
+
+
+class OpusPacketSource(discord.AudioSource):
+    """미리 인코딩된 Opus 패킷(20ms 단위)을 그대로 보내는 소스. 서브프로세스 없음."""
+
+    def __init__(self, packets: list[bytes]):
+        self._iter = iter(packets)
+
+    def read(self) -> bytes:
+        return next(self._iter, b"")
+
+    def is_opus(self) -> bool:
+        return True
+
+
+_opus_packets: OrderedDict[str, list[bytes]] = OrderedDict()  # key -> 패킷 (메모리 LRU)
+_opus_encoding: dict[str, asyncio.Task] = {}
+
+def read_opus_packets(path: Path) -> list[bytes]:
+    with open(path, "rb") as f:
+        return [p for p in OggStream(f).iter_packets()
+                if not p.startswith((b"OpusHead", b"OpusTags"))]
+
+async def load_opus_packets(key: str, path: Path) -> list[bytes]:
+    packets = _opus_packets.get(key)
+    if packets is None:
+        packets = await asyncio.to_thread(read_opus_packets, path)
+        _opus_packets[key] = packets
+        while len(_opus_packets) > TTS_OPUS_MEMORY_ENTRIES:
+            _opus_packets.popitem(last=False)
+    _opus_packets.move_to_end(key)
+    return packets
+
+async def _encode_opus(key: str, mp3: Path):
+    # 디스코드 보이스 규격(48kHz 스테레오, 20ms 프레임)으로 한 번만 변환해 둠
+    out = mp3.with_suffix(".ogg")
+    part = mp3.with_suffix(".ogg.part")
+    proc = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", str(mp3),
+        "-vn", "-map_metadata", "-1", "-c:a", "libopus", "-b:a", "64k",
+        "-ar", "48000", "-ac", "2", "-frame_duration", "20", "-f", "ogg", str(part),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE,
+    )
+    _, err = await proc.communicate()
+    if proc.returncode != 0 or not part.exists():
+        part.unlink(missing_ok=True)
+        print("TTS opus 변환 실패:", err.decode(errors="ignore").strip())
+        return
+    os.replace(part, out)
+    if tts_cache.lookup(key):  # 변환 중에 캐시에서 밀려났으면 버림
+        tts_cache.add_file(key, "opus", out)
+    else:
+        out.unlink(missing_ok=True)
+
+def ensure_opus(key: str, mp3: Path):
+    if key not in _opus_encoding:
+        task = asyncio.create_task(_encode_opus(key, mp3))
+        _opus_encoding[key] = task
+        task.add_done_callback(lambda _: _opus_encoding.pop(key, None))
+
+class _StreamPipe:
+    """
+    edge-tts 스트림 청크를 FFmpeg stdin 으로 넘기는 블로킹 파일 객체.
+    FFmpegPCMAudio(pipe=True) 의 writer 스레드가 read() 를 부르고, 이벤트 루프가 feed() 로 채움.
+    """
+
+    def __init__(self):
+        self._q: queue.Queue[bytes | None] = queue.Queue()
+        self._buf = b""
+        self._eof = False
+
+    def feed(self, data: bytes):
+        self._q.put(data)
+
+    def close_feed(self):
+        self._q.put(None)
+
+    def read(self, n: int = -1) -> bytes:
+        while not self._buf and not self._eof:
+            chunk = self._q.get()
+            if chunk is None:
+                self._eof = True
+            else:
+                self._buf += chunk
+        if n < 0:
+            n = len(self._buf)
+        out, self._buf = self._buf[:n], self._buf[n:]
+        return out
+
+
+def _log_task_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception():
+        print("TTS 합성 오류:", task.exception())
+
+async def tts_get_source(text: str,
+                         voice: str = TTS_VOICE,
+                         rate: str = "+0%",
+                         volume: str = "+0%") -> discord.AudioSource:
+    """
+    재생용 소스 반환.
+    - Opus 캐시 히트: 패킷을 그대로 전송 (FFmpeg 프로세스 없음)
+    - mp3 캐시 히트(또는 다른 길드가 합성 중): 완성된 mp3를 FFmpeg로 재생
+    - 캐시 미스: edge-tts 스트리밍 청크를 바로 FFmpeg에 흘려 재생하면서 mp3 캐시도 같이 작성
+    mp3가 생기면 다음부터 쓰도록 Opus 변환을 백그라운드로 걸어둠.
+    """
+    key = TTSCache.make_key(text, voice, rate, volume)
+    ogg = tts_cache.lookup(key, "opus")
+    if ogg:
+        tts_cache.hits += 1
+        return OpusPacketSource(await load_opus_packets(key, ogg))
+
+    if tts_cache.lookup(key) or tts_cache.pending(key):
+        mp3 = Path(await tts_synthesize_to_file(text, voice, rate, volume))
+        ensure_opus(key, mp3)
+        return discord.FFmpegPCMAudio(str(mp3), before_options="-nostdin", options="-vn")
+
+    # 반환 전에 inflight 등록: 같은 문장을 바로 뒤에 요청한 다른 길드는 위 분기로 완성된 mp3 를 기다림
+    fut = tts_cache.reserve(key)
+    pipe = _StreamPipe()
+
+    async def _create(path: Path):
+        try:
+            with open(path, "wb") as f:
+                async for chunk in edge_tts.Communicate(text, voice=voice, rate=rate, volume=volume).stream():
+                    if chunk["type"] == "audio":
+                        f.write(chunk["data"])
+                        pipe.feed(chunk["data"])
+        finally:
+            pipe.close_feed()
+
+    async def _synthesize():
+        try:
+            ensure_opus(key, await tts_cache.fill(key, fut, _create))
+        finally:
+            pipe.close_feed()  # _create 가 시작도 못 하고 실패해도 FFmpeg 가 EOF 를 받게
+
+    def _done(task: asyncio.Task):
+        if task.cancelled():  # 한 번도 실행되지 못하고 취소된 경우 (종료 시점 등)
+            tts_cache.release(key, fut)
+            pipe.close_feed()
+        _log_task_error(task)
+
+    task = asyncio.create_task(_synthesize())
+    task.add_done_callback(_done)
+    return discord.FFmpegPCMAudio(pipe, pipe=True, options="-vn")
+
+
+class GuildTTSPlayer:
     """
-    key = hashlib.sha1(text.encode("utf-8")).hexdigest()
-    out = TTS_CACHE_DIR / f"{key}.mp3"
-    if not out.exists():
-        # 필요하면 rate="+10%", volume="+0%" 같은 파라미터도 전달 가능
-        await edge_tts.Communicate(text, voice=voice).save(str(out))
-    return str(out)
+    길드별 TTS 재생 대기열.
+    소비자 태스크 하나가 순서대로 재생하고, 재생 종료는 vc.play 의 after 콜백으로 통지받음(폴링 없음).
+    """
+
+    def __init__(self, guild: discord.Guild):
+        self.guild = guild
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=TTS_QUEUE_MAX)  # (텍스트, 보이스채널, 응답채널)
+        self._task: asyncio.Task | None = None
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    def submit(self, text: str, voice_channel: discord.VoiceChannel, reply_to) -> Optional[int]:
+        """대기열에 넣고 앞에 남은 개수를 반환. 꽉 찼으면 None."""
+        if TTS_QUEUE_POLICY == "interrupt":
+            self._clear()
+        try:
+            self.queue.put_nowait((text, voice_channel, reply_to))
+        except asyncio.QueueFull:
+            return None
+        if TTS_QUEUE_POLICY == "interrupt":
+            self._stop_current()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._consume())
+        ahead = self.queue.qsize() - 1
+        vc = self.voice_client
+        return ahead + (1 if vc and vc.is_playing() else 0)
+
+    def stop(self) -> bool:
+        """대기열 비우고 현재 재생 중지. 뭔가 재생 중이었으면 True."""
+        self._clear()
+        return self._stop_current()
+
+    def _clear(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    def _stop_current(self) -> bool:
+        vc = self.voice_client
+        if vc and vc.is_playing():
+            vc.stop()  # after 콜백이 불려서 소비자가 다음 항목으로 넘어감
+            return True
+        return False
+
+    async def _connect(self, voice_channel, reply_to):
+        vc = self.voice_client
+        if vc and vc.is_connected():
+            return vc
+        try:
+            return await voice_channel.connect(timeout=15, reconnect=True)
+        except asyncio.TimeoutError:
+            await reply_to.send("보이스 연결 타임아웃… 잠시 후 다시 시도해줘요.", delete_after=4)
+        except discord.ClientException:
+            return self.voice_client  # 이미 연결 중/완료 상태
+        return None
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        while not self.queue.empty():
+            text, voice_channel, reply_to = self.queue.get_nowait()
+            try:
+                vc = await self._connect(voice_channel, reply_to)
+                if not vc:
+                    continue
+                source = await tts_get_source(text)
+                done = asyncio.Event()
+                if vc.is_playing():
+                    vc.stop()
+                vc.play(source, after=lambda _e: loop.call_soon_threadsafe(done.set))
+                await done.wait()
+            except Exception as e:
+                print("TTS 재생 오류:", e)
+
+
+tts_players: dict[int, GuildTTSPlayer] = {}
+
+def get_tts_player(guild: discord.Guild) -> GuildTTSPlayer:
+    player = tts_players.get(guild.id)
+    if player is None:
+        player = tts_players[guild.id] = GuildTTSPlayer(guild)
+    return player
 
 # ================= 기존 커맨드들 =================
 @bot.command()
@@ -275,29 +1425,54 @@ async def rps(ctx, opponent: discord.Member):
     await ctx.send(f"{ctx.author.mention} 님: {user_choice}\n{opponent.mention} 님: {bot_choice}\n결과: {result}")
 
 # ================= on_ready (병합) =================
+bot_started = False
+
 @bot.event
 async def on_ready():
-    init_points_db()
+    # 게이트웨이 재연결(샤드 재접속) 때도 on_ready 가 다시 오므로 초기화/루프 기동은 한 번만
+    global bot_started
+    if bot_started:
+        print(f"{bot.user} 재연결")
+        return
+    bot_started = True
+    await points_db.write(init_points_db)
+    await points_db.write(seed_ledger_base)
+    activity.load(await points_db.read(load_all_last_active))
+    guild_settings.load(await points_db.read(load_guild_settings))
+    await legacy_scores.start(copy=PRIMARY_SHARD)
     try:
-        await bot.tree.sync()
+        await reconcile_managed_channels()
     except Exception as e:
-        print("Slash sync error:", e)
+        print("임시 채널 정리 오류:", e)
+    if PRIMARY_SHARD:  # 전역 명령 동기화는 한 프로세스에서만
+        try:
+            await bot.tree.sync()
+        except Exception as e:
+            print("Slash sync error:", e)
     await bot.change_presence(activity=discord.Activity(
         type=discord.ActivityType.watching,
         name="기본 커맨드 : $? 　　　　　"
     ))
     # 보조 루프 스타트
+    activity_flush_loop.start()
     accrual_loop.start()
     afk_guard.start()
+    if PRIMARY_SHARD:
+        ledger_compact_loop.start()
+    start_loop_lag_probe()
+    # 음악은 부가 기능: 노드별 연결을 백그라운드로 띄우고 기다리지 않음 (노드가 죽어 있어도 위 기능은 정상 동작)
+    lavalink_pool.connect()
     print(f"{bot.user} 작동 중")
 
 # ================ 활동 기록 (텍스트 치면 비활동 해제) ================
 @bot.event
+@metrics.timed("bot_event_seconds", event="on_message")
 async def on_message(message: discord.Message):
     if message.guild and not message.author.bot:
-        with closing(get_db()) as db, db:
-            ensure_user(db, message.guild.id, message.author.id)
-            mark_active(db, message.guild.id, message.author.id)
+        # DB에는 activity_flush_loop 가 모아서 기록 (users 행 생성 포함)
+        now = int(dt.datetime.utcnow().timestamp())
+        mark_active(message.guild.id, message.author.id, now)
+        afk_sched.on_activity(message.guild.id, message.author.id, now)
     await bot.process_commands(message)
 
 # ================ 음성 상태 업데이트 (병합) ================
@@ -306,7 +1481,131 @@ def normalize_name(name: str) -> str:
     # 띄어쓰기/이모지/특수문자 제거 → '칼 바 내 전'도 '칼바내전'으로 인식
     return re.sub(r"\s+|[^\w가-힣]", "", name)
 
+def settle_voice_session(db, gid: int, uid: int, before_id: Optional[int], after_id: Optional[int],
+                         afk_id: Optional[int], now: int) -> tuple[int, int]:
+    """
+    보이스 이동 1건의 포인트 세션 정산 (DB 스레드에서 실행).
+    return: (이번에 지급된 포인트, 지급 후 총 포인트)
+    """
+    awarded, new_total = 0, 0
+    ensure_user(db, gid, uid)
+
+    if before_id and (not afk_id or before_id != afk_id):
+        row = db.execute("SELECT last_join FROM users WHERE guild_id=? AND user_id=?", (gid, uid)).fetchone()
+        if row and row["last_join"]:
+            elapsed = now - int(row["last_join"])
+            awarded, new_total = grant_points_for_session(db, gid, uid, elapsed)
+            db.execute("UPDATE users SET last_join=NULL WHERE guild_id=? AND user_id=?", (gid, uid))
+
+    if after_id and (not afk_id or after_id != afk_id):
+        row = db.execute("SELECT last_join FROM users WHERE guild_id=? AND user_id=?", (gid, uid)).fetchone()
+        if not row or row["last_join"] is None:
+            db.execute("UPDATE users SET last_join=? WHERE guild_id=? AND user_id=?", (now, gid, uid))
+    return awarded, new_total
+
+def settle_voice_batch(db, gid: int, ops, afk_id: Optional[int]) -> list[tuple[int, int, int]]:
+    """ops: [(user_id, before_id, after_id, now)] 를 순서대로 한 트랜잭션에서 정산. return: 지급된 [(uid, 지급, 총)]"""
+    awards = []
+    for uid, before_id, after_id, now in ops:
+        awarded, new_total = settle_voice_session(db, gid, uid, before_id, after_id, afk_id, now)
+        if awarded > 0:
+            awards.append((uid, awarded, new_total))
+    return awards
+
+VOICE_COALESCE_SECONDS = 0.5  # 이 시간 동안 들어온 같은 길드 이벤트를 모아서 처리
+
+class VoicePipeline:
+    """
+    길드별 보이스 이벤트 파이프라인.
+    - 방/팀 생성 트리거, 활동/AFK 갱신(메모리)은 이벤트에서 바로 처리
+    - 포인트 정산은 멤버별 '세션 시작/종료' 전환만 남김. 뮤트 토글이나 일반 채널 간 이동은
+      정산 결과가 같아서(carry_sec 로 이어짐) DB 를 건드리지 않음
+    - 남은 전환은 길드 단위로 모아 한 트랜잭션, 빈 채널 정리 검사는 채널당 한 번만
+    - DB 정산과 Discord API(채널 삭제)는 따로 진행, 길드마다 워커가 따로 돌아 길드끼리는 병렬
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._ops: dict[int, list[tuple[int, Optional[int], Optional[int], int]]] = defaultdict(list)
+        self._checks: dict[int, set[int]] = defaultdict(set)
+        self._workers: dict[int, asyncio.Task] = {}
+        self._open: set[tuple[int, int]] = set()  # 세션 시작이 DB 에 반영된 (길드, 유저)
+        self.events = 0
+        self.db_ops = 0
+
+    def submit(self, member: discord.Member, before, after, now: int):
+        gid, uid = member.guild.id, member.id
+        afk_id = get_afk_channel_id(gid)
+        b = before.channel.id if before.channel else None
+        a = after.channel.id if after.channel else None
+        counting_before = b is not None and b != afk_id
+        counting_after = a is not None and a != afk_id
+        self.events += 1
+
+        if counting_before and not counting_after:
+            self._ops[gid].append((uid, b, None, now))
+            self._open.discard((gid, uid))
+        elif counting_after and (not counting_before or (gid, uid) not in self._open):
+            # 재시작 직후처럼 세션 시작을 모르는 경우엔 한 번만 last_join 보장
+            self._ops[gid].append((uid, None, a, now))
+            self._open.add((gid, uid))
+
+        for cid in (b, a):
+            if cid:
+                self._checks[gid].add(cid)
+        task = self._workers.get(gid)
+        if task is None or task.done():
+            self._workers[gid] = asyncio.create_task(self._run(member.guild))
+
+    async def _run(self, guild: discord.Guild):
+        gid = guild.id
+        # while 검사와 종료 사이에 await 가 없으므로 submit()과 경합 없음
+        while self._ops.get(gid) or self._checks.get(gid):
+            await asyncio.sleep(self.delay)
+            ops = self._ops.pop(gid, [])
+            checks = self._checks.pop(gid, set())
+            for r in await asyncio.gather(self._settle(guild, ops), self._cleanup(guild, checks),
+                                          return_exceptions=True):
+                if isinstance(r, Exception):
+                    print("보이스 이벤트 처리 오류:", r)
+        self._workers.pop(gid, None)
+
+    async def _settle(self, guild: discord.Guild, ops):
+        if not ops:
+            return
+        self.db_ops += len(ops)
+        awards = await points_db.write(settle_voice_batch, guild.id, ops, get_afk_channel_id(guild.id))
+        if not awards:
+            return
+        on_points_changed(guild.id, [(uid, total) for uid, _, total in awards])
+        log_ch = get_log_channel_obj(guild)
+        if log_ch:
+            lines = []
+            for uid, awarded, total in awards:
+                member = guild.get_member(uid)
+                lines.append(award_line(member.name if member else str(uid), awarded, total))
+            award_log.post(log_ch, lines)
+
+    async def _cleanup(self, guild: discord.Guild, channel_ids: set[int]):
+        async def check(cid):
+            await maybe_cleanup_team_set(guild, cid)
+            ch = guild.get_channel(cid)
+            if isinstance(ch, discord.VoiceChannel):
+                await maybe_cleanup_temp_channel(ch)
+        await asyncio.gather(*(check(cid) for cid in channel_ids))
+
+    def flush_sync(self):
+        """종료 시점: 아직 반영 안 된 정산을 마저 기록."""
+        for gid, ops in list(self._ops.items()):
+            if ops:
+                points_db.write_sync(settle_voice_batch, gid, ops, get_afk_channel_id(gid))
+        self._ops.clear()
+
+
+voice_pipeline = VoicePipeline(VOICE_COALESCE_SECONDS)
+
 @bot.event
+@metrics.timed("bot_event_seconds", event="on_voice_state_update")
 async def on_voice_state_update(member, before, after):
     gid, uid = member.guild.id, member.id
     now = int(dt.datetime.utcnow().timestamp())
@@ -314,61 +1613,20 @@ async def on_voice_state_update(member, before, after):
     # --- (팀 생성 트리거) after가 '팀 생성' 이고 카테고리가 칼바/협곡이면 1~4팀 생성 ---
     if after.channel and after.channel.name == TEAM_TRIGGER_NAME:
         parent = after.channel.category
-        if parent and normalize_name(parent.name) in {"칼바내전", "협곡내전"}:
+        if parent and normalize_name(parent.name) in TEAM_PARENT_CATEGORIES:
             await create_team_set(parent, member, trigger_ch=after.channel)  # 트리거 채널 지우려면 이 인자 필수
 
-    # --- (팀 세트 자동 정리) 누가 나가거나 이동할 때마다, 이전/이후 채널 모두 확인 ---
-    if before.channel:
-        await maybe_cleanup_team_set(member.guild, before.channel.id)
-    if after.channel:
-        await maybe_cleanup_team_set(member.guild, after.channel.id)
-
-    # ----- 아래는 네 기존 '방 생성/정리' 및 포인트/AFK 로직 유지 -----
-    # --- 방 생성/정리 (기존 기능 그대로) ---
+    # --- 방 생성 트리거 (바로 처리) ---
     if after.channel and after.channel.name in TRIGGER_CHANNEL_NAMES:
-        category = after.channel.category
-        new_channel = await category.create_voice_channel(f"방장: {member.display_name}")
-        temp_channels[new_channel.id] = new_channel
-        await member.move_to(new_channel)
+        await open_temp_channel(member, after.channel.category)
 
-    if before.channel and before.channel.id in temp_channels:
-        if len(before.channel.members) == 0:
-            await temp_channels[before.channel.id].delete()
-            del temp_channels[before.channel.id]
+    # --- 활동/AFK 스케줄 (메모리만) ---
+    if after.channel and (not after.self_mute and not after.self_deaf):
+        mark_active(gid, uid, now)
+    afk_track(gid, uid, after, now)
 
-    # --- 포인트 정산/세션 관리 (신규) ---
-    awarded = 0
-    new_total = 0
-    with closing(get_db()) as db, db:
-        ensure_user(db, gid, uid)
-        afk_id = get_afk_channel_id(db, gid)
-
-        if before.channel and (not afk_id or before.channel.id != afk_id):
-            row = db.execute("SELECT last_join FROM users WHERE guild_id=? AND user_id=?", (gid, uid)).fetchone()
-            if row and row["last_join"]:
-                elapsed = now - int(row["last_join"])
-                awarded, new_total = grant_points_for_session(db, gid, uid, elapsed)
-                db.execute("UPDATE users SET last_join=NULL WHERE guild_id=? AND user_id=?", (gid, uid))
-
-        if after.channel and (not afk_id or after.channel.id != afk_id):
-            row = db.execute("SELECT last_join FROM users WHERE guild_id=? AND user_id=?", (gid, uid)).fetchone()
-            if not row or row["last_join"] is None:
-                db.execute("UPDATE users SET last_join=? WHERE guild_id=? AND user_id=?", (now, gid, uid))
-
-        if after.channel and (not after.self_mute and not after.self_deaf):
-            mark_active(db, gid, uid, now)
-
-        if awarded > 0:
-            log_ch = get_log_channel_obj(member.guild)
-            if log_ch:
-                try:
-                    blocks = awarded // POINTS_PER_BLOCK
-                    minutes = blocks * (BLOCK_SECONDS // 60)
-                    await log_ch.send(
-                        f"{member.name} 님이 **{minutes}분 활동**으로 **{awarded}p** 획득! (총 {new_total}p)"
-                    )
-                except Exception:
-                    pass
+    # --- 포인트 정산 + 빈 팀 세트/임시 채널 정리는 길드별로 모아서 ---
+    voice_pipeline.submit(member, before, after, now)
 
 #============================================================
 
@@ -376,42 +1634,50 @@ async def create_team_set(category: discord.CategoryChannel,
                           owner: discord.Member,
                           trigger_ch: discord.VoiceChannel | None = None) -> int:
     """카테고리에 1~4팀 생성. 이미 있으면 재사용. 생성 후 트리거 채널은 삭제."""
-    # 이미 이 카테고리에 팀 세트가 있으면 첫 채널로 이동만
-    if category.id in category_group:
-        group_key = category_group[category.id]
-        first_id = team_groups.get(group_key, [None])[0]
-        first_ch = category.guild.get_channel(first_id)
-        if isinstance(first_ch, discord.VoiceChannel):
-            try:
-                await owner.move_to(first_ch)
-            except Exception:
-                pass
-        # 트리거 채널이 남아있다면 지워주기(중복 클릭 방지)
-        if trigger_ch:
-            try: await trigger_ch.delete()
-            except Exception: pass
-        return group_key
-
-    # 1~4팀 생성
-    names = ["1팀", "2팀", "3팀", "4팀"]
-    created = [await category.create_voice_channel(n) for n in names]
-
-    group_key = created[0].id
-    team_groups[group_key] = [c.id for c in created]
-    category_group[category.id] = group_key
-    for cid in team_groups[group_key]:
-        channel_to_group[cid] = group_key
+    async with team_set_locks[category.id]:
+        # 이미 이 카테고리에 팀 세트가 있으면 첫 채널로 이동만
+        if category.id in category_group:
+            group_key = category_group[category.id]
+            alive = [category.guild.get_channel(cid) for cid in team_groups.get(group_key, [])]
+            alive = [ch for ch in alive if isinstance(ch, discord.VoiceChannel)]
+            if alive:
+                try:
+                    await owner.move_to(alive[0])
+                except Exception:
+                    pass
+                # 트리거 채널이 남아있다면 지워주기(중복 클릭 방지)
+                if trigger_ch:
+                    try: await trigger_ch.delete()
+                    except Exception: pass
+                return group_key
+            # 세트 채널이 전부 수동으로 지워진 경우: 새로 만듦
+            await points_db.write(delete_managed_channels, _forget_team_set(group_key))
+
+        # 1~4팀 동시 생성 (순서가 섞이지 않게 위치를 지정)
+        base = max((c.position for c in category.voice_channels), default=0) + 1
+        results = await asyncio.gather(
+            *(category.create_voice_channel(n, position=base + i) for i, n in enumerate(TEAM_SET_NAMES)),
+            return_exceptions=True,
+        )
+        created = [r for r in results if isinstance(r, discord.VoiceChannel)]
+        if len(created) != len(TEAM_SET_NAMES):
+            await delete_channels(created)
+            raise next(r for r in results if isinstance(r, Exception))
 
-    # ✅ 1) 먼저 유저를 1팀으로 이동
-    try:
-        await owner.move_to(created[0])
-    except Exception:
-        pass
+        group_key = _track_team_set(category.id, [c.id for c in created])
+        now = int(time.time())
+        rows = [(c.id, category.guild.id, "team", group_key, category.id, now) for c in created]
+
+    # ✅ 1) 유저를 1팀으로 이동 (기록 저장과 동시에)
+    async def _move():
+        try:
+            await owner.move_to(created[0])
+        except Exception:
+            pass
 
-    # 살짝 텀 주면 안정적(이벤트 순서/권한 레이스 대비)
-    await asyncio.sleep(0.1)
+    await asyncio.gather(_move(), points_db.write(save_managed_channels, rows))
 
-    # ✅ 2) 그 다음 트리거 채널 삭제
+    # ✅ 2) 그 다음 트리거 채널 삭제 (이동 응답을 받은 뒤라 대기 불필요)
     if trigger_ch:
         try:
             await trigger_ch.delete()
@@ -419,7 +1685,6 @@ async def create_team_set(category: discord.CategoryChannel,
             pass
 
     return group_key
-    
 
 
 async def maybe_cleanup_team_set(guild: discord.Guild, channel_id: int):
@@ -441,6 +1706,9 @@ async def maybe_cleanup_team_set(guild: discord.Guild, channel_id: int):
     if not all_empty:
         return
 
+    # 매핑 해제 (먼저 해 두면 삭제 중 들어온 이벤트가 같은 세트를 두 번 정리하지 않음)
+    _forget_team_set(group_key)
+
     # 보이스 클라 붙어있으면 끊기
     try:
         vc = guild.voice_client
@@ -449,152 +1717,400 @@ async def maybe_cleanup_team_set(guild: discord.Guild, channel_id: int):
     except Exception:
         pass
 
-    # 채널 삭제
-    for ch in channels:
-        try: await ch.delete()
-        except Exception: pass
+    # 채널 삭제 + 기록 삭제 (동시)
+    await asyncio.gather(delete_channels(channels), points_db.write(delete_managed_channels, ch_ids))
+
+    # 카테고리 기준으로 '팀 생성' 복구
+    await restore_team_trigger(channels[0].category if channels else None)
+
+
+# ================ 임시 채널/팀 세트 상태 (points DB 에 저장) ================
+# 재시작해도 어떤 채널이 봇이 만든 임시 채널/팀 세트인지 기억하고, 시작 시 실제 길드 채널과 맞춰 정리.
+TEAM_SET_NAMES = ["1팀", "2팀", "3팀", "4팀"]
+TEMP_CHANNEL_PREFIX = "방장: "
+
+def save_managed_channels(db, rows):
+    """rows: [(channel_id, guild_id, kind, group_key, category_id, created_at)] — kind: 'temp' | 'team'"""
+    db.executemany("INSERT OR REPLACE INTO managed_channels(channel_id, guild_id, kind, group_key, category_id, created_at) "
+                   "VALUES(?, ?, ?, ?, ?, ?)", rows)
 
-    # 매핑 해제
+def delete_managed_channels(db, channel_ids):
+    db.executemany("DELETE FROM managed_channels WHERE channel_id=?", [(cid,) for cid in channel_ids])
+
+def load_managed_channels(db):
+    return db.execute("SELECT channel_id, guild_id, kind, group_key, category_id FROM managed_channels").fetchall()
+
+team_set_locks: dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)  # 카테고리ID -> 락 (동시 트리거로 세트 2개 생기는 것 방지)
+
+def _forget_team_set(group_key: int) -> list[int]:
+    ch_ids = team_groups.pop(group_key, [])
     for cid in ch_ids:
         channel_to_group.pop(cid, None)
-    team_groups.pop(group_key, None)
+    for cat_id, key in list(category_group.items()):
+        if key == group_key:
+            category_group.pop(cat_id, None)
+    return ch_ids
+
+def _track_team_set(category_id: int, ch_ids: list[int]) -> int:
+    group_key = ch_ids[0]
+    team_groups[group_key] = list(ch_ids)
+    category_group[category_id] = group_key
+    for cid in ch_ids:
+        channel_to_group[cid] = group_key
+    return group_key
 
-    # 카테고리 기준으로 '팀 생성' 복구
-    cat = channels[0].category if channels else None
-    if cat:
-        category_group.pop(cat.id, None)  # 세트 없음으로 표시
-        # 이미 있으면 중복 생성 방지
-        already = any(vch.name == TEAM_TRIGGER_NAME for vch in cat.voice_channels)
-        if not already:
-            try:
-                await cat.create_voice_channel(TEAM_TRIGGER_NAME)
-            except Exception:
-                pass
+async def delete_channels(channels) -> None:
+    """여러 채널을 동시에 삭제 (레이트리밋은 discord.py 가 버킷 단위로 맞춰 줌)."""
+    results = await asyncio.gather(*(ch.delete() for ch in channels), return_exceptions=True)
+    for ch, r in zip(channels, results):
+        if isinstance(r, Exception) and not isinstance(r, discord.NotFound):
+            print("채널 삭제 실패:", ch, r)
+
+async def restore_team_trigger(category: Optional[discord.CategoryChannel]):
+    if category is None or any(vch.name == TEAM_TRIGGER_NAME for vch in category.voice_channels):
+        return
+    try:
+        await category.create_voice_channel(TEAM_TRIGGER_NAME)
+    except Exception:
+        pass
+
+async def open_temp_channel(member: discord.Member, category: Optional[discord.CategoryChannel]):
+    new_channel = await member.guild.create_voice_channel(f"{TEMP_CHANNEL_PREFIX}{member.display_name}", category=category)
+    temp_channels.add(new_channel.id)
+    row = (new_channel.id, member.guild.id, "temp", None, category.id if category else None, int(time.time()))
+    await asyncio.gather(member.move_to(new_channel), points_db.write(save_managed_channels, [row]))
 
+async def maybe_cleanup_temp_channel(channel: discord.VoiceChannel):
+    if channel.id not in temp_channels or len(channel.members) != 0:
+        return
+    temp_channels.discard(channel.id)
+    await asyncio.gather(delete_channels([channel]), points_db.write(delete_managed_channels, [channel.id]))
+
+async def reconcile_managed_channels():
+    """
+    저장된 채널 상태를 실제 길드 채널과 맞춤 (on_ready).
+    - 사라진 채널은 기록에서 제거, 비어 있는 세트/임시 채널은 한꺼번에 삭제
+    - 사람이 있는 세트/임시 채널은 다시 추적
+    - 기록이 없는 예전 팀 세트(팀 카테고리 안의 1~4팀)도 같은 규칙으로 정리/추적
+    """
+    rows = await points_db.read(load_managed_channels)
+    groups: dict[int, list] = defaultdict(list)
+    temps = []
+    for r in rows:
+        (groups[r["group_key"]].append(r) if r["kind"] == "team" else temps.append(r))
+
+    to_delete, stale_ids, new_rows = [], [], []
+    restore_categories: dict[int, discord.CategoryChannel] = {}
+    now = int(time.time())
+
+    for r in temps:
+        guild = bot.get_guild(r["guild_id"])
+        ch = guild.get_channel(r["channel_id"]) if guild else None
+        if not isinstance(ch, discord.VoiceChannel):
+            if guild:  # 길드가 안 보이는 경우(다른 샤드 등)는 기록 유지
+                stale_ids.append(r["channel_id"])
+        elif ch.members:
+            temp_channels.add(ch.id)
+        else:
+            to_delete.append(ch); stale_ids.append(ch.id)
+
+    tracked = set()
+    for group_key, members in groups.items():
+        guild = bot.get_guild(members[0]["guild_id"])
+        if guild is None:
+            continue
+        channels = [guild.get_channel(r["channel_id"]) for r in members]
+        alive = [ch for ch in channels if isinstance(ch, discord.VoiceChannel)]
+        tracked.update(r["channel_id"] for r in members)
+        _forget_team_set(group_key)
+        if alive and any(ch.members for ch in alive):
+            _track_team_set(members[0]["category_id"], [ch.id for ch in alive])
+            stale_ids.extend(r["channel_id"] for r in members if r["channel_id"] not in {c.id for c in alive})
+            continue
+        to_delete.extend(alive); stale_ids.extend(r["channel_id"] for r in members)
+        cat = guild.get_channel(members[0]["category_id"])
+        if isinstance(cat, discord.CategoryChannel):
+            restore_categories[cat.id] = cat
+
+    # 기록 없는 예전 팀 세트
+    for guild in bot.guilds:
+        for cat in guild.categories:
+            if normalize_name(cat.name) not in TEAM_PARENT_CATEGORIES or cat.id in category_group:
+                continue
+            orphans = [ch for ch in cat.voice_channels if ch.name in TEAM_SET_NAMES and ch.id not in tracked]
+            if not orphans:
+                continue
+            if any(ch.members for ch in orphans):
+                ch_ids = [ch.id for ch in sorted(orphans, key=lambda c: c.name)]
+                key = _track_team_set(cat.id, ch_ids)
+                new_rows.extend((cid, guild.id, "team", key, cat.id, now) for cid in ch_ids)
+            else:
+                to_delete.extend(orphans)
+                restore_categories[cat.id] = cat
+
+    if stale_ids or new_rows:
+        def _apply(db):
+            delete_managed_channels(db, stale_ids)
+            save_managed_channels(db, new_rows)
+        await points_db.write(_apply)
+    if to_delete:
+        print(f"정리: 빈 임시/팀 채널 {len(to_delete)}개 삭제")
+        await delete_channels(to_delete)
+    await asyncio.gather(*(restore_team_trigger(cat) for cat in restore_categories.values()))
 
 # ================ 포인트 보조 루프 (5분 간격) ================
+def accrue_guild_tick(db, guild_id: int, in_voice: set[int], now: int) -> list[tuple[int, int, int]]:
+    """
+    길드 1개 분량의 주기 정산을 집합 단위 SQL로 처리 (DB 스레드에서 실행).
+    유저별 grant_points_for_session 과 같은 블록/나머지 계산을 UPDATE 한 번으로 수행.
+    return: [(user_id, 지급 포인트, 총 포인트)] — 지급된 사람만
+    """
+    params = {"gid": guild_id, "now": now, "block": BLOCK_SECONDS, "ppb": POINTS_PER_BLOCK}
+
+    # 아직 보이스에 남아있는 유저 (last_join 갱신 대상)
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS accrual_voice(user_id INTEGER PRIMARY KEY)")
+    db.execute("DELETE FROM temp.accrual_voice")
+    db.executemany("INSERT INTO temp.accrual_voice(user_id) VALUES (?)", [(uid,) for uid in in_voice])
+
+    # ensure_user 와 동일하게 afk_watch 행 보장
+    db.execute("""
+        INSERT OR IGNORE INTO afk_watch(guild_id, user_id, last_active)
+        SELECT guild_id, user_id, :now FROM users
+        WHERE guild_id=:gid AND last_join IS NOT NULL
+    """, params)
+
+    # 로그용 지급 내역 (UPDATE 전 값 기준으로 계산)
+    rows = db.execute("""
+        SELECT user_id, awarded, points + awarded AS new_total FROM (
+            SELECT user_id, points,
+                   ((carry_sec + MAX(0, :now - last_join)) / :block) * :ppb AS awarded
+            FROM users
+            WHERE guild_id=:gid AND last_join IS NOT NULL
+        ) WHERE awarded > 0
+    """, params).fetchall()
+
+    # SET 의 모든 식은 갱신 전 행 값을 기준으로 평가됨
+    db.execute("""
+        UPDATE users SET
+            points    = points + ((carry_sec + MAX(0, :now - last_join)) / :block) * :ppb,
+            carry_sec = (carry_sec + MAX(0, :now - last_join)) % :block,
+            last_join = CASE WHEN user_id IN (SELECT user_id FROM temp.accrual_voice) THEN :now ELSE NULL END
+        WHERE guild_id=:gid AND last_join IS NOT NULL
+    """, params)
+    ledger_append(db, [(guild_id, r["user_id"], r["awarded"], r["new_total"], "voice", None, now) for r in rows])
+    return [(r["user_id"], r["awarded"], r["new_total"]) for r in rows]
+
 @tasks.loop(minutes=5)
+@metrics.timed("bot_loop_tick_seconds", loop="accrual")
 async def accrual_loop():
-    now = int(dt.datetime.utcnow().timestamp())
-    awarded_msgs = []
-
-    with closing(get_db()) as db, db:
-        for guild in bot.guilds:
-            afk_id = get_afk_channel_id(db, guild.id)
-            in_voice = set()
-            for vc in guild.voice_channels:
-                if afk_id and vc.id == afk_id:
+    await accrual_tick(local_guilds(), int(dt.datetime.utcnow().timestamp()))
+
+async def accrual_tick(guilds, now: int):
+    """accrual_loop 1회분 (벤치마크에서 가짜 길드로 직접 호출)."""
+    for guild in guilds:
+        afk_id = get_afk_channel_id(guild.id)
+        in_voice = set()
+        for vc in guild.voice_channels:
+            if afk_id and vc.id == afk_id:
+                continue
+            for m in vc.members:
+                if m.bot:
                     continue
-                for m in vc.members:
-                    if m.bot:
-                        continue
-                    in_voice.add(m.id)
+                in_voice.add(m.id)
 
-                    # ✅ 여기가 핵심: 음성채널에 있고 뮤트/이어폰 아니면 활동으로 갱신
-                    try:
-                        vs = m.voice  # discord.VoiceState
-                        if vs and not vs.self_mute and not vs.self_deaf:
-                            mark_active(db, guild.id, m.id, now)
-                    except Exception:
-                        pass
-
-            rows = db.execute("""
-                SELECT user_id, last_join FROM users
-                WHERE guild_id=? AND last_join IS NOT NULL
-            """, (guild.id,)).fetchall()
-
-            for r in rows:
-                uid = r["user_id"]
-                elapsed = now - int(r["last_join"])
-                awarded, new_total = grant_points_for_session(db, guild.id, uid, elapsed)
-
-                if uid not in in_voice:
-                    db.execute("UPDATE users SET last_join=NULL WHERE guild_id=? AND user_id=?", (guild.id, uid))
-                else:
-                    db.execute("UPDATE users SET last_join=? WHERE guild_id=? AND user_id=?", (now, guild.id, uid))
+                # ✅ 여기가 핵심: 음성채널에 있고 뮤트/이어폰 아니면 활동으로 갱신
+                vs = m.voice  # discord.VoiceState
+                if vs and not vs.self_mute and not vs.self_deaf:
+                    mark_active(guild.id, m.id, now)
 
-                if awarded > 0:
-                    awarded_msgs.append((guild, uid, awarded, new_total))
+        rows = await points_db.write(accrue_guild_tick, guild.id, in_voice, now)
+        on_points_changed(guild.id, [(uid, new_total) for uid, _, new_total in rows])
 
-    for guild, uid, awarded, new_total in awarded_msgs:
+        # 길드별 한 번에 묶어서 큐로 넘김 (전송은 award_log 가 백그라운드로)
         ch = get_log_channel_obj(guild)
-        if not ch:
+        if not ch or not rows:
             continue
-        member = guild.get_member(uid)
-        if not member:
-            continue
-        blocks  = awarded // POINTS_PER_BLOCK
-        minutes = blocks * (BLOCK_SECONDS // 60)
-        await ch.send(
-            f"{str(member)} 님이 **{minutes}분 활동**으로 **{awarded}p** 획득! (총 {new_total}p)"
-        )
-
-# ================ AFK 감시 루프 (1분 간격) ================
-@tasks.loop(minutes=1)
-async def afk_guard():
-    now = int(dt.datetime.utcnow().timestamp())
-    with closing(get_db()) as db, db:
-        for guild in bot.guilds:
-            afk_id = get_afk_channel_id(db, guild.id)
-            if not afk_id:
-                continue
+        lines = []
+        for uid, awarded, new_total in rows:
+            member = guild.get_member(uid)
+            if member:
+                lines.append("• " + award_line(str(member), awarded, new_total))
+        if lines:
+            award_log.post(ch, [f"⏱️ **포인트 적립** ({len(lines)}명)"] + lines)
+
+# ================ AFK 스케줄러 (마감시각 기반) ================
+class AfkScheduler:
+    """
+    멤버별 AFK 이동 마감시각(deadline) 최소 힙.
+    말할 수 있는 상태(뮤트/이어폰 아님)면 계속 활동으로 갱신되므로, 뮤트/이어폰 중인 멤버만 등록.
+    deadline = min(마지막 활동 + AFK_SECONDS, 뮤트 시작 + MUTE_GRACE_SECONDS)
+    힙에서 지우지 않고 _deadline 과 다른 항목은 꺼낼 때 버림(lazy invalidation).
+    이동에 실패하면 뮤트 시작 시각은 그대로 두고 backoff() 로 재시도 시각까지 마감을 미룸.
+    """
 
-            afk_channel = guild.get_channel(afk_id)
-            if not isinstance(afk_channel, discord.VoiceChannel):
-                continue
+    def __init__(self):
+        self.mute_since: dict[tuple[int, int], int] = {}  # 뮤트/이어폰 시작 시각
+        self._retry: dict[tuple[int, int], tuple[int, int]] = {}  # 이동 실패 (횟수, 다음 시도 시각)
+        self._deadline: dict[tuple[int, int], int] = {}
+        self._heap: list[tuple[int, int, int]] = []
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def update(self, guild_id: int, user_id: int, muted: bool, now: int):
+        key = (guild_id, user_id)
+        if not muted:
+            self.discard(guild_id, user_id)
+            return
+        since = self.mute_since.setdefault(key, now)
+        last_active = activity.get(guild_id, user_id, now)
+        deadline = min(last_active + AFK_SECONDS, since + MUTE_GRACE_SECONDS)
+        retry = self._retry.get(key)
+        if retry:  # 이동 실패 후에는 재시도 시각 전에 다시 깨어나지 않음
+            deadline = max(deadline, retry[1])
+        self._set(key, deadline)
+
+    def on_activity(self, guild_id: int, user_id: int, now: int):
+        # 뮤트 상태로 채팅만 치는 경우: 비활동 마감만 뒤로 밀림
+        if (guild_id, user_id) in self._deadline:
+            self.update(guild_id, user_id, True, now)
+
+    def discard(self, guild_id: int, user_id: int):
+        key = (guild_id, user_id)
+        self.mute_since.pop(key, None)
+        self._retry.pop(key, None)
+        self._deadline.pop(key, None)
+
+    def backoff(self, guild_id: int, user_id: int, now: int):
+        """이동 실패: 추적은 유지하고 다음 시도를 AFK_RETRY_SECONDS × 2^(실패-1) 뒤로 (최대 AFK_RETRY_MAX_SECONDS)."""
+        key = (guild_id, user_id)
+        if key not in self.mute_since:
+            return
+        fails = self._retry.get(key, (0, 0))[0] + 1
+        at = now + min(AFK_RETRY_MAX_SECONDS, AFK_RETRY_SECONDS * 2 ** (fails - 1))
+        self._retry[key] = (fails, at)
+        self._set(key, at)
 
-            for vc in guild.voice_channels:
-                if vc.id == afk_id:
-                    continue
+    def is_due(self, guild_id: int, user_id: int, now: int) -> bool:
+        d = self._deadline.get((guild_id, user_id))
+        return d is not None and d <= now
 
-                for m in vc.members:
-                    if m.bot:
-                        continue
+    def tracked(self) -> set[tuple[int, int]]:
+        return set(self._deadline)
 
-                    # 최근 활동시각
-                    row = db.execute(
-                        "SELECT last_active FROM afk_watch WHERE guild_id=? AND user_id=?",
-                        (guild.id, m.id)
-                    ).fetchone()
-                    last_active = row["last_active"] if row else now
-                    inactive = (now - last_active) >= AFK_SECONDS
-
-                    # 뮤트/이어폰 상태 지속 시간 디바운스
-                    key = (guild.id, m.id)
-                    currently_muted = (m.voice.self_mute or m.voice.self_deaf)
-
-                    if currently_muted:
-                        # 시작 기록 없으면 지금부터 카운트
-                        if key not in mute_since:
-                            mute_since[key] = now
-                        muted_long = (now - mute_since[key]) >= MUTE_GRACE_SECONDS
-                    else:
-                        # 뮤트 해제되면 카운터 제거
-                        if key in mute_since:
-                            mute_since.pop(key, None)
-                        muted_long = False
-
-                    # 이동 조건: 오랜 비활동 or (뮤트/이어폰이 일정 시간 이상 지속)
-                    if inactive or muted_long:
-                        try:
-                            await m.move_to(afk_channel, reason="비활동/뮤트 지속으로 AFK 이동")
-                            # 이동했으면 뮤트 타이머도 초기화
-                            mute_since.pop(key, None)
-                        except discord.Forbidden:
-                            pass
-                        except Exception:
-                            pass
+    def _set(self, key: tuple[int, int], deadline: int):
+        if self._deadline.get(key) == deadline:
+            return
+        self._deadline[key] = deadline
+        heapq.heappush(self._heap, (deadline, *key))
+        # 버려진 항목이 너무 쌓이면 힙 재구성
+        if len(self._heap) > 2 * len(self._deadline) + 64:
+            self._heap = [(d, g, u) for (g, u), d in self._deadline.items()]
+            heapq.heapify(self._heap)
+        if self._heap[0][0] == deadline:
+            self._wake.set()
+
+    def _peek(self) -> Optional[int]:
+        while self._heap:
+            d, g, u = self._heap[0]
+            if self._deadline.get((g, u)) == d:
+                return d
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now: int) -> list[tuple[int, int]]:
+        due = []
+        while (d := self._peek()) is not None and d <= now:
+            _, g, u = heapq.heappop(self._heap)
+            del self._deadline[(g, u)]
+            due.append((g, u))
+        return due
+
+    async def _run(self, on_due):
+        while True:
+            self._wake.clear()
+            now = int(dt.datetime.utcnow().timestamp())
+            for g, u in self.pop_due(now):
+                try:
+                    await on_due(g, u, now)
+                except Exception as e:
+                    print("AFK 처리 오류:", e)
+            nxt = self._peek()
+            timeout = None if nxt is None else max(0, nxt - int(dt.datetime.utcnow().timestamp()))
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, on_due):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(on_due))
+
+
+afk_sched = AfkScheduler()
+
+def afk_track(guild_id: int, user_id: int, voice_state, now: int):
+    """보이스 상태 기준으로 AFK 마감 갱신. 보이스에 없거나 이미 AFK 채널이면 추적 해제."""
+    if not voice_state or not voice_state.channel or voice_state.channel.id == get_afk_channel_id(guild_id):
+        afk_sched.discard(guild_id, user_id)
+        return
+    afk_sched.update(guild_id, user_id, bool(voice_state.self_mute or voice_state.self_deaf), now)
+
+async def afk_expire(guild_id: int, user_id: int, now: int):
+    """마감 도달: 현재 상태로 다시 확인 후 AFK 채널로 이동."""
+    guild = bot.get_guild(guild_id)
+    member = guild.get_member(user_id) if guild else None
+    if not member or not member.voice or not member.voice.channel:
+        afk_sched.discard(guild_id, user_id)
+        return
+
+    # 이벤트를 놓쳤을 수도 있으니 현재 상태로 재계산(AFK 채널에 있으면 해제), 아직 안 됐으면 재등록만
+    afk_track(guild_id, user_id, member.voice, now)
+    if not afk_sched.is_due(guild_id, user_id, now):
+        return
+    afk_id = get_afk_channel_id(guild_id)
+    afk_channel = guild.get_channel(afk_id) if afk_id else None
+    if not isinstance(afk_channel, discord.VoiceChannel):
+        # AFK 채널 미설정/삭제: 뮤트 시작 시각은 유지, 채널이 설정되면 재시도 때 이동
+        afk_sched.backoff(guild_id, user_id, now)
+        return
+    try:
+        await member.move_to(afk_channel, reason="비활동/뮤트 지속으로 AFK 이동")
+    except Exception as e:
+        print("AFK 이동 실패:", guild_id, user_id, e)
+        afk_sched.backoff(guild_id, user_id, now)
+        return
+    # 이동했으면 뮤트 타이머도 초기화
+    afk_sched.discard(guild_id, user_id)
+
+# ================ AFK 안전망 루프 (10분 간격) ================
+@tasks.loop(minutes=AFK_RECONCILE_MINUTES)
+@metrics.timed("bot_loop_tick_seconds", loop="afk_guard")
+async def afk_guard():
+    """이벤트 누락 대비: 보이스 멤버 전체로 스케줄을 다시 맞추고 스케줄러 기동 확인."""
+    afk_reconcile(local_guilds(), int(dt.datetime.utcnow().timestamp()))
+    afk_sched.start(afk_expire)
+
+def afk_reconcile(guilds, now: int):
+    """afk_guard 1회분: 보이스 멤버 전체로 AFK 스케줄 재설정."""
+    live = set()
+    for guild in guilds:
+        afk_id = get_afk_channel_id(guild.id)
+        for vc in guild.voice_channels:
+            if vc.id == afk_id:  # 이미 AFK 채널에 있는 멤버는 추적하지 않음
+                continue
+            for m in vc.members:
+                if m.bot:
+                    continue
+                live.add((guild.id, m.id))
+                afk_track(guild.id, m.id, m.voice, now)
+    for g, u in afk_sched.tracked() - live:
+        afk_sched.discard(g, u)
 
 # ================ Slash 명령 (포인트/상점/AFK) ================
 @bot.command(name="포인트")
 async def points_prefix_kr(ctx, member: discord.Member = None):
     member = member or ctx.author
-    with closing(get_db()) as db:
-        row = db.execute(
-            "SELECT points FROM users WHERE guild_id=? AND user_id=?",
-            (ctx.guild.id, member.id)
-        ).fetchone()
-    pts = row["points"] if row else 0
+    pts = await balances.get(ctx.guild.id, member.id)
     await ctx.send(f"💰 {member.display_name} 님의 포인트: **{pts}p**")
 
 @bot.command(name="points")
@@ -602,45 +2118,212 @@ async def points_prefix_en(ctx, member: discord.Member = None):
     await points_prefix_kr(ctx, member)
 
 @bot.tree.command(name="leaderboard", description="포인트 리더보드 Top 10")
-async def leaderboard_cmd(interaction: discord.Interaction):
-    with closing(get_db()) as db:
-        rows = db.execute("SELECT user_id, points FROM users WHERE guild_id=? ORDER BY points DESC LIMIT 10",
-                          (interaction.guild.id,)).fetchall()
-    if not rows:
-        await interaction.response.send_message("아직 포인트가 없습니다.")
+async def leaderboard_cmd(interaction: discord.Interaction, page: int = 1):
+    guild = interaction.guild
+    page = max(1, page)
+    await points_board.ensure(guild.id)
+    def render(rows):
+        lines = [f"{rank}. {member_name(guild, uid)} — {pts}p" for rank, uid, pts in rows]
+        return f"🏆 **리더보드** ({page}쪽)\n" + "\n".join(lines)
+
+    text = points_board.page_text(guild.id, page - 1, render)
+    await interaction.response.send_message(text or "아직 포인트가 없습니다.")
+
+@bot.tree.command(name="rank", description="내 포인트 순위와 주변 순위 보기")
+async def rank_cmd(interaction: discord.Interaction, member: Optional[discord.Member] = None):
+    guild, member = interaction.guild, member or interaction.user
+    await points_board.ensure(guild.id)
+    rank = points_board.rank(guild.id, member.id)
+    if rank is None:
+        await interaction.response.send_message(f"{member.display_name} 님은 아직 포인트가 없습니다.")
         return
-    lines = []
-    for i, r in enumerate(rows, start=1):
-        mem = interaction.guild.get_member(r["user_id"])
-        name = mem.display_name if mem else str(r["user_id"])
-        lines.append(f"{i}. {name} — {r['points']}p")
-    await interaction.response.send_message("🏆 **리더보드**\n" + "\n".join(lines))
+    lines = [
+        f"{'▶ ' if uid == member.id else ''}{r}. {member_name(guild, uid)} — {pts}p"
+        for r, uid, pts in points_board.around(guild.id, member.id)
+    ]
+    await interaction.response.send_message(
+        f"📈 **{member.display_name}** 님은 {points_board.size(guild.id)}명 중 **{rank}위**\n" + "\n".join(lines)
+    )
 
 @bot.tree.command(name="set_afk_channel", description="잠수방(포인트 제외 & 자동이동) 설정/해제")
 @app_commands.default_permissions(administrator=True)
 async def set_afk_channel_cmd(interaction: discord.Interaction, channel: Optional[discord.VoiceChannel]):
-    with closing(get_db()) as db, db:
-        set_afk_channel_id(db, interaction.guild.id, channel.id if channel else None)
+    await guild_settings.set_afk(interaction.guild.id, channel.id if channel else None)
     await interaction.response.send_message(
         f"⛔ 잠수방: **{channel.name}**" if channel else "잠수방 설정이 해제되었습니다."
     )
 
+# ---- 구매 엔진 (한정 수량 동시 구매 대비) ----
+PURCHASE_BATCH_MAX = 200  # 쓰기 트랜잭션 한 번에 처리할 최대 구매 요청 수
+PURCHASE_RECHECK_SECONDS = 5  # 메모리상 품절인 아이템의 DB 재고 재확인 간격 (아이템당)
+
+def settle_purchases(db, reqs, now: int):
+    """
+    구매 요청 묶음을 한 트랜잭션으로 처리 (DB 스레드). reqs: [(guild_id, user_id, item_id)]
+    요청마다 조건부 UPDATE 로 재고 확인+차감, 포인트 확인+차감 → 동시에 몰려도 초과 판매/마이너스 잔액 없음.
+    return: [(상태, 잔액)] — 상태: ok | no_points | sold_out
+    """
+    out, purchases, ledger = [], [], []
+    for gid, uid, item_id in reqs:
+        ensure_user(db, gid, uid)
+        item = db.execute("UPDATE shop SET stock = stock - 1 WHERE id=? AND guild_id=? AND (stock IS NULL OR stock > 0) "
+                          "RETURNING price, stock", (item_id, gid)).fetchone()
+        if item is None:
+            out.append(("sold_out", None))
+            continue
+        price = item["price"]
+        row = db.execute("UPDATE users SET points = points - ? WHERE guild_id=? AND user_id=? AND points >= ? "
+                         "RETURNING points", (price, gid, uid, price)).fetchone()
+        if row is None:
+            if item["stock"] is not None:  # 재고 되돌림 (같은 트랜잭션이라 밖에서는 안 보임)
+                db.execute("UPDATE shop SET stock = stock + 1 WHERE id=?", (item_id,))
+            out.append(("no_points", get_user_points(db, gid, uid)))
+            continue
+        purchases.append((gid, uid, item_id, now))
+        if price:
+            ledger.append((gid, uid, -price, row["points"], f"buy:{item_id}", uid, now))
+        out.append(("ok", row["points"]))
+    db.executemany("INSERT INTO purchases(guild_id, user_id, item_id, ts) VALUES(?, ?, ?, ?)", purchases)
+    ledger_append(db, ledger)
+    return out
+
+class PurchaseEngine:
+    """
+    /buy 처리.
+    - 재고 있는 아이템은 남은 수량을 메모리에 두고 먼저 깎음: 품절 뒤 몰리는 요청은 DB 를 거치지 않고 바로 거절
+    - 통과한 요청은 큐에 모았다가 쓰기 트랜잭션 한 번에 처리 (앞 묶음을 쓰는 동안 다음 묶음이 쌓임)
+    - 최종 판정은 DB 의 조건부 UPDATE: 메모리 수량이 어긋나도(다른 프로세스 등) 초과 판매는 없음
+    - 예약한 메모리 수량은 _flush 가 DB 결과대로 맞춤 (요청이 취소돼도 DB 에 보낸 건 결과 기준, 안 보낸 건 반납)
+    - 메모리상 품절이면 품절 응답 전에 DB 재고를 다시 읽음 (재입고/다른 프로세스 반영, 아이템당 5초에 한 번)
+    """
+
+    def __init__(self, db: Optional[PointsDB] = None):
+        self._db = db  # None 이면 전역 points_db
+        self._items: dict[int, sqlite3.Row] = {}
+        self._stock: dict[int, int] = {}  # item_id -> 메모리상 남은 수량 (무제한은 없음)
+        self._loading: dict[int, asyncio.Future] = {}
+        self._rechecked: dict[int, float] = {}  # item_id -> 마지막 DB 재고 재확인 (monotonic)
+        self._queue: list[tuple[int, int, int, bool, asyncio.Future]] = []  # (길드, 유저, 아이템, 수량 예약 여부, 결과)
+        self._flusher: Optional[asyncio.Task] = None
+        self.batches = 0
+
+    @property
+    def db(self) -> PointsDB:
+        return self._db or points_db
+
+    async def _item(self, item_id: int, refresh: bool = False):
+        if not refresh and item_id in self._items:
+            return self._items[item_id]
+        fut = self._loading.get(item_id)
+        if fut is not None:
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        self._loading[item_id] = fut
+        try:
+            item = await self.db.read(lambda db: db.execute(
+                "SELECT id, guild_id, name, price, stock FROM shop WHERE id=?", (item_id,)).fetchone())
+            if item is None:  # 없는 번호는 나중에 추가될 수 있으니 캐시 안 함
+                self._items.pop(item_id, None)
+                self._stock.pop(item_id, None)
+            else:
+                self._items[item_id] = item
+                if item["stock"] is None:
+                    self._stock.pop(item_id, None)
+                else:
+                    self._stock[item_id] = item["stock"]
+            fut.set_result(item)
+            return item
+        except BaseException as e:
+            fut.set_exception(e)
+            fut.exception()
+            raise
+        finally:
+            self._loading.pop(item_id, None)
+
+    async def buy(self, guild_id: int, user_id: int, item_id: int):
+        """return: (상태, 아이템, 잔액) — 상태: ok | no_item | no_points | sold_out"""
+        item = await self._item(item_id)
+        if item is not None and self._stock.get(item_id, 1) <= 0 and self._recheck_due(item_id):
+            item = await self._item(item_id, refresh=True)
+        if item is None or item["guild_id"] != guild_id:
+            return "no_item", None, 0
+        limited = item_id in self._stock
+        if limited:
+            if self._stock[item_id] <= 0:
+                return "sold_out", item, None
+            self._stock[item_id] -= 1
+        fut = asyncio.get_running_loop().create_future()
+        self._queue.append((guild_id, user_id, item_id, limited, fut))
+        if self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush())
+        # 여기서 취소되면 fut 도 취소됨 → 아직 안 보냈으면 _flush 가 건너뛰고, 이미 보냈으면 결과대로 맞춤
+        status, balance = await fut
+        return status, item, balance
+
+    def _recheck_due(self, item_id: int) -> bool:
+        now = time.monotonic()
+        if now - self._rechecked.get(item_id, -PURCHASE_RECHECK_SECONDS) < PURCHASE_RECHECK_SECONDS:
+            return False
+        self._rechecked[item_id] = now
+        return True
+
+    def _settle_stock(self, item_id: int, limited: bool, status: Optional[str]):
+        """예약한 메모리 수량을 결과에 맞춤. status None: DB 에 반영 안 됨(취소/쓰기 실패)"""
+        if not limited or status == "ok" or item_id not in self._stock:
+            return
+        # DB 가 품절이라면 메모리 수량이 틀렸던 것 → 0 으로 맞춤, 그 외는 예약분 반납
+        self._stock[item_id] = 0 if status == "sold_out" else self._stock[item_id] + 1
+
+    async def _flush(self):
+        try:
+            while self._queue:
+                batch, self._queue = self._queue[:PURCHASE_BATCH_MAX], self._queue[PURCHASE_BATCH_MAX:]
+                for _, _, item_id, limited, fut in batch:
+                    if fut.cancelled():  # 보내기 전에 취소된 요청은 DB 에 반영하지 않음
+                        self._settle_stock(item_id, limited, None)
+                batch = [r for r in batch if not r[4].cancelled()]
+                if not batch:
+                    continue
+                try:
+                    results = await self.db.write(settle_purchases, [r[:3] for r in batch], int(time.time()))
+                except Exception as e:
+                    for _, _, item_id, limited, fut in batch:
+                        self._settle_stock(item_id, limited, None)
+                        if not fut.done():
+                            fut.set_exception(e)
+                    continue
+                self.batches += 1
+                for (_, _, item_id, limited, fut), result in zip(batch, results):
+                    self._settle_stock(item_id, limited, result[0])
+                    if not fut.done():
+                        fut.set_result(result)
+        finally:
+            self._flusher = None
+
+    def depth(self) -> int:
+        return len(self._queue)
+
+
+purchase_engine = PurchaseEngine()
+
 @bot.tree.command(name="shop_add", description="상점 아이템 추가 (관리자)")
 @app_commands.default_permissions(administrator=True)
 async def shop_add_cmd(interaction: discord.Interaction, name: str, price: int, stock: Optional[int] = None):
     if price < 0:
         await interaction.response.send_message("가격은 0 이상이어야 합니다.", ephemeral=True)
         return
-    with closing(get_db()) as db, db:
-        db.execute("INSERT INTO shop(guild_id, name, price, stock) VALUES(?, ?, ?, ?)",
-                   (interaction.guild.id, name, price, stock))
+    await points_db.write(
+        lambda db: db.execute("INSERT INTO shop(guild_id, name, price, stock) VALUES(?, ?, ?, ?)",
+                              (interaction.guild.id, name, price, stock))
+    )
     await interaction.response.send_message(f"🛒 추가: [{name}] — {price}p (재고: {'무제한' if stock is None else stock})")
 
 @bot.tree.command(name="shop", description="상점 목록 보기")
 async def shop_cmd(interaction: discord.Interaction):
-    with closing(get_db()) as db:
-        rows = db.execute("SELECT id, name, price, stock FROM shop WHERE guild_id=? ORDER BY id ASC",
-                          (interaction.guild.id,)).fetchall()
+    rows = await points_db.read(
+        lambda db: db.execute("SELECT id, name, price, stock FROM shop WHERE guild_id=? ORDER BY id ASC",
+                              (interaction.guild.id,)).fetchall()
+    )
     if not rows:
         await interaction.response.send_message("상점에 등록된 아이템이 없습니다.")
         return
@@ -650,36 +2333,37 @@ async def shop_cmd(interaction: discord.Interaction):
 @bot.tree.command(name="buy", description="상점 아이템 구매")
 async def buy_cmd(interaction: discord.Interaction, item_id: int):
     uid, gid = interaction.user.id, interaction.guild.id
-    with closing(get_db()) as db, db:
-        ensure_user(db, gid, uid)
-        item = db.execute("SELECT id, name, price, stock FROM shop WHERE guild_id=? AND id=?",
-                          (gid, item_id)).fetchone()
-        if not item:
-            await interaction.response.send_message("해당 ID의 아이템이 없습니다.", ephemeral=True)
-            return
-        user = db.execute("SELECT points FROM users WHERE guild_id=? AND user_id=?", (gid, uid)).fetchone()
-        pts = user["points"] if user else 0
-        if pts < item["price"]:
-            await interaction.response.send_message(f"포인트가 부족합니다. (보유 {pts}p / 필요 {item['price']}p)", ephemeral=True)
-            return
-        if item["stock"] is not None and item["stock"] <= 0:
-            await interaction.response.send_message("해당 아이템은 품절입니다.", ephemeral=True)
-            return
-        db.execute("UPDATE users SET points = points - ? WHERE guild_id=? AND user_id=?",
-                   (item["price"], gid, uid))
-        if item["stock"] is not None:
-            db.execute("UPDATE shop SET stock = stock - 1 WHERE id=?", (item["id"],))
-        db.execute("INSERT INTO purchases(guild_id, user_id, item_id, ts) VALUES(?, ?, ?, ?)",
-                   (gid, uid, item["id"], int(dt.datetime.utcnow().timestamp())))
-    await interaction.response.send_message(f"✅ 구매 완료: **{item['name']}** — {item['price']}p 차감")
+    # 한정 판매 때 요청이 몰려도 3초 응답 제한에 걸리지 않게 먼저 응답 예약 (구매 완료는 예전처럼 공개)
+    await interaction.response.defer(thinking=True)
+
+    async def reply(text: str, keep: bool = False):
+        msg = await interaction.followup.send(text, wait=True)
+        if not keep:  # 실패 안내는 잠깐 보여 주고 지움 (몰릴 때 채널 도배 방지)
+            await msg.delete(delay=5)
+
+    try:
+        status, item, pts = await purchase_engine.buy(gid, uid, item_id)
+    except Exception as e:
+        print("구매 처리 오류:", e)
+        await reply("⚠️ 구매 처리 중 오류가 발생했습니다. 잠시 후 다시 시도해 주세요.")
+        return
+    if status == "no_item":
+        await reply("해당 ID의 아이템이 없습니다.")
+    elif status == "no_points":
+        await reply(f"포인트가 부족합니다. (보유 {pts}p / 필요 {item['price']}p)")
+    elif status == "sold_out":
+        await reply("해당 아이템은 품절입니다.")
+    else:
+        on_points_changed(gid, [(uid, pts)])
+        await reply(f"✅ 구매 완료: **{item['name']}** — {item['price']}p 차감", keep=True)
 
 @bot.tree.command(name="give", description="특정 유저에게 포인트 지급/차감 (관리자)")
 @app_commands.default_permissions(administrator=True)
 async def give_cmd(interaction: discord.Interaction, member: discord.Member, amount: int):
-    with closing(get_db()) as db, db:
-        ensure_user(db, interaction.guild.id, member.id)
-        db.execute("UPDATE users SET points=points+? WHERE guild_id=? AND user_id=?",
-                   (amount, interaction.guild.id, member.id))
+    gid = interaction.guild.id
+
+    total = await points_db.write(change_points, gid, member.id, "give", interaction.user.id, amount)
+    on_points_changed(gid, [(member.id, total)])
     await interaction.response.send_message(f"{member.display_name} 님에게 {amount:+}p 적용됨")
 
 # ================== 너의 기존 명령들 그대로 유지 ==================
@@ -703,28 +2387,36 @@ async def question_help(ctx):
 
 @bot.command()
 async def setlog(ctx, channel: discord.TextChannel):
-    conn = get_db()
-    with conn:
-        conn.execute(
-            "INSERT INTO guild_settings(guild_id, log_channel_id) VALUES(?, ?) "
-            "ON CONFLICT(guild_id) DO UPDATE SET log_channel_id=excluded.log_channel_id",
-            (ctx.guild.id, channel.id)
-        )
+    await guild_settings.set_log(ctx.guild.id, channel.id)
     await ctx.send(f"📜 로그 채널이 {channel.mention} 로 설정되었습니다!")
 
 @bot.command()
 @commands.has_permissions(administrator=True)
 async def set_afk(ctx, channel: discord.VoiceChannel):
     """AFK 채널 ID를 DB에 저장"""
-    with closing(get_db()) as db, db:
-        db.execute("""
-            INSERT INTO guild_settings (guild_id, afk_channel_id)
-            VALUES (?, ?)
-            ON CONFLICT(guild_id) DO UPDATE SET afk_channel_id=excluded.afk_channel_id
-        """, (ctx.guild.id, channel.id))
+    await guild_settings.set_afk(ctx.guild.id, channel.id)
     await ctx.send(f"✅ AFK 채널이 `{channel.name}`(ID: {channel.id})로 설정되었습니다.")
 
 
+@bot.event
+async def on_guild_channel_delete(channel):
+    # 설정된 AFK/로그 채널이 지워지면 설정도 해제
+    gid = channel.guild.id
+    if guild_settings.afk.get(gid) == channel.id:
+        await guild_settings.set_afk(gid, None)
+    if guild_settings.log.get(gid) == channel.id:
+        await guild_settings.set_log(gid, None)
+    # 봇이 만든 임시/팀 채널을 누가 직접 지운 경우 추적 해제
+    if channel.id in temp_channels:
+        temp_channels.discard(channel.id)
+        await points_db.write(delete_managed_channels, [channel.id])
+    elif channel.id in channel_to_group:
+        group_key = channel_to_group.pop(channel.id)
+        team_groups[group_key] = [cid for cid in team_groups.get(group_key, []) if cid != channel.id]
+        if not team_groups[group_key]:
+            _forget_team_set(group_key)
+        await points_db.write(delete_managed_channels, [channel.id])
+
 @bot.event 
 async def on_member_join(member):
     channel = discord.utils.get(member.guild.text_channels, name=ENTER_QUIT)
@@ -746,25 +2438,205 @@ async def on_member_update(before, after):
             new_nick = after.nick if after.nick else after.name
             await channel.send(f"**{old_nick}** 님이 닉네임을 **{new_nick}**(으)로 변경했습니다.")
 
+# ================ 메시지 대량 삭제 (clear) ================
+BULK_DELETE_MAX_AGE = dt.timedelta(days=14, minutes=-5)  # bulk delete 는 14일 이내 메시지만 (경계 여유 5분)
+CLEAR_PROGRESS_SECONDS = 3   # 진행 상황 메시지 수정 간격
+CLEAR_FROM_DEFAULT_DAYS = 14  # clear from @유저 기본 검색 기간 (이 안이면 전부 bulk delete 가능)
+CLEAR_OLD_QUEUE = 500        # 14일 지난 메시지 개별 삭제 대기열 (가득 차면 history 읽기를 잠시 멈춤)
+CLEAR_USAGE = "사용법: `$clear all`, `$clear 100`, `$clear from @User [개수] [일수d]`, `$clear cancel`"
+
+class PurgeJob:
+    """
+    채널 메시지 대량 삭제 1건.
+    - history 를 페이지 단위로 흘려 읽으면서 조건에 맞는 메시지만 모음 (전체를 메모리에 올리지 않음)
+    - 14일 이내 메시지는 100개씩 bulk delete, 삭제 요청 1개를 보내 둔 채 다음 페이지를 읽음
+    - 14일 지난 메시지는 API 상 1개씩만 지워져 별도 작업이 순서대로 삭제 (레이트 리밋은 discord.py 가 맞춤)
+    - 상태 메시지를 주기적으로 수정하고, cancel() 하면 다음 메시지부터 멈춤
+    """
+
+    def __init__(self, channel: discord.TextChannel, status: discord.Message, *, limit: Optional[int] = None,
+                 check=None, before=None, after: Optional[dt.datetime] = None):
+        self.channel = channel
+        self.status = status
+        self.limit = limit
+        self.check = check
+        self.before = before
+        self.after = after
+        self.scanned = 0
+        self.matched = 0
+        self.deleted = 0
+        self.failed = 0
+        self._cancel = asyncio.Event()
+        self._last_progress = 0.0
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    async def run(self) -> int:
+        cutoff = discord.utils.utcnow() - BULK_DELETE_MAX_AGE
+        old: asyncio.Queue = asyncio.Queue(maxsize=CLEAR_OLD_QUEUE)
+        old_worker = asyncio.create_task(self._delete_old(old))
+        batch: list[discord.Message] = []
+        inflight: Optional[asyncio.Task] = None
+        try:
+            # after= 를 주면 기본이 오래된 순이라 방향을 명시 (개수 제한은 최근 메시지부터)
+            async for msg in self.channel.history(limit=None, before=self.before, after=self.after,
+                                                  oldest_first=False):
+                if self.cancelled:
+                    break
+                self.scanned += 1
+                if msg.id == self.status.id or (self.check and not self.check(msg)):
+                    continue
+                self.matched += 1
+                if msg.created_at < cutoff:
+                    await self._put_old(old, old_worker, msg)
+                else:
+                    batch.append(msg)
+                    if len(batch) == 100:
+                        if inflight:
+                            await inflight  # 삭제 요청은 채널당 1개만 띄워 둠
+                        inflight = asyncio.create_task(self._bulk(batch))
+                        batch = []
+                await self._progress()
+                if self.limit is not None and self.matched >= self.limit:
+                    break
+            if batch and not self.cancelled:
+                if inflight:
+                    await inflight
+                inflight = asyncio.create_task(self._bulk(batch))
+            if inflight:
+                await inflight
+            await self._put_old(old, old_worker, None)
+            await old_worker
+        finally:
+            old_worker.cancel()
+        return self.deleted
+
+    @staticmethod
+    async def _put_old(old: asyncio.Queue, worker: asyncio.Task, msg):
+        """대기열이 차 있으면 자리가 날 때까지 기다리되, 그 사이 작업자가 죽으면 같이 멈춤 (영원히 막히지 않게)."""
+        put = asyncio.ensure_future(old.put(msg))
+        await asyncio.wait({put, worker}, return_when=asyncio.FIRST_COMPLETED)
+        if not put.done():
+            put.cancel()
+            worker.result()  # 작업자 예외를 그대로 올림
+            raise RuntimeError("오래된 메시지 삭제 작업이 먼저 끝남")
+
+    async def _bulk(self, messages: list[discord.Message]):
+        try:
+            await self.channel.delete_messages(messages)
+            self.deleted += len(messages)
+        except discord.HTTPException:
+            # 중간에 누가 지운 메시지가 섞이거나 일시 오류면 묶음 전체가 실패 → 하나씩
+            for msg in messages:
+                await self._single(msg)
+
+    async def _single(self, msg: discord.Message):
+        try:
+            await msg.delete()
+            self.deleted += 1
+        except discord.NotFound:
+            pass
+        except discord.HTTPException as e:  # 권한 없는 시스템 메시지, 5xx 등은 건너뛰고 계속
+            self.failed += 1
+            print(f"clear: 메시지 {msg.id} 삭제 실패:", e)
+
+    async def _delete_old(self, old: asyncio.Queue):
+        while (msg := await old.get()) is not None:
+            if not self.cancelled:
+                await self._single(msg)
+                await self._progress()
+
+    async def _progress(self):
+        now = time.monotonic()
+        if now - self._last_progress < CLEAR_PROGRESS_SECONDS:
+            return
+        self._last_progress = now
+        try:
+            await self.status.edit(content=f"🧹 삭제 중… {self.deleted}개 삭제 / {self.scanned}개 확인 "
+                                           f"(중단: `$clear cancel`)")
+        except discord.HTTPException:
+            pass
+
+
+purge_jobs: dict[int, PurgeJob] = {}  # 채널ID -> 진행 중인 삭제
+
+async def recreate_channel(channel: discord.TextChannel) -> discord.TextChannel:
+    """
+    채널 전체 삭제 빠른 경로: 같은 설정(이름/주제/권한/카테고리/슬로우모드)으로 복제 후 원래 채널 삭제.
+    메시지 수와 상관없이 API 호출 몇 번이면 끝남. 채널 ID 가 바뀌므로 로그 채널 설정도 옮김.
+    """
+    new = await channel.clone(reason="clear all")
+    await new.edit(position=channel.position)
+    await channel.delete(reason="clear all")
+    if guild_settings.log.get(channel.guild.id) == channel.id:
+        await guild_settings.set_log(channel.guild.id, new.id)
+    return new
+
+def parse_clear_from(args) -> tuple[Optional[int], int]:
+    """`from @유저` 뒤의 [개수] [일수d] 해석 → (최대 삭제 개수, 검색 기간 일수)"""
+    limit, days = None, CLEAR_FROM_DEFAULT_DAYS
+    for a in args:
+        if a.isdigit():
+            limit = int(a)
+        elif a[:-1].isdigit() and a[-1] in "dD일":
+            days = int(a[:-1])
+    return limit, days
+
 @bot.command()
 @commands.has_permissions(manage_messages=True)
 async def clear(ctx, *args):
     if not args:
-        await ctx.send("사용법: `$clear all`, `$clear 100`, `$clear from @User`", delete_after=5)
+        await ctx.send(CLEAR_USAGE, delete_after=5)
+        return
+    if args[0] == "cancel":
+        job = purge_jobs.get(ctx.channel.id)
+        if job:
+            job.cancel()
+        await ctx.send("⏹️ 삭제를 중단합니다." if job else "진행 중인 삭제가 없습니다.", delete_after=3)
+        return
+    if ctx.channel.id in purge_jobs:
+        await ctx.send("이미 이 채널에서 삭제가 진행 중입니다. (`$clear cancel` 로 중단)", delete_after=5)
         return
+
+    kwargs = {}
     if args[0] == "all":
-        await ctx.channel.purge(limit=None)
-        await ctx.send("모든 메시지가 삭제되었습니다.", delete_after=3)
+        perms = ctx.channel.permissions_for(ctx.guild.me)
+        if perms.manage_channels and ctx.author.guild_permissions.manage_channels:
+            new = await recreate_channel(ctx.channel)
+            await new.send("모든 메시지가 삭제되었습니다. (채널을 새로 만들었습니다)", delete_after=5)
+            return
     elif args[0].isdigit():
-        count = int(args[0])
-        await ctx.channel.purge(limit=count + 1)
-        await ctx.send(f"최근 {count}개 메시지 삭제 완료", delete_after=3)
+        kwargs["limit"] = int(args[0])
     elif args[0] == "from" and len(ctx.message.mentions) > 0:
         member = ctx.message.mentions[0]
-        deleted = await ctx.channel.purge(limit=1000, check=lambda m: m.author == member)
-        await ctx.send(f"{member.display_name}님의 메시지 {len(deleted)}개 삭제 완료", delete_after=3)
+        limit, days = parse_clear_from(args[2:])
+        kwargs.update(limit=limit, check=lambda m: m.author.id == member.id,
+                      after=discord.utils.utcnow() - dt.timedelta(days=days))
     else:
-        await ctx.send("사용법: `$clear all`, `$clear 100`, `$clear from @User`", delete_after=5)
+        await ctx.send(CLEAR_USAGE, delete_after=5)
+        return
+    if kwargs.get("limit") == 0:  # 0개 삭제 요청이 전체 삭제로 번지지 않게
+        await ctx.send(CLEAR_USAGE, delete_after=5)
+        return
+
+    try:
+        await ctx.message.delete()
+    except discord.HTTPException:
+        pass
+    status = await ctx.send("🧹 삭제 시작… (중단: `$clear cancel`)")
+    job = purge_jobs[ctx.channel.id] = PurgeJob(ctx.channel, status, before=ctx.message, **kwargs)
+    try:
+        deleted = await job.run()
+    finally:
+        purge_jobs.pop(ctx.channel.id, None)
+    head = "⏹️ 삭제 중단" if job.cancelled else "✅ 삭제 완료"
+    tail = f" (삭제 실패 {job.failed}개)" if job.failed else ""
+    await status.edit(content=f"{head}: 메시지 {deleted}개 삭제{tail}", delete_after=5)
 
 @clear.error
 async def clear_error(ctx, error):
@@ -772,6 +2644,99 @@ async def clear_error(ctx, error):
         await ctx.send("⚠️ 메시지 관리 권한이 없습니다.", delete_after=5)
     else:
         raise error
+# ================ 역할 버튼 / 일괄 변경 ================
+ROLE_GROUPS = (MEMBER_ROLES, POSITION_ROLES)  # 그룹 안에서는 역할 하나만 유지
+ROLE_BULK_PROGRESS_SECONDS = 5
+
+class RoleIndex:
+    """
+    길드별 역할 이름 → Role 인덱스. 첫 조회 때 guild.roles 를 한 번 훑어 만들고,
+    역할 생성/수정/삭제 이벤트가 오면 그 길드 것만 버림 (다음 조회 때 다시 만듦).
+    이름이 겹치면 discord.utils.get 과 같이 guild.roles 순서상 앞의 것.
+    """
+
+    def __init__(self):
+        self._by_guild: dict[int, dict[str, discord.Role]] = {}
+
+    def get(self, guild: discord.Guild, name: str) -> Optional[discord.Role]:
+        index = self._by_guild.get(guild.id)
+        if index is None:
+            index = self._by_guild[guild.id] = {}
+            for r in guild.roles:
+                index.setdefault(r.name, r)
+        return index.get(name)
+
+    def invalidate(self, guild_id: int):
+        self._by_guild.pop(guild_id, None)
+
+
+role_index = RoleIndex()
+
+@bot.event
+async def on_guild_role_create(role):
+    role_index.invalidate(role.guild.id)
+
+@bot.event
+async def on_guild_role_delete(role):
+    role_index.invalidate(role.guild.id)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    role_index.invalidate(after.guild.id)
+
+def edited_roles(member: discord.Member, add=(), remove=()) -> Optional[list]:
+    """add/remove 를 반영한 새 역할 목록 (@everyone 제외, member.edit(roles=...) 용). 바뀌는 게 없으면 None"""
+    remove_ids = {r.id for r in remove} - {r.id for r in add}
+    current = [r for r in member.roles if not r.is_default()]
+    keep = [r for r in current if r.id not in remove_ids]
+    have = {r.id for r in keep}
+    new = keep + [r for r in add if r.id not in have]
+    if {r.id for r in new} == {r.id for r in current}:
+        return None
+    return new
+
+class RoleBulkQueue:
+    """
+    관리자 역할 일괄 부여/회수. 길드마다 작업 하나씩, 멤버 한 명씩 순서대로 member.edit 한 번.
+    멤버 수정은 길드 단위 레이트 리밋이라 동시에 보내도 429 대기만 늘어남 (429 대기는 discord.py 가 처리).
+    이미 원하는 상태인 멤버는 API 를 부르지 않음.
+    """
+
+    def __init__(self):
+        self._locks: dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.pending = 0  # 처리 대기 중인 멤버 수 (메트릭)
+
+    async def apply(self, guild: discord.Guild, members, add=(), remove=(), progress=None) -> tuple[int, int, int]:
+        """return: (변경, 건너뜀, 실패). progress(처리 수, 전체) 는 ROLE_BULK_PROGRESS_SECONDS 마다 호출"""
+        members = list(members)
+        changed = skipped = failed = 0
+        self.pending += len(members)
+        left = len(members)
+        try:
+            async with self._locks[guild.id]:
+                last = time.monotonic()
+                for i, member in enumerate(members, 1):
+                    left -= 1
+                    self.pending -= 1
+                    roles = edited_roles(member, add, remove)
+                    if roles is None:
+                        skipped += 1
+                        continue
+                    try:
+                        await member.edit(roles=roles, reason="역할 일괄 변경")
+                        changed += 1
+                    except discord.HTTPException:
+                        failed += 1
+                    if progress and time.monotonic() - last >= ROLE_BULK_PROGRESS_SECONDS:
+                        last = time.monotonic()
+                        await progress(i, len(members))
+        finally:
+            self.pending -= left
+        return changed, skipped, failed
+
+
+role_bulk = RoleBulkQueue()
+
 class RoleView(View):
     def __init__(self):
         super().__init__(timeout=None)
@@ -788,26 +2753,55 @@ class RoleButton(Button):
         super().__init__(label=label, style=style, custom_id=f"role_{role_name}")
         self.role_name = role_name
     async def callback(self, interaction: discord.Interaction):
-        guild = interaction.guild
-        role = discord.utils.get(guild.roles, name=self.role_name)
-        if self.role_name in MEMBER_ROLES:
-            for r_name in MEMBER_ROLES:
-                role_to_remove = discord.utils.get(guild.roles, name=r_name)
-                if role_to_remove and role_to_remove in interaction.user.roles:
-                    await interaction.user.remove_roles(role_to_remove)
-        if self.role_name in POSITION_ROLES:
-            for r_name in POSITION_ROLES:
-                role_to_remove = discord.utils.get(guild.roles, name=r_name)
-                if role_to_remove and role_to_remove in interaction.user.roles:
-                    await interaction.user.remove_roles(role_to_remove)
-        if role in interaction.user.roles:
-            await interaction.user.remove_roles(role)
-            msg = await interaction.channel.send(f"{interaction.user.mention} `{role.name}` 역할을 제거했습니다.")
+        # 몰릴 때 3초 제한에 걸리지 않게 먼저 응답 예약, 결과는 누른 사람에게만
+        await interaction.response.defer(ephemeral=True)
+        guild, member = interaction.guild, interaction.user
+        role = role_index.get(guild, self.role_name)
+        if role is None:
+            await interaction.followup.send(f"`{self.role_name}` 역할이 서버에 없습니다.", ephemeral=True)
+            return
+        had = role in member.roles
+        if had:
+            roles = edited_roles(member, remove=[role])
         else:
-            await interaction.user.add_roles(role)
-            msg = await interaction.channel.send(f"{interaction.user.mention} `{role.name}` 역할을 부여했습니다.")
-        await msg.delete(delay=3)
-        await interaction.response.defer()
+            group = next((g for g in ROLE_GROUPS if self.role_name in g), [])
+            others = [r for r in (role_index.get(guild, n) for n in group) if r is not None and r != role]
+            roles = edited_roles(member, add=[role], remove=others)
+        try:
+            await member.edit(roles=roles, reason="역할 버튼")
+        except discord.Forbidden:
+            await interaction.followup.send("⚠️ 봇 권한이 부족해 역할을 바꿀 수 없습니다.", ephemeral=True)
+            return
+        except discord.HTTPException as e:  # 5xx/레이트리밋 등: 응답 예약만 남지 않게 실패를 알려줌
+            print("역할 버튼 변경 실패:", e)
+            await interaction.followup.send("⚠️ 역할 변경에 실패했습니다. 잠시 후 다시 눌러 주세요.", ephemeral=True)
+            return
+        await interaction.followup.send(f"`{role.name}` 역할을 {'제거' if had else '부여'}했습니다.", ephemeral=True)
+
+@bot.tree.command(name="role_bulk", description="(관리자) 여러 멤버에게 역할을 한꺼번에 부여/회수합니다.")
+@app_commands.default_permissions(administrator=True)
+async def role_bulk_cmd(interaction: discord.Interaction, action: Literal["add", "remove"], role: discord.Role,
+                        target: Optional[discord.Role] = None):
+    """target 역할을 가진 멤버(없으면 봇 제외 전체)에게 role 을 부여(add)/회수(remove)"""
+    guild = interaction.guild
+    if role.is_default() or role.managed or role >= guild.me.top_role:
+        await interaction.response.send_message("봇이 관리할 수 없는 역할입니다. (봇 역할보다 위이거나 연동 역할)",
+                                                ephemeral=True)
+        return
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    members = [m for m in (target.members if target else guild.members) if not m.bot]
+    add, remove = ([role], []) if action == "add" else ([], [role])
+    status = await interaction.followup.send(f"⏳ {len(members)}명 처리 대기 중…", ephemeral=True, wait=True)
+
+    async def progress(done, total):
+        try:
+            await status.edit(content=f"⏳ `{role.name}` {action}: {done}/{total}명 처리")
+        except discord.HTTPException:
+            pass
+
+    changed, skipped, failed = await role_bulk.apply(guild, members, add, remove, progress)
+    await status.edit(content=f"✅ `{role.name}` {action} 완료: 변경 {changed}명, 이미 적용 {skipped}명"
+                              + (f", 실패 {failed}명" if failed else ""))
 
 @bot.command()
 async def 역할(ctx):
@@ -827,152 +2821,1168 @@ async def role(ctx):
     )
     await ctx.send(embed=embed, view=RoleView())
 
+# ================ Q&A (OpenAI) ================
+class QAGate:
+    """
+    OpenAI 호출 동시 실행 제한 (전역 + 길드별) 과 FIFO 대기열.
+    길드 한도에 걸린 요청은 건너뛰고 뒤의 다른 길드 요청이 먼저 들어갈 수 있음.
+    """
+
+    def __init__(self, global_limit: int, per_guild: int):
+        self.global_limit = global_limit
+        self.per_guild = per_guild
+        self._running = 0
+        self._by_guild: dict[int, int] = defaultdict(int)
+        self._waiters: deque[tuple[int, asyncio.Future]] = deque()
+
+    def _can_run(self, guild_id: int) -> bool:
+        return self._running < self.global_limit and self._by_guild[guild_id] < self.per_guild
+
+    def _take(self, guild_id: int):
+        self._running += 1
+        self._by_guild[guild_id] += 1
+
+    def release(self, guild_id: int):
+        self._running -= 1
+        self._by_guild[guild_id] -= 1
+        if not self._by_guild[guild_id]:
+            del self._by_guild[guild_id]
+        self._wake()
+
+    def _wake(self):
+        for entry in list(self._waiters):
+            guild_id, fut = entry
+            if fut.done():
+                self._waiters.remove(entry)
+            elif self._can_run(guild_id):
+                self._waiters.remove(entry)
+                self._take(guild_id)
+                fut.set_result(None)
+
+    def depth(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, guild_id: int, timeout: float, on_wait=None):
+        """
+        자리 날 때까지 대기. on_wait(순번) 은 순번이 바뀔 때마다 호출(대기열 안내용).
+        timeout 초과 시 asyncio.TimeoutError.
+        """
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        entry = (guild_id, fut)
+        self._waiters.append(entry)
+        self._wake()
+        if fut.done():
+            return
+        deadline = loop.time() + timeout
+        last_pos = None
+        try:
+            while True:
+                if entry in self._waiters:
+                    pos = self._waiters.index(entry) + 1
+                    if on_wait and pos != last_pos:
+                        last_pos = pos
+                        await on_wait(pos)
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError
+                try:
+                    await asyncio.wait_for(asyncio.shield(fut), min(2.0, remaining))
+                    return
+                except asyncio.TimeoutError:
+                    continue
+        except BaseException:
+            if fut.done() and not fut.cancelled():
+                self.release(guild_id)  # 자리를 받은 직후 취소된 경우 반납
+            else:
+                fut.cancel()
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+            raise
+
+
+qa_gate = QAGate(QA_MAX_CONCURRENCY, QA_PER_GUILD)
+
+class _ProgressEditor:
+    """스트리밍 중 메시지를 최신 내용으로 주기적으로 수정 (생성 루프는 수정 완료를 기다리지 않음)."""
+
+    def __init__(self, message: discord.Message, interval: float = QA_EDIT_INTERVAL):
+        self.message = message
+        self.interval = interval
+        self._latest: Optional[str] = None
+        self._task: asyncio.Task | None = None
+
+    def update(self, content: str):
+        self._latest = content
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self._latest is not None:
+            content, self._latest = self._latest, None
+            try:
+                await self.message.edit(content=content[:DISCORD_MESSAGE_LIMIT])
+            except Exception:
+                pass
+            await asyncio.sleep(self.interval)
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except BaseException:
+                pass
+
+async def ask_openai(question: str, on_partial=None) -> str:
+    """비동기 클라이언트로 스트리밍 요청. on_partial(지금까지 답변) 은 조각이 올 때마다 호출."""
+    t0 = time.perf_counter()
+    status = "ok"
+    try:
+        stream = await client.chat.completions.create(
+            model=QA_MODEL,
+            messages=[{"role": "user", "content": question}],
+            stream=True,
+        )
+        parts = []
+        async for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                if not parts:
+                    metrics.observe("bot_openai_seconds", time.perf_counter() - t0, phase="first_token", status="ok")
+                parts.append(delta)
+                if on_partial:
+                    on_partial("".join(parts))
+        return "".join(parts).strip()
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        metrics.observe("bot_openai_seconds", time.perf_counter() - t0, phase="total", status=status)
+
+def normalize_question(text: str) -> str:
+    """
+    캐시 키용 질문 정규화.
+    NFKC(전각/호환 자모 → 완성형 한글), 대소문자 무시, 공백 하나로, 끝 문장부호 제거.
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = re.sub(r"\s+", " ", text).strip()
+    return text.rstrip("?!.~ ")
+
+def _qa_get(db, key: str, min_created: int, now: int) -> Optional[str]:
+    row = db.execute("SELECT answer FROM qa_cache WHERE key=? AND created_at>=?", (key, min_created)).fetchone()
+    if row:
+        db.execute("UPDATE qa_cache SET last_hit=?, hits=hits+1 WHERE key=?", (now, key))
+    return row["answer"] if row else None
+
+def _qa_put(db, key: str, model: str, question: str, answer: str, now: int, ttl: int, max_entries: int):
+    db.execute("INSERT OR REPLACE INTO qa_cache(key, model, question, answer, created_at, last_hit) "
+               "VALUES(?,?,?,?,?,?)", (key, model, question, answer, now, now))
+    # 만료분 + 최근 사용 순 상한 밖 정리
+    db.execute("DELETE FROM qa_cache WHERE created_at < ?", (now - ttl,))
+    db.execute("DELETE FROM qa_cache WHERE key IN "
+               "(SELECT key FROM qa_cache ORDER BY last_hit DESC LIMIT -1 OFFSET ?)", (max_entries,))
+
+class QACache:
+    """
+    OpenAI 답변 캐시 (points DB 의 qa_cache 테이블, 재시작 후에도 유지).
+    키 = 모델명 + 정규화된 질문. TTL 지나면 무효, 개수 상한 넘으면 오래 안 쓴 것부터 제거.
+    """
+
+    def __init__(self, model: str, ttl: int, max_entries: int):
+        self.model = model
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, question: str) -> str:
+        raw = f"{self.model}\0{normalize_question(question)}"
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    async def get(self, question: str) -> Optional[str]:
+        now = int(time.time())
+        answer = await points_db.write(_qa_get, self.key(question), now - self.ttl, now)
+        if answer is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return answer
+
+    async def put(self, question: str, answer: str):
+        await points_db.write(_qa_put, self.key(question), self.model, question, answer,
+                              int(time.time()), self.ttl, self.max_entries)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": (self.hits / total) if total else 0.0}
+
+
+qa_cache = QACache(QA_MODEL, QA_CACHE_TTL, QA_CACHE_MAX)
+
+async def run_qa(ctx, question: str, message: discord.Message) -> Optional[str]:
+    """
+    캐시 확인 → 대기열 → 답변 스트리밍(메시지 점진 수정) 까지 처리하고 최종 답변 반환.
+    실패/시간초과면 message 에 안내를 남기고 None.
+    """
+    cached = await qa_cache.get(question)
+    if cached is not None:
+        return cached
+
+    async def _on_wait(pos: int):
+        try:
+            await message.edit(content=f"⏳ 질문이 많아요… 대기열 {pos}번째")
+        except Exception:
+            pass
+
+    try:
+        await qa_gate.acquire(ctx.guild.id if ctx.guild else 0, QA_QUEUE_TIMEOUT, _on_wait)
+    except asyncio.TimeoutError:
+        await message.edit(content="⌛ 대기 시간이 초과됐어요. 잠시 후 다시 질문해주세요.")
+        return None
+
+    editor = _ProgressEditor(message)
+    try:
+        await message.edit(content="🤔 강민봇이 생각 중...")
+        answer = await asyncio.wait_for(
+            ask_openai(question, lambda partial: editor.update(partial + " ▌")), QA_TIMEOUT
+        )
+        if answer:
+            await qa_cache.put(question, answer)
+        return answer
+    except asyncio.TimeoutError:
+        await message.edit(content="⌛ 답변 생성 시간이 초과됐어요.")
+    except Exception as e:
+        print("OpenAI 오류:", e)
+        await message.edit(content="⚠️ 답변을 가져오지 못했어요.")
+    finally:
+        await editor.close()
+        qa_gate.release(ctx.guild.id if ctx.guild else 0)
+    return None
+
 @bot.command()
 async def 질문(ctx, *, question):
     thinking = await ctx.send("🤔 강민봇이 생각 중...")
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": question}]
-    )
-    answer = response.choices[0].message.content.strip()
-    embed = discord.Embed(title="🤖 강민봇의 답변", description=answer, color=discord.Color.blue())
+    answer = await run_qa(ctx, question, thinking)
+    if answer is None:
+        return
+    embed = discord.Embed(title="🤖 강민봇의 답변", description=answer[:4096], color=discord.Color.blue())
     embed.set_footer(text=f"질문자: {ctx.author.display_name}")
-    await thinking.delete()
-    await ctx.send(embed=embed)
+    await thinking.edit(content=None, embed=embed)
+
+# ----- 팀 밸런서 -----
+# 점수 합 차이(가장 강한 팀 - 가장 약한 팀)를 최소화하는 k팀(2~4) 분할.
+# 포지션이 주어지면 "같은 팀 안 포지션 중복 수"를 먼저 줄이고, 그 안에서 점수 차를 줄임 (사전식 비교).
+# 작은 인원은 정확 탐색, 큰 인원은 LPT + 교환 지역 탐색.
+TEAM_EXACT_LIMIT = 6_000        # 분할 경우의 수가 이 이하이면 분기한정 완전 탐색
+TEAM_MITM_MAX_PLAYERS = 24      # 2팀 & 포지션 없음: 이 인원까지 meet-in-the-middle 정확 해
+TEAM_HEURISTIC_BUDGET = 0.02    # 휴리스틱 재시작에 쓰는 최대 시간(초)
+
+def team_sizes(n: int, k: int) -> list[int]:
+    return [n // k + (1 if i < n % k else 0) for i in range(k)]
+
+def _position_dups(teams: list[list[int]], positions) -> int:
+    if not positions:
+        return 0
+    dups = 0
+    for team in teams:
+        seen = [positions[i] for i in team if positions[i]]
+        dups += len(seen) - len(set(seen))
+    return dups
+
+def team_cost(teams: list[list[int]], scores: list[int], positions=None) -> tuple[int, int]:
+    """(포지션 중복 수, 최대 팀합 - 최소 팀합) — 작을수록 좋음"""
+    sums = [sum(scores[i] for i in team) for team in teams]
+    return _position_dups(teams, positions), max(sums) - min(sums)
+
+def _partition_count(n: int, k: int, equal_size: bool) -> int:
+    if equal_size:
+        count = 1
+        rest = n
+        for size in team_sizes(n, k):
+            count *= _comb(rest, size)
+            rest -= size
+        for size in set(team_sizes(n, k)):
+            count //= _factorial(team_sizes(n, k).count(size))
+        return count
+    # 공집합 없는 k분할 수 (제2종 스털링 수)
+    s = [[0] * (k + 1) for _ in range(n + 1)]
+    s[0][0] = 1
+    for i in range(1, n + 1):
+        for j in range(1, k + 1):
+            s[i][j] = j * s[i - 1][j] + s[i - 1][j - 1]
+    return s[n][k]
+
+def _comb(n: int, r: int) -> int:
+    return _factorial(n) // (_factorial(r) * _factorial(n - r))
+
+def _factorial(n: int) -> int:
+    out = 1
+    for i in range(2, n + 1):
+        out *= i
+    return out
+
+def _balance_exact(scores, k, equal_size, positions, seed=None) -> list[list[int]]:
+    """
+    분기한정 DFS. 점수 내림차순으로 배치하고, 빈 팀은 첫 번째 것만 시도(팀 순서 대칭 제거).
+    seed(휴리스틱 해)를 주면 그 비용을 처음 상한으로 써서 가지치기가 빨라짐.
+    """
+    n = len(scores)
+    order = sorted(range(n), key=lambda i: -scores[i])
+    cap = -(-n // k)
+    full_limit = (n % k) or k  # cap 크기까지 찰 수 있는 팀 수
+    suffix = [0] * (n + 1)
+    for idx in range(n - 1, -1, -1):
+        suffix[idx] = suffix[idx + 1] + scores[order[idx]]
+
+    teams: list[list[int]] = [[] for _ in range(k)]
+    sums = [0] * k
+    team_pos: list[dict] = [defaultdict(int) for _ in range(k)]
+    best = {"cost": (float("inf"), float("inf")), "teams": None}
+    if seed is not None:
+        best["cost"], best["teams"] = team_cost(seed, scores, positions), seed
+    state = {"dups": 0, "full": 0}
+
+    def dfs(idx: int):
+        if state["dups"] > best["cost"][0]:
+            return
+        if idx == n:
+            if not equal_size and any(not t for t in teams):
+                return
+            cost = (state["dups"], max(sums) - min(sums))
+            if cost < best["cost"]:
+                best["cost"], best["teams"] = cost, [list(t) for t in teams]
+            return
+        empty = sum(1 for t in teams if not t)
+        if not equal_size and empty > n - idx:
+            return
+        if state["dups"] == best["cost"][0] and max(sums) - min(sums) - suffix[idx] >= best["cost"][1]:
+            return
+        p = order[idx]
+        pos = positions[p] if positions else None
+        tried_empty = False
+        for t in range(k):
+            if not teams[t]:
+                if tried_empty:
+                    continue
+                tried_empty = True
+            if equal_size and len(teams[t]) == cap:
+                continue
+            if equal_size and len(teams[t]) == cap - 1 and state["full"] == full_limit:
+                continue
+            added_dup = 1 if pos and team_pos[t][pos] else 0
+            teams[t].append(p); sums[t] += scores[p]
+            if pos:
+                team_pos[t][pos] += 1
+            state["dups"] += added_dup
+            if equal_size and len(teams[t]) == cap:
+                state["full"] += 1
+            dfs(idx + 1)
+            if equal_size and len(teams[t]) == cap:
+                state["full"] -= 1
+            state["dups"] -= added_dup
+            if pos:
+                team_pos[t][pos] -= 1
+            teams[t].pop(); sums[t] -= scores[p]
+            if best["cost"] == (0, 0):
+                return
+
+    dfs(0)
+    return best["teams"]
+
+def _subset_sums(items: list[int], scores) -> dict[int, list[tuple[int, int]]]:
+    """{부분집합 크기: [(합, 비트마스크)] 정렬}"""
+    by_count: dict[int, list[tuple[int, int]]] = defaultdict(list)
+    for mask in range(1 << len(items)):
+        total = 0
+        for b, i in enumerate(items):
+            if mask >> b & 1:
+                total += scores[i]
+        by_count[bin(mask).count("1")].append((total, mask))
+    for lst in by_count.values():
+        lst.sort()
+    return by_count
+
+def _balance_two_mitm(scores, equal_size) -> list[list[int]]:
+    """2팀 정확 해: 반씩 나눠 부분합을 만들고, 오른쪽 각 부분합에 대해 왼쪽에서 목표에 가장 가까운 합을 이분 탐색."""
+    n = len(scores)
+    left, right = list(range(n // 2)), list(range(n // 2, n))
+    lsums, rsums = _subset_sums(left, scores), _subset_sums(right, scores)
+    total = sum(scores)
+    sizes = {n // 2, n - n // 2} if equal_size else set(range(1, n))
+    best_diff, best = None, None
+    for rc, rlist in rsums.items():
+        for lc, llist in lsums.items():
+            if lc + rc not in sizes:
+                continue
+            lkeys = [s for s, _ in llist]
+            for rs, rmask in rlist:
+                # 팀 A 합이 total/2 에 가까울수록 좋음
+                target = total / 2 - rs
+                j = bisect.bisect_left(lkeys, target)
+                for cand in (j - 1, j):
+                    if 0 <= cand < len(llist):
+                        diff = abs(total - 2 * (llist[cand][0] + rs))
+                        if best_diff is None or diff < best_diff:
+                            best_diff, best = diff, (llist[cand][1], rmask)
+    lmask, rmask = best
+    team_a = [i for b, i in enumerate(left) if lmask >> b & 1] + [i for b, i in enumerate(right) if rmask >> b & 1]
+    chosen = set(team_a)
+    return [team_a, [i for i in range(n) if i not in chosen]]
+
+def _lpt(order, scores, k, equal_size, positions=None) -> list[list[int]]:
+    """큰 점수부터 (자리가 남은) 가장 약한 팀에 배치. 포지션이 있으면 중복이 안 생기는 팀을 우선."""
+    caps = team_sizes(len(order), k) if equal_size else [len(order)] * k
+    teams, sums = [[] for _ in range(k)], [0] * k
+    taken: list[set] = [set() for _ in range(k)]
+    for p in order:
+        pos = positions[p] if positions else None
+        t = min((t for t in range(k) if len(teams[t]) < caps[t]),
+                key=lambda t: (pos in taken[t], sums[t]))
+        teams[t].append(p); sums[t] += scores[p]
+        if pos:
+            taken[t].add(pos)
+    return teams
+
+def _improve(teams, scores, positions, equal_size, deadline: float) -> list[list[int]]:
+    """
+    두 팀 사이 1:1 교환(인원 자유면 1명 이동 포함)으로 비용이 줄어드는 동안 반복.
+    팀합/포지션 수는 증분 갱신, 인원이 많아도 deadline 을 넘기면 그때까지의 결과 반환.
+    """
+    k = len(teams)
+    sums = [sum(scores[i] for i in t) for t in teams]
+    counts = [defaultdict(int) for _ in range(k)]
+    if positions:
+        for t, team in enumerate(teams):
+            for i in team:
+                if positions[i]:
+                    counts[t][positions[i]] += 1
+    cost = team_cost(teams, scores, positions)
+
+    def pos_of(i):
+        return positions[i] if positions else None
+
+    def dup_delta(t, out, into) -> int:
+        """팀 t 에서 포지션 out 이 빠지고 into 가 들어올 때 중복 수 변화"""
+        if out == into:
+            return 0
+        d = 0
+        if out and counts[t][out] >= 2:
+            d -= 1
+        if into and counts[t][into] >= 1:
+            d += 1
+        return d
+
+    improved = True
+    while improved and cost != (0, 0):
+        improved = False
+        for a in range(k):
+            for b in range(k):
+                if a == b:
+                    continue
+                for ia, pa in enumerate(teams[a]):
+                    if time.perf_counter() > deadline:
+                        return teams
+                    xa = pos_of(pa)
+                    options = [(ib, pb) for ib, pb in enumerate(teams[b])] if a < b else []
+                    if not equal_size and len(teams[a]) > 1:
+                        options.append((None, None))
+                    for ib, pb in options:
+                        moved = scores[pb] if pb is not None else 0
+                        xb = pos_of(pb) if pb is not None else None
+                        new_sums = list(sums)
+                        new_sums[a] += moved - scores[pa]
+                        new_sums[b] += scores[pa] - moved
+                        new = (cost[0] + dup_delta(a, xa, xb) + dup_delta(b, xb, xa),
+                               max(new_sums) - min(new_sums))
+                        if new >= cost:
+                            continue
+                        if pb is None:
+                            teams[a].pop(ia); teams[b].append(pa)
+                        else:
+                            teams[a][ia], teams[b][ib] = pb, pa
+                        for t, out, into in ((a, xa, xb), (b, xb, xa)):
+                            if out:
+                                counts[t][out] -= 1
+                            if into:
+                                counts[t][into] += 1
+                        sums, cost, improved = new_sums, new, True
+                        break
+                    if improved:
+                        break
+                if improved:
+                    break
+            if improved:
+                break
+    return teams
+
+def _balance_heuristic(scores, k, equal_size, positions, budget) -> list[list[int]]:
+    n = len(scores)
+    deadline = time.perf_counter() + budget
+    order = sorted(range(n), key=lambda i: -scores[i])
+    best = _improve(_lpt(order, scores, k, equal_size, positions), scores, positions, equal_size, deadline)
+    best_cost = team_cost(best, scores, positions)
+    rng = random.Random(n * 31 + k)
+    while best_cost != (0, 0) and time.perf_counter() < deadline:
+        # 점수가 비슷한 사람끼리 순서를 살짝 흔들어 다른 시작점에서 다시 탐색
+        noisy = sorted(range(n), key=lambda i: -scores[i] * (1 + rng.uniform(-0.05, 0.05)))
+        teams = _improve(_lpt(noisy, scores, k, equal_size, positions), scores, positions, equal_size, deadline)
+        cost = team_cost(teams, scores, positions)
+        if cost < best_cost:
+            best, best_cost = teams, cost
+    return best
+
+def balance_teams(scores: list[int], k: int = 2, equal_size: bool = True,
+                  positions: Optional[list[Optional[str]]] = None,
+                  budget: float = TEAM_HEURISTIC_BUDGET) -> list[list[int]]:
+    """
+    scores[i] 인 n명을 k팀으로 나눔. 반환: 팀별 선수 인덱스 목록 (팀 합 내림차순).
+    equal_size=True 면 팀 인원 차이 최대 1명.
+    positions[i] 는 포지션 이름 또는 None (같은 팀 중복을 피함).
+    """
+    n = len(scores)
+    if not 2 <= k <= n:
+        raise ValueError("팀 수는 2 이상, 인원 수 이하여야 합니다.")
+    if not any(positions or []):
+        positions = None
+    if k == 2 and positions is None and n <= TEAM_MITM_MAX_PLAYERS:
+        teams = _balance_two_mitm(scores, equal_size)
+    elif _partition_count(n, k, equal_size) <= TEAM_EXACT_LIMIT:
+        seed = _balance_heuristic(scores, k, equal_size, positions, 0)
+        teams = _balance_exact(scores, k, equal_size, positions, seed)
+    else:
+        teams = _balance_heuristic(scores, k, equal_size, positions, budget)
+    return sorted(teams, key=lambda t: -sum(scores[i] for i in t))
+
+TEAM_EMOJIS = ["🔵", "🔴", "🟢", "🟡"]
+
+def member_position(member: discord.Member) -> Optional[str]:
+    for role in member.roles:
+        if role.name in POSITION_ROLES:
+            return role.name
+    return None
 
 # ----- 랭킹(기존) -----
+# 점수/경기 기록은 points DB(scores, match_logs)에 INTEGER 키로 저장.
+# 예전 scores.db(TEXT 키)는 시작 시 백그라운드로 옮기고, 끝날 때까지는 두 곳을 합쳐 읽음.
+SCORES_MIGRATE_BATCH = 500
+SCORES_MIGRATED_KEY = "scores_db_migrated"
+
+def get_score_row(db, guild_id: int, user_id: int):
+    return db.execute("SELECT username, score FROM scores WHERE guild_id=? AND user_id=?",
+                      (guild_id, user_id)).fetchone()
+
+def register_score(db, guild_id: int, user_id: int, username: str, score: int = 1000) -> bool:
+    cur = db.execute("INSERT OR IGNORE INTO scores(guild_id, user_id, username, score) VALUES(?, ?, ?, ?)",
+                     (guild_id, user_id, username, score))
+    return cur.rowcount == 1
+
+def load_score_rows(db, guild_id: int) -> list[tuple[int, int]]:
+    return [(r["user_id"], r["score"]) for r in
+            db.execute("SELECT user_id, score FROM scores WHERE guild_id=?", (guild_id,))]
+
+def recent_match_logs(db, guild_id: int, limit: int):
+    return [tuple(r) for r in db.execute(
+        "SELECT id, timestamp, winner_ids, loser_ids, note FROM match_logs WHERE guild_id=? ORDER BY id DESC LIMIT ?",
+        (guild_id, limit))]
+
+def import_legacy_scores(db, rows) -> int:
+    """rows: [(guild_id, user_id, username, score)] — 이미 있는 (guild_id, user_id)는 건너뜀."""
+    before = db.total_changes
+    db.executemany("INSERT OR IGNORE INTO scores(guild_id, user_id, username, score) VALUES(?, ?, ?, ?)", rows)
+    return db.total_changes - before
+
+def import_legacy_match_logs(db, rows) -> int:
+    """rows: [(id, guild_id, timestamp, winner_ids, loser_ids, note)] — id 를 그대로 써서 재실행해도 중복 없음."""
+    before = db.total_changes
+    db.executemany("INSERT OR IGNORE INTO match_logs(id, guild_id, timestamp, winner_ids, loser_ids, note) "
+                   "VALUES(?, ?, ?, ?, ?, ?)", rows)
+    return db.total_changes - before
+
+
+class LegacyScores:
+    """
+    scores.db → points DB 온라인 이전 + 이전 기간 동안의 호환 읽기.
+    - scores.db 는 읽기 전용으로만 열고, rowid 순으로 배치씩 읽어 points DB 에 INSERT OR IGNORE
+    - 중간에 봇이 꺼져도 다음 시작 때 처음부터 다시 돌리면 됨 (중복 없음)
+    - 다 옮기면 meta 에 표시하고 이후로는 scores.db 를 보지 않음
+    - 샤드가 여러 프로세스면 0번 샤드 프로세스만 옮기고, 나머지는 meta 표시가 생길 때까지 호환 읽기만 함
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.active = False  # True 인 동안만 scores.db 를 같이 읽음
+        self._task: Optional[asyncio.Task] = None
+
+    def _query(self, sql: str, params=()) -> list[tuple]:
+        try:
+            conn = sqlite3.connect(f"file:{urllib.parse.quote(self.path)}?mode=ro", uri=True)
+        except sqlite3.OperationalError:
+            return []
+        try:
+            return conn.execute(sql, params).fetchall()
+        except sqlite3.OperationalError:
+            return []  # 테이블 없음
+        finally:
+            conn.close()
+
+    async def query(self, sql: str, params=()) -> list[tuple]:
+        if not self.active:
+            return []
+        return await asyncio.to_thread(self._query, sql, params)
+
+    async def start(self, copy: bool = True):
+        if self._task is not None:
+            return
+        if not os.path.exists(self.path) or await points_db.read(get_meta, SCORES_MIGRATED_KEY):
+            return
+        self.active = True
+        self._task = asyncio.create_task(self._migrate() if copy else self._wait_migrated())
+        self._task.add_done_callback(self._done)
+
+    async def _wait_migrated(self):
+        while not await points_db.read(get_meta, SCORES_MIGRATED_KEY):
+            await asyncio.sleep(30)
+        self.active = False
+        scores_board.forget_all()
+
+    @staticmethod
+    def _done(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            print("scores.db 이전 오류 (다음 시작 때 다시 시도):", task.exception())
+
+    async def _copy(self, sql: str, convert, importer) -> int:
+        last, moved = 0, 0
+        while True:
+            batch = await asyncio.to_thread(self._query, sql, (last, SCORES_MIGRATE_BATCH))
+            if not batch:
+                return moved
+            last = batch[-1][0]
+            rows = []
+            for r in batch:
+                try:
+                    rows.append(convert(r))
+                except (TypeError, ValueError):
+                    print("scores.db 이전: 건너뛴 행", r)
+            moved += await points_db.write(importer, rows)
+
+    async def _migrate(self):
+        scores = await self._copy(
+            "SELECT rowid, guild_id, user_id, username, score FROM scores WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            lambda r: (int(r[1]), int(r[2]), r[3], r[4]),
+            import_legacy_scores,
+        )
+        logs = await self._copy(
+            "SELECT id, guild_id, timestamp, winner_ids, loser_ids, note FROM match_logs "
+            "WHERE id > ? ORDER BY id LIMIT ?",
+            lambda r: (r[0], int(r[1]), r[2], r[3], r[4], r[5]),
+            import_legacy_match_logs,
+        )
+        await points_db.write(set_meta, SCORES_MIGRATED_KEY, str(int(time.time())))
+        self.active = False
+        scores_board.forget_all()
+        print(f"scores.db 이전 완료: 점수 {scores}건, 경기 기록 {logs}건")
+
+
+legacy_scores = LegacyScores(DB_PATH)
+
+async def fetch_score(guild_id: int, user_id: int) -> Optional[tuple[str, int]]:
+    row = await points_db.read(get_score_row, guild_id, user_id)
+    if row:
+        return row["username"], row["score"]
+    rows = await legacy_scores.query("SELECT username, score FROM scores WHERE guild_id=? AND user_id=?",
+                                     (str(guild_id), str(user_id)))
+    return tuple(rows[0]) if rows else None
+
+async def _load_score_board(guild_id: int):
+    legacy = await legacy_scores.query("SELECT user_id, score FROM scores WHERE guild_id=?", (str(guild_id),))
+    merged = {}
+    for uid, score in legacy:
+        try:
+            merged.setdefault(int(uid), score)
+        except ValueError:
+            pass
+    merged.update(await points_db.read(load_score_rows, guild_id))
+    return list(merged.items())
+
+scores_board = Leaderboard(_load_score_board)
+
 @bot.command()
 async def 등록(ctx, member: Optional[discord.Member] = None):
     member = member or ctx.author
-    guild_id = str(ctx.guild.id)
-    user_id = str(member.id)
     username = member.name
-    conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM scores WHERE guild_id=? AND user_id=?", (guild_id, user_id))
-    if cursor.fetchone():
+    if await fetch_score(ctx.guild.id, member.id) is not None \
+            or not await points_db.write(register_score, ctx.guild.id, member.id, username):
         await ctx.send(f"{username} 님은 이미 등록되어 있습니다.")
-    else:
-        cursor.execute("INSERT INTO scores (guild_id, user_id, username, score) VALUES (?, ?, ?, 1000)",
-                       (guild_id, user_id, username))
-        conn.commit()
-        await ctx.send(f"{username} 님을 1000점으로 등록했습니다! ✅")
-    conn.close()
+        return
+    scores_board.update(ctx.guild.id, [(member.id, 1000)])
+    await ctx.send(f"{username} 님을 1000점으로 등록했습니다! ✅")
 
 @bot.command()
 async def 점수(ctx, member: Optional[discord.Member] = None):
     member = member or ctx.author
-    guild_id = str(ctx.guild.id); user_id = str(member.id)
-    conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
-    cursor.execute("SELECT score FROM scores WHERE guild_id=? AND user_id=?", (guild_id, user_id))
-    row = cursor.fetchone(); conn.close()
-    if row: await ctx.send(f"{member.name}님의 현재 점수는 {row[0]}점입니다.")
+    row = await fetch_score(ctx.guild.id, member.id)
+    if row: await ctx.send(f"{member.name}님의 현재 점수는 {row[1]}점입니다.")
     else:   await ctx.send(f"{member.name}님은 아직 등록되지 않았습니다.")
 
 @bot.command()
-async def 랭킹(ctx):
-    guild = ctx.guild; guild_id = str(guild.id)
-    conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
-    cursor.execute("SELECT user_id, score FROM scores WHERE guild_id=? ORDER BY score DESC LIMIT 10", (guild_id,))
-    rows = cursor.fetchall(); conn.close()
-    if not rows:
-        await ctx.send("등록된 유저가 없습니다."); return
-    msg = "🏆 **서버 내 랭킹 TOP 10** 🏆\n"
-    for i, (user_id, score) in enumerate(rows, start=1):
-        member = guild.get_member(int(user_id))
-        name = f"@{member.display_name}" if member else f"`탈퇴 또는 미확인 유저 ({user_id})`"
-        msg += f"{i}. {name} - {score}점\n"
+async def 랭킹(ctx, page: int = 1):
+    guild = ctx.guild
+    page = max(1, page)
+    await scores_board.ensure(guild.id)
+
+    def render(rows):
+        msg = "🏆 **서버 내 랭킹 TOP 10** 🏆\n" if page == 1 else f"🏆 **서버 내 랭킹 ({page}쪽)** 🏆\n"
+        for i, user_id, score in rows:
+            member = guild.get_member(user_id)
+            name = f"@{member.display_name}" if member else f"`탈퇴 또는 미확인 유저 ({user_id})`"
+            msg += f"{i}. {name} - {score}점\n"
+        return msg
+
+    msg = scores_board.page_text(guild.id, page - 1, render)
+    await ctx.send(msg or "등록된 유저가 없습니다.")
+
+@bot.command()
+async def 순위(ctx, member: Optional[discord.Member] = None):
+    member = member or ctx.author
+    guild = ctx.guild
+    await scores_board.ensure(guild.id)
+    rank = scores_board.rank(guild.id, member.id)
+    if rank is None:
+        await ctx.send(f"{member.name}님은 아직 등록되지 않았습니다."); return
+    msg = f"📈 {member.name}님은 {scores_board.size(guild.id)}명 중 **{rank}위**입니다.\n"
+    for r, user_id, score in scores_board.around(guild.id, member.id):
+        mark = "▶ " if user_id == member.id else ""
+        msg += f"{mark}{r}. {member_name(guild, user_id)} - {score}점\n"
     await ctx.send(msg)
 
 @bot.command()
-async def 팀짜기(ctx, *members: discord.Member):
-    guild_id = str(ctx.guild.id)
-    if len(members) < 2:
-        await ctx.send("최소 2명 이상의 멤버를 멘션해주세요."); return
-    conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
+async def 팀짜기(ctx, k: Optional[int] = None, free: Optional[Literal["인원무관"]] = None,
+                *members: discord.Member):
+    """$팀짜기 [팀 수 2~4] [인원무관] @유저..."""
+    k = k or 2
+    members = list(dict.fromkeys(members))
+    if not 2 <= k <= 4:
+        await ctx.send("팀 수는 2~4 사이로 입력해주세요."); return
+    if len(members) < k:
+        await ctx.send(f"최소 {k}명 이상의 멤버를 멘션해주세요."); return
     team_pool = []; missing = []
     for member in members:
-        uid = str(member.id)
-        cursor.execute("SELECT username, score FROM scores WHERE guild_id=? AND user_id=?", (guild_id, uid))
-        row = cursor.fetchone()
-        (team_pool.append(row) if row else missing.append(member.mention))
-    conn.close()
+        row = await fetch_score(ctx.guild.id, member.id)
+        (team_pool.append((row[0], row[1], member_position(member))) if row else missing.append(member.mention))
     if missing:
         await ctx.send(f"등록되지 않은 유저: {', '.join(missing)}"); return
-    random.shuffle(team_pool)
-    team1, team2, sum1, sum2 = [], [], 0, 0
-    for name, score in team_pool:
-        if sum1 <= sum2: team1.append((name, score)); sum1 += score
-        else:            team2.append((name, score)); sum2 += score
-    def fmt(team, total): return "\n".join([f"{n} - {s}" for n, s in team]) + f"\n총합: {total}"
-    result = f"""📊 멘션한 유저로 팀 편성 완료
-
-🔵 **Team A**
-{fmt(team1, sum1)}
-
-🔴 **Team B**
-{fmt(team2, sum2)}
-"""
+    scores = [score for _, score, _ in team_pool]
+    positions = [pos for _, _, pos in team_pool]
+    teams = await asyncio.to_thread(balance_teams, scores, k, free is None, positions)
+
+    def fmt(team):
+        lines = [f"{team_pool[i][0]} - {team_pool[i][1]}" + (f" ({team_pool[i][2]})" if team_pool[i][2] else "")
+                 for i in team]
+        return "\n".join(lines) + f"\n총합: {sum(scores[i] for i in team)}"
+
+    sums = [sum(scores[i] for i in team) for team in teams]
+    blocks = [f"{TEAM_EMOJIS[t]} **Team {chr(65 + t)}**\n{fmt(team)}" for t, team in enumerate(teams)]
+    result = f"📊 멘션한 유저로 팀 편성 완료 (점수 차 {max(sums) - min(sums)})\n\n" + "\n\n".join(blocks)
     await ctx.send(result)
 
 @bot.command()
 async def 로그(ctx):
-    guild_id = str(ctx.guild.id)
-    conn = sqlite3.connect(DB_PATH); cursor = conn.cursor()
-    cursor.execute("SELECT timestamp, winner_ids, loser_ids, note FROM match_logs WHERE guild_id=? ORDER BY id DESC LIMIT 5",
-                   (guild_id,))
-    logs = cursor.fetchall(); conn.close()
+    rows = await points_db.read(recent_match_logs, ctx.guild.id, 5)
+    rows += await legacy_scores.query(
+        "SELECT id, timestamp, winner_ids, loser_ids, note FROM match_logs WHERE guild_id=? ORDER BY id DESC LIMIT 5",
+        (str(ctx.guild.id),))
+    logs = sorted({r[0]: r for r in rows}.values(), reverse=True)[:5]
     if logs:
         msg = "📜 **최근 경기 기록**\n"
-        for i, (time, winners, losers, note) in enumerate(logs, start=1):
-            msg += f"{i}. [{time}]\n승리: {winners}\n패배: {losers}\n비고: {note}\n\n"
+        for i, (_, played_at, winners, losers, note) in enumerate(logs, start=1):
+            msg += f"{i}. [{played_at}]\n승리: {winners}\n패배: {losers}\n비고: {note}\n\n"
         await ctx.send(msg)
     else:
         await ctx.send("아직 기록된 경기가 없습니다.")
 
 @bot.command()
 async def a(ctx, *, question):
-    response = client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": question}]
+    msg = await ctx.send("🤔 ...")
+    answer = await run_qa(ctx, question, msg)
+    if answer is None:
+        return
+    chunks = split_message(answer.splitlines()) or ["(빈 답변)"]
+    await msg.edit(content=chunks[0])
+    for chunk in chunks[1:]:
+        await ctx.send(chunk)
+
+@bot.command(name="캐시통계")
+@commands.has_permissions(administrator=True)
+async def cache_stats(ctx):
+    qa, tts = qa_cache.stats(), tts_cache.stats()
+    await ctx.send(
+        f"🧠 Q&A 캐시: 히트 {qa['hits']} / 미스 {qa['misses']} (적중률 {qa['hit_rate']:.0%})\n"
+        f"🗣️ TTS 캐시: {tts['entries']}개, {tts['bytes'] / 1024 / 1024:.1f}MB, "
+        f"히트 {tts['hits']} / 미스 {tts['misses']} (적중률 {tts['hit_rate']:.0%})"
     )
-    await ctx.send(response.choices[0].message.content.strip())
 
 @bot.command(name='투표')
 async def poll(ctx, *, 질문):
     message = await ctx.send(f"📊 **{질문}**\n\n👍 가능\n❌ 불가능\n🤔 미정")
     await message.add_reaction("👍"); await message.add_reaction("❌"); await message.add_reaction("🤔")
 
+# ================ Lavalink 노드 풀 ================
+# "이름=http://host:2333|비밀번호" 를 쉼표로 구분 (이름 생략 시 node1, node2 ...)
+LAVALINK_NODES = os.getenv("LAVALINK_NODES", "http://localhost:2333|youshallnotpass")
+LAVALINK_STATS_SECONDS = 30  # 노드 부하 통계 갱신 + 상태 확인 주기
+LAVALINK_RETRIES = 3  # 노드 연결 재시도 횟수 (다 쓰면 lavalink_stats_loop 가 새로 연결)
+
+def parse_lavalink_nodes(spec: str) -> list[tuple[str, str, str]]:
+    """LAVALINK_NODES → [(identifier, uri, password)]"""
+    nodes = []
+    for i, part in enumerate(p.strip() for p in spec.split(",")):
+        if not part:
+            continue
+        ident, _, rest = part.rpartition("=") if "=" in part.split("|")[0] else ("", "", part)
+        uri, _, password = rest.partition("|")
+        nodes.append((ident or f"node{i + 1}", uri.strip(), password.strip()))
+    return nodes
+
+def node_penalty(stats: dict) -> float:
+    """
+    Lavalink 클라이언트들이 쓰는 부하 점수(낮을수록 여유).
+    재생 중 플레이어 수 + CPU 부하 + 프레임 누락(1분 기준) 가중치.
+    """
+    penalty = stats.get("playing", 0) + stats.get("pending", 0)
+    penalty += 1.05 ** (100 * stats.get("system_load", 0.0)) * 10 - 10
+    deficit, nulled = stats.get("deficit", 0), stats.get("nulled", 0)
+    if deficit or nulled:
+        penalty += 1.03 ** (500 * (deficit / 3000)) * 600 - 600
+        penalty += (1.03 ** (500 * (nulled / 3000)) * 300 - 300) * 2
+    return penalty
+
+def pick_node(stats_by_node: dict[str, dict], healthy: set[str]) -> Optional[str]:
+    candidates = [ident for ident in stats_by_node if ident in healthy]
+    if not candidates:
+        return None
+    return min(candidates, key=lambda ident: node_penalty(stats_by_node[ident]))
+
+
+class LavalinkPool:
+    """
+    Lavalink 노드 여러 대 관리.
+    - 노드마다 연결 태스크를 따로 띄움: 죽은/느린 노드가 봇 시작이나 다른 노드 연결을 막지 않음 (재시도는 유한)
+    - 새 플레이어는 부하 점수가 가장 낮은 노드에 배치
+    - 노드가 끊기면 플레이어가 아직 붙어 있을 때 살아있는 노드로 옮김 (유저가 $play 다시 할 필요 없음)
+      감지: on_wavelink_node_disconnected + lavalink_stats_loop 의 상태 확인
+    - 재시도를 다 쓰고 멈춘 노드는 lavalink_stats_loop 가 새로 연결
+    """
+
+    def __init__(self, spec: str):
+        self.specs = {ident: (uri, password) for ident, uri, password in parse_lavalink_nodes(spec)}
+        self.stats: dict[str, dict] = {}
+        self._connecting: dict[str, asyncio.Task] = {}
+        self._started = False
+
+    def connect(self):
+        """노드별 연결 태스크만 띄우고 바로 반환 (on_ready 에서 한 번)."""
+        if self._started or not self.specs:
+            return
+        self._started = True
+        for ident in self.specs:
+            self._spawn(ident)
+        lavalink_stats_loop.start()
+
+    def _spawn(self, ident: str):
+        task = self._connecting.get(ident)
+        if task is not None and not task.done():
+            return
+        task = self._connecting[ident] = asyncio.create_task(self._connect_node(ident))
+        task.add_done_callback(self._connect_done)
+
+    @staticmethod
+    def _connect_done(task: asyncio.Task):
+        if not task.cancelled() and task.exception():
+            print("Lavalink 연결 오류:", task.exception())
+
+    async def _connect_node(self, ident: str):
+        old = wavelink.Pool.nodes.get(ident)
+        if old is not None:
+            # 재시도를 다 쓴 노드: 남은 플레이어를 옮기고 풀에서 뺀 뒤 새로 만듦
+            await self.failover(old)
+            await old.close(eject=True)
+        uri, password = self.specs[ident]
+        node = wavelink.Node(identifier=ident, uri=uri, password=password, retries=LAVALINK_RETRIES)
+        self.stats.setdefault(ident, {})
+        await wavelink.Pool.connect(nodes=[node], client=bot, cache_capacity=None)
+
+    def healthy(self) -> dict[str, "wavelink.Node"]:
+        return {ident: node for ident, node in wavelink.Pool.nodes.items()
+                if node.status == wavelink.NodeStatus.CONNECTED}
+
+    async def check_health(self):
+        """연결이 끊긴 노드의 플레이어는 옮기고, 연결 시도를 멈춘 노드는 다시 연결."""
+        for ident in self.specs:
+            node = wavelink.Pool.nodes.get(ident)
+            if node is not None and node.status != wavelink.NodeStatus.CONNECTED:
+                await self.failover(node)
+            if node is None or node.status == wavelink.NodeStatus.DISCONNECTED:
+                self._spawn(ident)
+
+    async def refresh_stats(self):
+        for ident, node in self.healthy().items():
+            t0 = time.perf_counter()
+            try:
+                st = await node.fetch_stats()
+                metrics.observe("bot_lavalink_seconds", time.perf_counter() - t0, op="stats", status="ok")
+            except Exception as e:
+                metrics.observe("bot_lavalink_seconds", time.perf_counter() - t0, op="stats", status="error")
+                print("Lavalink 통계 조회 실패:", ident, e)
+                continue
+            frames = st.frames
+            self.stats[ident] = {
+                "playing": st.playing,
+                "pending": 0,  # 다음 통계까지 새로 배치한 수
+                "system_load": st.cpu.system_load,
+                "deficit": frames.deficit if frames else 0,
+                "nulled": frames.nulled if frames else 0,
+            }
+
+    def best_node(self, exclude: Optional[str] = None) -> Optional["wavelink.Node"]:
+        healthy = self.healthy()
+        ident = pick_node(self.stats, set(healthy) - {exclude})
+        if ident is None:
+            return None
+        self.stats[ident]["pending"] = self.stats[ident].get("pending", 0) + 1
+        return healthy[ident]
+
+    def player_cls(self):
+        """channel.connect(cls=...) 에 넘길 팩토리. 배치할 노드를 고정해서 Player 생성."""
+        node = self.best_node()
+        if node is None:
+            return wavelink.Player
+        return lambda client, channel: wavelink.Player(client, channel, nodes=[node])
+
+    async def failover(self, dead_node) -> int:
+        """dead_node 에 붙어 있는 플레이어를 살아있는 노드로 옮김. return: 옮긴 수"""
+        moved = 0
+        for player in list(dead_node.players.values()):
+            if player.node is not dead_node:
+                continue
+            target = self.best_node(exclude=dead_node.identifier)
+            if target is None:
+                print("Lavalink: 옮길 수 있는 노드가 없습니다.")
+                break
+            try:
+                await player.switch_node(target)
+                moved += 1
+            except Exception as e:
+                print("Lavalink 노드 이동 실패:", e)
+        if moved:
+            print(f"Lavalink: {dead_node.identifier} → 플레이어 {moved}개 이동")
+        return moved
+
+
+lavalink_pool = LavalinkPool(LAVALINK_NODES)
+
+@tasks.loop(seconds=LAVALINK_STATS_SECONDS)
+@metrics.timed("bot_loop_tick_seconds", loop="lavalink_stats")
+async def lavalink_stats_loop():
+    await lavalink_pool.check_health()
+    await lavalink_pool.refresh_stats()
+
+@bot.event
+async def on_wavelink_node_disconnected(payload):
+    # 연결이 끊겨 재연결을 시도하는 동안에도 플레이어는 노드에 붙어 있음 → 이때 옮김
+    # (on_wavelink_node_closed 는 플레이어가 이미 끊긴 뒤라 switch_node 가 실패함)
+    await lavalink_pool.failover(getattr(payload, "node", payload))
+
+# ================ 음악 (wavelink) ================
+MUSIC_SEARCH_CACHE_SIZE = 256
+MUSIC_SEARCH_CACHE_TTL = 30 * 60  # 검색 결과 재사용 시간(초)
+MUSIC_QUEUE_MAX = 100
+
+class SearchCache:
+    """검색어 → 트랙 목록 LRU 캐시 (TTL 포함). 빈 결과는 저장하지 않음."""
+
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, list]] = OrderedDict()
+
+    def get(self, query: str) -> Optional[list]:
+        item = self._data.get(query)
+        if not item:
+            return None
+        ts, tracks = item
+        if time.monotonic() - ts > self.ttl:
+            del self._data[query]
+            return None
+        self._data.move_to_end(query)
+        return tracks
+
+    def put(self, query: str, tracks: list):
+        self._data[query] = (time.monotonic(), tracks)
+        self._data.move_to_end(query)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+
+search_cache = SearchCache(MUSIC_SEARCH_CACHE_SIZE, MUSIC_SEARCH_CACHE_TTL)
+
+async def _search_one(query: str) -> list:
+    t0 = time.perf_counter()
+    try:
+        found = await wavelink.Playable.search(query)
+    except Exception as e:
+        metrics.observe("bot_lavalink_seconds", time.perf_counter() - t0, op="search", status="error")
+        print("트랙 검색 오류:", query, e)
+        return []
+    metrics.observe("bot_lavalink_seconds", time.perf_counter() - t0, op="search", status="ok")
+    # 플레이리스트 결과도 트랙 목록으로 취급
+    return list(getattr(found, "tracks", found) or [])
+
+async def search_tracks(query: str) -> list:
+    """유튜브 뮤직/유튜브 동시 검색 (유튜브 뮤직 결과 우선), 결과는 캐시."""
+    key = re.sub(r"\s+", " ", query).strip().casefold()
+    cached = search_cache.get(key)
+    if cached is not None:
+        return cached
+    ytm, yt = await asyncio.gather(_search_one(f"ytmsearch:{query}"), _search_one(f"ytsearch:{query}"))
+    tracks = ytm or yt
+    if tracks:
+        search_cache.put(key, tracks)
+    return tracks
+
+
+class QueuedTrack:
+    """
+    대기열 항목. 검색어 → 트랙 해석(search_tracks)만 미리(prefetch) 또는 재생 직전에 수행.
+    오디오 자체는 미리 받지 않음 — player.play() 때 Lavalink 가 로드.
+    """
+
+    def __init__(self, query: str, requester: str):
+        self.query = query
+        self.requester = requester
+        self._resolve: asyncio.Task | None = None
+
+    def prefetch(self):
+        """검색 결과만 미리 받아 둠 (오디오 프리로드 아님)."""
+        if self._resolve is None:
+            self._resolve = asyncio.create_task(search_tracks(self.query))
+
+    async def resolve(self):
+        self.prefetch()
+        tracks = await self._resolve
+        return tracks[0] if tracks else None
+
+
+class GuildMusic:
+    """길드별 음악 대기열. 트랙 종료 이벤트로 다음 곡 재생, 재생 시작 시 다음 곡의 검색 결과를 미리 받아 둠."""
+
+    def __init__(self):
+        self.items: deque[QueuedTrack] = deque()
+        self.text_channel = None  # 마지막으로 $play 를 받은 채널 (재생 알림용)
+        self._lock = asyncio.Lock()
+
+    @property
+    def busy(self) -> bool:
+        """play_next 가 다음 곡을 검색/시작하는 중 (아직 player.playing 이 아닐 수 있음)"""
+        return self._lock.locked()
+
+    def prefetch_next(self):
+        if self.items:
+            self.items[0].prefetch()
+
+    async def play_next(self, player: wavelink.Player) -> Optional[QueuedTrack]:
+        """대기열에서 재생 가능한 첫 곡을 시작하고 그 항목을 반환. 이미 재생 중이거나 틀 곡이 없으면 None"""
+        # 동시에 들어온 $play / track_end 가 서로 덮어쓰지 않도록 직렬화
+        async with self._lock:
+            if player.playing or player.paused:
+                return None
+            while self.items:
+                item = self.items.popleft()
+                track = await item.resolve()
+                if not track:
+                    await self._say(f"트랙을 찾을 수 없어 건너뜁니다: {item.query}")
+                    continue
+                await player.play(track)
+                await self._say(f"🎵 현재 재생 중: {track.title} (신청: {item.requester})")
+                return item
+            return None
+
+    async def _say(self, text: str):
+        if self.text_channel:
+            try:
+                await self.text_channel.send(text)
+            except Exception:
+                pass
+
+
+music_queues: dict[int, GuildMusic] = defaultdict(GuildMusic)
+
+@bot.event
+async def on_wavelink_track_start(payload):
+    if payload.player:
+        music_queues[payload.player.guild.id].prefetch_next()
+
+@bot.event
+async def on_wavelink_track_end(payload):
+    player = payload.player
+    if player and player.connected:
+        await music_queues[player.guild.id].play_next(player)
+
 @bot.command()
 async def play(ctx, *, query: str):
     if not ctx.author.voice:
         await ctx.send("먼저 음성 채널에 들어가 있어야 해요."); return
     if not ctx.voice_client:
-        vc: wavelink.Player = await ctx.author.voice.channel.connect(cls=wavelink.Player)
+        vc: wavelink.Player = await ctx.author.voice.channel.connect(cls=lavalink_pool.player_cls())
     else:
         vc: wavelink.Player = ctx.voice_client
-    tracks = await wavelink.Playable.search(f"ytmsearch:{query}")
-    await ctx.send("Youtube Music에서 검색중 ..."); await ctx.send(f"쿼리: {query}"); await ctx.send(f"{tracks}")
-    if not tracks:
-        tracks = await wavelink.Playable.search(f"ytsearch:{query}")
-        await ctx.send("Youtube 에서 검색중 ..."); await ctx.send(f"{tracks}")
-    if not tracks:
-        await ctx.send("트랙을 찾을 수 없습니다."); await ctx.send("해당 국가는 Youtube API를 이용하실 수 없습니다."); return
-    track = tracks[0]; await vc.play(track); await ctx.send(f"🎵 현재 재생 중: {track.title}")
+    gm = music_queues[ctx.guild.id]
+    gm.text_channel = ctx.channel
+    if len(gm.items) >= MUSIC_QUEUE_MAX:
+        await ctx.send("대기열이 가득 찼어요."); return
+
+    item = QueuedTrack(query, ctx.author.display_name)
+    gm.items.append(item)
+    if not (vc.playing or vc.paused or gm.busy):
+        started = await gm.play_next(vc)
+        if started is item or item not in gm.items:
+            return  # "현재 재생 중" 또는 "찾을 수 없어 건너뜀" 알림이 응답
+    if item in gm.items:
+        gm.prefetch_next()
+        await ctx.send(f"📝 대기열 {gm.items.index(item) + 1}번째에 추가: {query}")
+
+@bot.command(name="queue")
+async def queue_cmd(ctx):
+    gm = music_queues.get(ctx.guild.id)
+    if not gm or not gm.items:
+        await ctx.send("대기열이 비어 있어요."); return
+    lines = [f"{i}. {item.query} ({item.requester})" for i, item in enumerate(gm.items, start=1)]
+    await ctx.send(split_message(["📝 **대기열**"] + lines)[0])
 
 @bot.command()
 async def resume(ctx):
     vc: wavelink.Player = ctx.voice_client
-    await vc.resume(); await ctx.send("▶️ 다시 재생!")
+    if not vc:
+        await ctx.send("음성채널에 없습니다."); return
+    if vc.paused:
+        await vc.pause(False)
+    elif not vc.playing:
+        await music_queues[ctx.guild.id].play_next(vc)
+    await ctx.send("▶️ 다시 재생!")
 
 @bot.command()
 async def skip(ctx):
     vc: wavelink.Player = ctx.voice_client
-    await vc.stop(); await ctx.send("⏭️ 스킵!")
+    if not vc:
+        await ctx.send("음성채널에 없습니다."); return
+    # 현재 곡이 멈추면 track_end 이벤트에서 다음 곡 재생
+    await vc.skip(force=True); await ctx.send("⏭️ 스킵!")
 
 @bot.command()
 async def stop(ctx):
     vc: wavelink.Player = ctx.voice_client
     if vc:
+        music_queues.pop(ctx.guild.id, None)
         await vc.stop(); await vc.disconnect(); await ctx.send("🛑 노래 중지 및 음성채널에서 나갔습니다.")
     else:
         await ctx.send("이미 음성채널에 없습니다.")
@@ -985,55 +3995,119 @@ async def s(ctx, *, text):
     except Exception:
         pass
 
-    # 보이스 관련 동시성 제어: 한 길드당 한 번씩만 처리
-    async with voice_locks[ctx.guild.id]:
-        # 발화자 음성 채널 체크
-        if not ctx.author.voice:
-            await ctx.send("먼저 음성채널에 들어가 있어야 해요.", delete_after=3)
-            return
-
-        # 연결/재사용
-        vc = ctx.voice_client
-        if not vc or not vc.is_connected():
-            try:
-                vc = await ctx.author.voice.channel.connect(timeout=15, reconnect=True)
-            except asyncio.TimeoutError:
-                await ctx.send("보이스 연결 타임아웃… 잠시 후 다시 시도해줘요.", delete_after=4)
-                return
-            except discord.ClientException:
-                vc = ctx.voice_client  # 이미 연결 중/완료 상태
-
-        # edge-tts 합성 (캐시 사용)
-        mp3_path = await tts_synthesize_to_file(text)
-
-        # 재생 중이면 정지 후 새로
-        if vc.is_playing():
-            vc.stop()
-
-        # ffmpeg로 재생
-        source = discord.FFmpegPCMAudio(mp3_path, before_options="-nostdin", options="-vn")
-        vc.play(source)
+    # 발화자 음성 채널 체크
+    if not ctx.author.voice:
+        await ctx.send("먼저 음성채널에 들어가 있어야 해요.", delete_after=3)
+        return
 
-        # 끝날 때까지 짧게 폴링
-        while vc.is_playing():
-            await asyncio.sleep(0.2)
+    # 길드별 대기열로 넘기고 바로 리턴 (재생/합성은 소비자 태스크가 처리)
+    ahead = get_tts_player(ctx.guild).submit(text, ctx.author.voice.channel, ctx.channel)
+    if ahead is None:
+        await ctx.send("TTS 대기열이 가득 찼어요. 잠시 후 다시 시도해줘요.", delete_after=3)
+    elif ahead > 0:
+        await ctx.send(f"🔊 대기열 {ahead}번째로 추가됐어요.", delete_after=3)
 
 
 @bot.command()
 async def sstop(ctx):
-    vc = ctx.voice_client
-    if vc and vc.is_playing():
-        vc.stop()
+    if get_tts_player(ctx.guild).stop():
         await ctx.send("TTS를 중지했습니다.", delete_after=3)
     else:
         await ctx.send("현재 TTS가 재생 중이 아닙니다.", delete_after=3)
 
+# ================ 메트릭 수집 훅 / HTTP 서버 ================
+@bot.before_invoke
+async def _metrics_before_command(ctx):
+    ctx.metrics_started = time.perf_counter()
+
+@bot.after_invoke
+async def _metrics_after_command(ctx):
+    started = getattr(ctx, "metrics_started", None)
+    if started is not None and ctx.command:
+        metrics.observe("bot_command_seconds", time.perf_counter() - started, kind="prefix",
+                        command=ctx.command.qualified_name, status="error" if ctx.command_failed else "ok")
+
+@bot.event
+async def on_app_command_completion(interaction: discord.Interaction, command):
+    # 슬래시 명령은 시작 훅이 없어서 인터랙션 생성 시각부터 잼 (게이트웨이 전달 시간 포함)
+    elapsed = (discord.utils.utcnow() - interaction.created_at).total_seconds()
+    metrics.observe("bot_command_seconds", max(0.0, elapsed), kind="slash",
+                    command=command.qualified_name, status="ok")
+
+async def loop_lag_probe():
+    """LOOP_LAG_INTERVAL 만큼 잤을 때 실제로 늦게 깨어난 시간 = 루프를 막고 있던 작업 시간."""
+    loop = asyncio.get_running_loop()
+    while True:
+        t0 = loop.time()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        metrics.observe("bot_event_loop_lag_seconds", max(0.0, loop.time() - t0 - LOOP_LAG_INTERVAL))
+
+_loop_lag_task: Optional[asyncio.Task] = None
+
+def start_loop_lag_probe():
+    global _loop_lag_task
+    if _loop_lag_task is None or _loop_lag_task.done():
+        _loop_lag_task = asyncio.create_task(loop_lag_probe())
+
+def _tts_queue_depth() -> int:
+    return sum(p.queue.qsize() for p in list(tts_players.values()))
+
+def _lavalink_penalties() -> dict:
+    return {(("node", ident),): node_penalty(st) for ident, st in list(lavalink_pool.stats.items())}
+
+metrics.callback("bot_gateway_latency_seconds", "gauge", "디스코드 게이트웨이 하트비트 지연",
+                 lambda: bot.latency if bot.latency == bot.latency else 0.0)  # 연결 전엔 NaN
+if SHARD_COUNT:
+    metrics.callback("bot_shard_latency_seconds", "gauge", "샤드별 게이트웨이 하트비트 지연 (-1: 연결 끊김)",
+                     lambda: {(("shard", str(sid)),): -1.0 if sh.is_closed() or sh.latency != sh.latency else sh.latency
+                              for sid, sh in bot.shards.items()})
+metrics.callback("bot_award_log_queue_depth", "gauge", "전송 대기 중인 포인트 로그 줄 수", lambda: award_log.depth())
+metrics.callback("bot_tts_queue_depth", "gauge", "재생 대기 중인 TTS 요청 수", _tts_queue_depth)
+metrics.callback("bot_purchase_queue_depth", "gauge", "DB 반영 대기 중인 구매 요청 수", lambda: purchase_engine.depth())
+metrics.callback("bot_role_bulk_pending", "gauge", "역할 일괄 변경 대기 중인 멤버 수", lambda: role_bulk.pending)
+metrics.callback("bot_qa_queue_depth", "gauge", "동시 처리 제한으로 대기 중인 Q&A 요청 수", lambda: qa_gate.depth())
+metrics.callback("bot_tts_cache_hits_total", "counter", "TTS 캐시 히트", lambda: tts_cache.stats()["hits"])
+metrics.callback("bot_tts_cache_misses_total", "counter", "TTS 캐시 미스", lambda: tts_cache.stats()["misses"])
+metrics.callback("bot_tts_cache_hit_ratio", "gauge", "TTS 캐시 적중률", lambda: tts_cache.stats()["hit_rate"])
+metrics.callback("bot_tts_cache_bytes", "gauge", "TTS 캐시 디스크 사용량", lambda: tts_cache.stats()["bytes"])
+metrics.callback("bot_qa_cache_hits_total", "counter", "Q&A 캐시 히트", lambda: qa_cache.stats()["hits"])
+metrics.callback("bot_qa_cache_misses_total", "counter", "Q&A 캐시 미스", lambda: qa_cache.stats()["misses"])
+metrics.callback("bot_voice_events_total", "counter", "받은 보이스 상태 이벤트 수", lambda: voice_pipeline.events)
+metrics.callback("bot_voice_settle_ops_total", "counter", "합친 뒤 DB 에 반영한 보이스 정산 수", lambda: voice_pipeline.db_ops)
+metrics.callback("bot_lavalink_node_penalty", "gauge", "Lavalink 노드 부하 점수", _lavalink_penalties)
+
+def start_metrics_server():
+    """METRICS_PORT 가 있으면 uvicorn 을 데몬 스레드로 실행 (봇 이벤트 루프와 별개 루프)."""
+    if not METRICS_PORT:
+        return
+    app = FastAPI()
+
+    @app.get("/metrics")
+    async def metrics_endpoint(request: Request):
+        return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    server = uvicorn.Server(uvicorn.Config(app, host=METRICS_HOST, port=int(METRICS_PORT), log_level="warning"))
+    threading.Thread(target=server.run, name="metrics-http", daemon=True).start()
+    print(f"메트릭: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
 # ================= 실행 =================
 def main():
     if not MY_DISCORD_TOKEN_KEY:
         print("환경변수 DISCORD_TOKEN이 비어있습니다. 토큰을 설정하세요.")
         return
-    bot.run(MY_DISCORD_TOKEN_KEY)
+    start_metrics_server()
+    # SIGTERM(systemd, docker stop, kill)도 Ctrl+C 처럼 KeyboardInterrupt 로 받아 아래 종료 처리를 거치게
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        bot.run(MY_DISCORD_TOKEN_KEY)
+    finally:
+        # 아직 기록 안 된 보이스 정산/활동 시각까지 마저 쓰고 종료
+        voice_pipeline.flush_sync()
+        rows = activity.drain()
+        if rows:
+            points_db.write_sync(flush_activity_rows, rows)
+        points_db.close()
+        tts_cache.save()
 
 if __name__ == "__main__":
     main()